@@ -0,0 +1,395 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2026 Vinay M. Sajip. See LICENSE for licensing information.
+#
+# Benchmarks for sarge: Subprocess Allegedly Rewards Good Encapsulation :-)
+#
+# Run with the names of the benchmarks to run, or with no names to run them
+# all. Use --help to see the available benchmarks and options.
+#
+import gc
+import optparse
+import os
+import subprocess
+import sys
+import time
+
+import sarge
+
+BENCHMARKS = []
+
+
+def benchmark(func):
+    BENCHMARKS.append(func)
+    return func
+
+
+def timed(func, count):
+    gc.collect()
+    start = time.time()
+    for i in range(count):
+        func()
+    return time.time() - start
+
+
+def report(label, elapsed, count, unit='op'):
+    print('  %-40s %10.1f us/%s' % (label, elapsed * 1e6 / count, unit))
+
+
+def get_rss():
+    """
+    Return the resident set size of this process in MB, where available.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE') // (1024 * 1024)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+@benchmark
+def spawn(options):
+    """
+    Spawn latency versus parent RSS, with and without the posix_spawn() path.
+    """
+    count = options.count
+    ballast = None
+    for size in (0, 256, 1024, 2048):
+        if size:
+            del ballast
+            # Touch every page so that it's really resident
+            ballast = bytearray(b'x') * (size * 1024 * 1024)
+        print('parent RSS: %s MB' % get_rss())
+        for fast in (False, True):
+
+            def func():
+                sarge.Command(['true'], fast_spawn=fast).run()
+
+            report('Command.run (fast_spawn=%s)' % fast, timed(func, count), count, 'spawn')
+    del ballast
+
+
+@benchmark
+def spawnserver(options):
+    """
+    Spawn latency versus parent RSS, spawning locally and via a spawn server.
+    """
+    from sarge.spawnserver import SpawnServer
+
+    count = options.count
+    server = SpawnServer().start()
+    ballast = None
+    try:
+        for size in (0, 1024, 2048):
+            if size:
+                del ballast
+                ballast = bytearray(b'x') * (size * 1024 * 1024)
+            print('parent RSS: %s MB' % get_rss())
+            for label, kwargs in (('local', {}), ('spawn server', {'spawn_server': server})):
+
+                def func():
+                    sarge.run('true', **kwargs)
+
+                report('run (%s)' % label, timed(func, count), count, 'spawn')
+    finally:
+        del ballast
+        server.stop()
+
+
+@benchmark
+def construction(options):
+    """
+    Construction cost of Command and Pipeline objects with an env overlay.
+    """
+    count = options.count * 10
+    env = {'SARGE_BENCH': '1'}
+    # simulate a largish environment
+    for i in range(200):
+        os.environ['SARGE_BENCH_%d' % i] = 'x' * 64
+    maxsize = sarge.env_cache.maxsize
+    try:
+        for size in (0, maxsize):
+            sarge.env_cache.maxsize = size
+            sarge.env_cache.clear()
+
+            def command():
+                sarge.Command(['echo', 'foo'], env=env)
+
+            def pipeline():
+                p = sarge.Pipeline('echo foo | cat', env=env)
+                for node in p.tree.parts[::2]:
+                    p.new_command(node.command, **p.kwargs)
+
+            label = 'cached' if size else 'uncached'
+            report('Command (%s)' % label, timed(command, count), count)
+            report('Pipeline, 2 commands (%s)' % label, timed(pipeline, count), count)
+    finally:
+        sarge.env_cache.maxsize = maxsize
+        for i in range(200):
+            del os.environ['SARGE_BENCH_%d' % i]
+
+
+@benchmark
+def lookup(options):
+    """
+    Executable lookup: stat()/access() calls and time, with and without caching.
+    """
+    from sarge.utils import ExecutableCache, executable_cache, which
+
+    count = options.count * 10
+    calls = [0]
+    names = ('stat', 'lstat', 'access')
+    originals = dict((name, getattr(os, name)) for name in names)
+
+    def counting(func):
+        def wrapper(*args, **kwargs):
+            calls[0] += 1
+            return func(*args, **kwargs)
+        return wrapper
+
+    def uncached():
+        which('sh')
+
+    def cached():
+        executable_cache.find('sh')
+
+    def checked():
+        cache.find('sh')
+
+    cache = ExecutableCache(check_interval=0)
+    print('  PATH has %d entries' % len(os.environ.get('PATH', '').split(os.pathsep)))
+    for label, func in (('uncached', uncached), ('cached, always checked', checked),
+                        ('cached', cached)):
+        func()  # prime the cache
+        for name in names:
+            setattr(os, name, counting(originals[name]))
+        calls[0] = 0
+        try:
+            func()
+        finally:
+            for name in names:
+                setattr(os, name, originals[name])
+        print('  %-40s %10d syscalls/lookup' % ('lookup of sh (%s)' % label, calls[0]))
+        report('lookup of sh (%s)' % label, timed(func, count), count, 'lookup')
+
+
+@benchmark
+def bulk(options):
+    """
+    Commands per second from run_many, for various numbers of workers.
+    """
+    count = options.count * 2
+    print('  %d CPUs' % sarge.cpu_count())
+    workers = 1
+    while True:
+        elapsed = timed(lambda: sarge.run_many(['true'] * count, max_workers=workers), 1)
+        print('  %-40s %10.1f commands/s' % ('run_many, max_workers=%d' % workers,
+                                              count / elapsed))
+        if workers >= 2 * sarge.cpu_count():
+            break
+        workers *= 2
+    elapsed = timed(lambda: [sarge.run('true') for i in range(count)], 1)
+    print('  %-40s %10.1f commands/s' % ('sequential run()', count / elapsed))
+
+
+@benchmark
+def batching(options):
+    """
+    Running a command over many arguments: run_batched() versus one process per item.
+    """
+    count = options.count * 10
+    items = ['file-%06d.txt' % i for i in range(count)]
+    elapsed = timed(lambda: sarge.run_many(['true %s' % item for item in items]), 1)
+    report('one process per item (%d items)' % count, elapsed, count, 'item')
+    for max_workers in sorted(set((1, sarge.cpu_count()))):
+        elapsed = timed(lambda: sarge.run_batched('true', items, max_workers=max_workers), 1)
+        report('run_batched, max_workers=%d' % max_workers, elapsed, count, 'item')
+
+
+@benchmark
+def reaping(options):
+    """
+    Reap latency and CPU time for many concurrent children, with and without the reaper.
+    """
+    import resource
+    import threading
+
+    count = options.count * 25
+    idle = 1.0
+    enabled = sarge.reaper.enabled
+
+    def cpu():
+        r = resource.getrusage(resource.RUSAGE_SELF)
+        return r.ru_utime + r.ru_stime
+
+    def poll_loop(ps):
+        delay = 0.0005
+        while True:
+            ps = [p for p in ps if p.poll() is None]
+            if not ps:
+                break
+            time.sleep(delay)
+            delay = min(delay * 2, 0.02)
+
+    def wait_all(ps):
+        for p in ps:
+            p.wait()
+
+    def reaper_loop(ps):
+        # This is how run_many() waits when the reaper is available
+        while True:
+            exits = sarge.reaper.exits
+            ps = [p for p in ps if p.poll() is None]
+            if not ps:
+                break
+            sarge.reaper.wait_for_exit(exits, 1.0)
+
+    print('  %d children, running for %.1f s; reaper available: %s' % (count, idle,
+                                                                       sarge.reaper.available))
+    try:
+        for label, use_reaper, func in (('blocking waits', False, wait_all),
+                                        ('poll loop', False, poll_loop),
+                                        ('reaper', True, reaper_loop),
+                                        ('reaper, blocking waits', True, wait_all)):
+            sarge.reaper.enabled = use_reaper
+            # The children all exit when the write end of their stdin is closed
+            rd, wr = os.pipe()
+            ps = [sarge.Popen(['cat'], stdin=rd, stdout=subprocess.DEVNULL)
+                  for i in range(count)]
+            os.close(rd)
+            gc.collect()
+            time.sleep(0.5)
+            timer = threading.Timer(idle, os.close, (wr,))
+            start_cpu = cpu()
+            start = time.time()
+            timer.start()
+            func(ps)
+            elapsed = time.time() - start - idle
+            print('  %-40s %10.1f ms after exit, %.1f ms CPU' % (
+                  'reap all (%s)' % label, elapsed * 1e3, (cpu() - start_cpu) * 1e3))
+    finally:
+        sarge.reaper.enabled = enabled
+
+
+@benchmark
+def binding(options):
+    """
+    Creating pipelines from a template: formatting and parsing versus binding.
+    """
+    count = options.count * 10
+    template = 'grep {0} {1} | sort | uniq -c > {2}'
+    compiled = sarge.compile_pipeline(template)
+    args = ('some pattern', 'input file.txt', 'counts.txt')
+
+    def parse():
+        sarge.parse_command_line(sarge.shell_format(template, *args))
+
+    def bind():
+        compiled.bind(*args)
+
+    def parse_pipeline():
+        sarge.Pipeline(sarge.shell_format(template, *args))
+
+    def bind_pipeline():
+        compiled.pipeline(*args)
+
+    report('shell_format + parse', timed(parse, count), count)
+    report('bind', timed(bind, count), count)
+    report('Pipeline (shell_format + parse)', timed(parse_pipeline, count), count)
+    report('Pipeline (bind)', timed(bind_pipeline, count), count)
+
+
+@benchmark
+def lexing(options):
+    """
+    Parsing throughput for long command lines: regex scanning versus shell_shlex.
+    """
+    count = max(options.count // 20, 1)
+    maxsize = sarge.parse_cache.maxsize
+    sarge.parse_cache.maxsize = 0
+    try:
+        for n in (10, 1000, 10000):
+            source = 'ls -l %s | sort > out.txt' % ' '.join('"file %06d.txt"' % i
+                                                          for i in range(n))
+            for use_scanner in (False, True):
+
+                def parse():
+                    parser = sarge.CommandLineParser()
+                    parser.use_scanner = use_scanner
+                    parser.parse(source)
+
+                label = 'regex scanner' if use_scanner else 'shell_shlex'
+                elapsed = timed(parse, count)
+                print('  %-40s %10.1f MB/s' % ('%s, %d arguments' % (label, n),
+                                               len(source) * count / elapsed / 1e6))
+    finally:
+        sarge.parse_cache.maxsize = maxsize
+
+
+@benchmark
+def memory(options):
+    """
+    Memory used by parsed command lines, as held by the parse cache.
+    """
+    import tracemalloc
+
+    count = options.count * 10
+    maxsize = sarge.parse_cache.maxsize
+    sarge.parse_cache.maxsize = 0
+    try:
+        for source in ('echo foo', 'grep -v x a.txt | sort | uniq -c > out.txt',
+                       '(a | b; c d && e || f > ghi jkl 2> mno) & p; q | r 2>&1 | s'):
+            gc.collect()
+            tracemalloc.start()
+            trees = [sarge.parse_command_line(source) for i in range(count)]
+            size = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            del trees
+            print('  %-60s %6d bytes/tree' % (source, size / count))
+    finally:
+        sarge.parse_cache.maxsize = maxsize
+
+
+@benchmark
+def plans(options):
+    """
+    Loading serialized plans versus parsing the command lines they came from.
+    """
+    count = options.count * 10
+    maxsize = sarge.parse_cache.maxsize
+    sarge.parse_cache.maxsize = 0
+    try:
+        for label, source in (
+                ('short', 'grep -v x a.txt | sort | uniq -c > out.txt'),
+                ('compound', '(a | b; c d && e || f > ghi jkl 2> mno) & p; q | r 2>&1 | s'),
+                ('1000 arguments', 'ls %s | sort > out.txt' % ' '.join(
+                    '"file %06d.txt"' % i for i in range(1000)))):
+            plan = sarge.dump_plan(source)
+            n = count if len(source) < 1000 else max(count // 100, 1)
+            print('  %s: %d byte command line, %d byte plan' % (label, len(source), len(plan)))
+            report('parse (%s)' % label, timed(lambda: sarge.parse_command_line(source), n), n)
+            report('load_plan (%s)' % label, timed(lambda: sarge.load_plan(plan), n), n)
+    finally:
+        sarge.parse_cache.maxsize = maxsize
+
+
+def main():
+    parser = optparse.OptionParser(usage='usage: %prog [options] [benchmark ...]')
+    parser.add_option('-n', '--count', default=200, type='int',
+                      help='Number of iterations for each measurement')
+    parser.add_option('-l', '--list', default=False, action='store_true',
+                      help='List the available benchmarks')
+    options, args = parser.parse_args()
+    if options.list:
+        for func in BENCHMARKS:
+            print('%-20s %s' % (func.__name__, func.__doc__.strip().splitlines()[0]))
+        return
+    selected = [f for f in BENCHMARKS if not args or f.__name__ in args]
+    for func in selected:
+        print('%s: %s' % (func.__name__, func.__doc__.strip().splitlines()[0]))
+        func(options)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -4,9 +4,14 @@
 #
 # sarge: Subprocess Allegedly Rewards Good Encapsulation :-)
 #
+from collections import OrderedDict, deque
 import errno
+import functools
+import hashlib
 from io import BytesIO
+import json
 import logging
+import math
 import os
 
 try:
@@ -14,12 +19,15 @@ try:
 except ImportError:  # pragma: no cover
     import Queue as queue
 import re
+import select
 import shutil
 import signal
 import string
+import struct
 import subprocess
 import sys
 import threading
+import time
 
 try:
     from logging import NullHandler
@@ -36,11 +44,13 @@ except ImportError:  # pragma: no cover
             self.lock = None
 
 
-from .shlext import shell_shlex
+from .shlext import scan_tokens, shell_shlex
 
 __all__ = ('shell_quote', 'Capture', 'Command', 'ShellFormatter', 'Pipeline', 'Feeder',
            'shell_format', 'run', 'parse_command_line', 'capture_stdout',
-           'capture_stderr', 'capture_both', 'get_stdout', 'get_stderr', 'get_both')
+           'capture_stderr', 'capture_both', 'get_stdout', 'get_stderr', 'get_both',
+           'run_many', 'run_batched', 'run_hedged', 'compile_pipeline', 'dump_plan',
+           'load_plan')
 
 __version__ = '0.1.9.dev0'
 __date__ = '2026-01-20'
@@ -61,6 +71,17 @@ if sys.version_info[0] < 3:  # pragma: no cover
     binary_type = str
     string_types = basestring,
     _wait_has_timeout = False
+    _has_process_group = False
+
+    class _TimeoutExpired(Exception):
+        """
+        Stands in for :class:`subprocess.TimeoutExpired`, which Python 2
+        doesn't have.
+        """
+        def __init__(self, cmd, timeout):
+            super(_TimeoutExpired, self).__init__(cmd, timeout)
+            self.cmd = cmd
+            self.timeout = timeout
 else:  # pragma: no cover
     PY3 = True
     text_type = str
@@ -68,6 +89,9 @@ else:  # pragma: no cover
     string_types = str,
     basestring = str
     _wait_has_timeout = sys.version_info[:2] >= (3, 3)
+    # Popen accepts a process_group argument from Python 3.11
+    _has_process_group = sys.version_info[:2] >= (3, 11)
+    _TimeoutExpired = subprocess.TimeoutExpired
 
 # This regex determines which shell input needs quoting
 # because it may be unsafe
@@ -112,7 +136,8 @@ class ShellFormatter(string.Formatter):
         If a conversion is specified (e.g. !s, !r), no quoting is performed.
         If *no* conversion is specified, the value is converted to string
         (using `str()`) and that value is quoted using `shell_quote()`
-        before being returned.
+        before being returned. Lists and tuples are returned unchanged, to be
+        quoted by `format_field()`, which knows the format spec.
 
         Args:
             value (Any): The value to be converted.
@@ -123,11 +148,37 @@ class ShellFormatter(string.Formatter):
             str: The converted value.
         """
         if conversion is None:
-            result = shell_quote(str(value))
+            if isinstance(value, (list, tuple)):
+                result = value
+            else:
+                result = shell_quote(str(value))
         else:
             result = super(ShellFormatter, self).convert_field(value, conversion)
         return result
 
+    def format_field(self, value, format_spec):
+        """
+        Format a field which has been converted by `convert_field()`.
+
+        A list or tuple with the format spec ``*`` (as in ``{0:*}``) is
+        expanded into several words: each element is converted to string and
+        quoted, and the results are joined with spaces. Otherwise, it's quoted
+        as a single word, like any other value.
+
+        Args:
+            value (Any): The value to be formatted.
+
+            format_spec (str): The format spec.
+
+        Returns:
+            str: The formatted value.
+        """
+        if isinstance(value, (list, tuple)):
+            if format_spec == '*':
+                return ' '.join([shell_quote(str(v)) for v in value])
+            value = shell_quote(str(value))
+        return super(ShellFormatter, self).format_field(value, format_spec)
+
 
 def shell_format(fmt, *args, **kwargs):
     """
@@ -213,7 +264,7 @@ class Capture(WithMixin):
         self.counter = self.__class__.counter
         self.__class__.counter += 1
 
-    def add_stream(self, stream):
+    def add_stream(self, stream, source=None):
         """
         Add a stream to this instance. A new thread is spawned to read from
         the stream into the capture queue for this instance.
@@ -222,11 +273,13 @@ class Capture(WithMixin):
             stream (file): An output stream from a child process (i.e. the read
                            end of a pipe, whose write end is the output stream
                            from the process.
+            source (tuple): The :class:`Command` whose output the stream is, and
+                            the name of the stream, for tracing and callbacks.
         """
         self.streams.append(stream)
 
         ready = threading.Event()
-        t = threading.Thread(target=self.reader, args=(stream, ready))
+        t = threading.Thread(target=self.reader, args=(stream, ready, source))
         logger.debug('Created thread %s as reader for %r', t.name, self)
         self.threads.append(t)
         t.daemon = True
@@ -235,7 +288,7 @@ class Capture(WithMixin):
         ready.wait()
         logger.debug('%r: reader thread now started', self)
 
-    def reader(self, stream, ready):
+    def reader(self, stream, ready, source=None):
         """
         The callable used as the runnable in reader threads.
 
@@ -244,8 +297,13 @@ class Capture(WithMixin):
 
             ready (threading.Event): An Event instance to set when the
                                      reader thread starts executing.
+
+            source (tuple): The :class:`Command` whose output the stream is, and
+                            the name of the stream, for tracing and callbacks.
         """
         ready.set()
+        first = source is not None and (tracer is not None
+                                        or source[0].on_first_output is not None)
         chunk_size = self.buffer_size
         if chunk_size > 0:
             logger.debug('%r: reader thread about to read %s', self, chunk_size)
@@ -258,6 +316,9 @@ class Capture(WithMixin):
             else:
                 chunk = stream.read(chunk_size)
             if chunk:
+                if first:
+                    first = False
+                    self._first_output(source)
                 self.buffer.put_nowait(chunk)
                 logger.debug('queued chunk of length %d to %s: %r', len(chunk), self.buffer,
                              chunk[:30])
@@ -270,8 +331,17 @@ class Capture(WithMixin):
                 if not chunk:
                     break
         logger.debug('%r: finished reading stream %s', self, stream)
+        if source and tracer is not None:
+            tracer.instant('EOF (%s)' % source[1], time.time(), source[0].process.pid)
         stream.close()
 
+    def _first_output(self, source):
+        command, name = source
+        if tracer is not None:
+            tracer.instant('first output (%s)' % name, time.time(), command.process.pid)
+        if command.on_first_output is not None:
+            _call_hook(command.on_first_output, command, name)
+
     @property
     def bytes(self):
         """
@@ -540,13 +610,634 @@ SWAP_OUTPUTS = {
 }
 
 
+# A started spawnserver.SpawnServer instance to spawn children with, unless
+# overridden using the ``spawn_server`` keyword argument to Command.
+default_spawn_server = None
+
+# Whether to spawn children using os.posix_spawn() where the requested
+# redirections, environment and working directory allow it. This avoids
+# the cost of fork() in large parent processes. It's opt-in, as it changes how
+# close_fds is honoured and how errors are reported. Where subprocess already
+# uses vfork() (Python >= 3.10 on Linux), there's little benefit anyway.
+default_fast_spawn = False
+
+if os.name == 'posix' and hasattr(os, 'posix_spawn'):  # pragma: no cover
+    import inspect
+
+    # The parameters of Popen._execute_child vary across Python versions, so
+    # we look them up by name.
+    _EXECUTE_CHILD_PARAMS = inspect.getfullargspec(subprocess.Popen._execute_child).args[1:]
+    del inspect
+    _CAN_FAST_SPAWN = hasattr(subprocess.Popen, '_close_pipe_fds')
+else:  # pragma: no cover
+    _CAN_FAST_SPAWN = False
+
+
+def _inheritable_fds():
+    """
+    Return a list of the inheritable file descriptors above 2 which are open in
+    this process, or ``None`` if they can't be determined.
+    """
+    for d in ('/proc/self/fd', '/dev/fd'):
+        try:
+            names = os.listdir(d)
+        except OSError:
+            continue
+        result = []
+        for name in names:
+            fd = int(name)
+            if fd > 2:
+                try:
+                    if os.get_inheritable(fd):
+                        result.append(fd)
+                except OSError:
+                    pass  # e.g. the fd used to list the directory
+        return result
+    return None
+
+
+def _find_executable(executable, env, cwd=None):
+    """
+    Find the path of an executable in the same way as the exec*p* functions,
+    using the ``PATH`` in ``env``, or ``os.environ`` if that's ``None``.
+    Return ``None`` if no executable can be found.
+    """
+    from .utils import executable_cache
+
+    if os.path.dirname(executable):
+        return executable
+    if env is None:
+        path = os.environ.get('PATH', os.defpath)
+    else:
+        path = env.get('PATH')
+        if path is None:
+            path = env.get(b'PATH', os.defpath)
+        if PY3 and isinstance(path, bytes):
+            path = os.fsdecode(path)
+    return executable_cache.find(executable, path, cwd)
+
+
+# Serializes the checks which ensure each callback is only called once
+_hook_lock = threading.Lock()
+
+
+def _call_hook(hook, *args):
+    """
+    Call a user-supplied callback. Exceptions are logged rather than raised, as
+    the caller is often one of sarge's internal threads.
+    """
+    try:
+        hook(*args)
+    except Exception as e:
+        logger.exception('Callback %r failed: %s', hook, e)
+
+
+# Serializes adding, taking and calling the exit callbacks of processes
+_exit_lock = threading.Condition()
+
+
+def _call_exit_callbacks(p, wait=False):
+    """
+    Call the exit callbacks of a process which has exited (its ``returncode``
+    has been set). Callbacks added afterwards are called by :func:`_on_exit`
+    itself. This must be called with no locks held, such as the
+    ``_waitpid_lock`` of a :class:`subprocess.Popen`, as the callbacks may
+    poll or wait for the process.
+
+    Args:
+        p: The process (a :class:`Popen` or
+           :class:`~sarge.spawnserver.RemoteProcess`).
+        wait (bool): If ``True`` and another thread is calling the callbacks,
+                     wait until it has finished, so that they've all been
+                     called on return.
+    """
+    me = threading.current_thread()
+    with _exit_lock:
+        if p.returncode is None:
+            return
+        if p.exit_caller is not None:
+            if wait and p.exit_caller is not me:
+                while p.exit_caller is not None:
+                    _exit_lock.wait()
+            return
+        callbacks, p.exit_callbacks = p.exit_callbacks, None
+        if not callbacks:
+            return
+        p.exit_caller = me
+    try:
+        for callback in callbacks:
+            _call_hook(callback, p)
+    finally:
+        with _exit_lock:
+            p.exit_caller = None
+            _exit_lock.notify_all()
+
+
+def _on_exit(p, callback):
+    """
+    Arrange for a callback to be called with a process once it has exited and
+    its ``returncode`` has been set, from whichever thread notices that. If
+    that has already happened, it's called now.
+
+    Args:
+        p: The process (a :class:`Popen` or
+           :class:`~sarge.spawnserver.RemoteProcess`).
+        callback (callable): The callback.
+    """
+    with _exit_lock:
+        if p.returncode is None:
+            if p.exit_callbacks is None:
+                p.exit_callbacks = []
+            p.exit_callbacks.append(callback)
+            return
+    _call_hook(callback, p)
+
+
+# The installed Tracer, if any. When this is None, tracing costs one test
+# of it at each point where an event might be recorded.
+tracer = None
+
+
+def _trace_time(t):
+    # Trace event timestamps are in microseconds
+    return int(t * 1e6)
+
+
+def _command_line(args):
+    if isinstance(args, string_types):
+        return args
+    return ' '.join(args)
+
+
+class Tracer(object):
+    """
+    This class records a timeline of what sarge does, as events in the Chrome
+    trace event format, which can be viewed in Perfetto (https://ui.perfetto.dev)
+    or ``chrome://tracing``. Each child process gets its own track, showing
+    when it was spawned, when its captured output started and ended, and when it
+    exited. Command line parsing is shown on the track of the thread which did
+    it.
+
+    Use an instance as a context manager, or call :meth:`install` and
+    :meth:`uninstall`, to record events while it's installed.
+    """
+
+    def __init__(self):
+        self.events = []
+        self.pid = os.getpid()
+        self.previous = None
+        self.named = set()
+
+    def install(self):
+        """
+        Start recording events. Returns the instance.
+        """
+        global tracer
+
+        self.previous = tracer
+        tracer = self
+        return self
+
+    def uninstall(self):
+        """
+        Stop recording events, reinstating any previously installed tracer.
+        """
+        global tracer
+
+        if tracer is self:
+            tracer = self.previous
+        self.previous = None
+
+    __enter__ = install
+
+    def __exit__(self, *args):
+        self.uninstall()
+
+    def name_track(self, tid, name):
+        """
+        Give a name to a track, if it doesn't already have one.
+
+        Args:
+            tid (int): The track's identifier: a child's process ID, or a
+                       thread's identifier.
+            name (str): The name for the track.
+        """
+        if tid not in self.named:
+            self.named.add(tid)
+            self.events.append({'name': 'thread_name', 'ph': 'M', 'pid': self.pid, 'tid': tid,
+                                'args': {'name': name}})
+
+    def complete(self, name, start, end, tid, args=None):
+        """
+        Record an event with a duration.
+
+        Args:
+            name (str): The event's name.
+            start (float): When it started, as a ``time.time()`` value.
+            end (float): When it ended, as a ``time.time()`` value.
+            tid (int): The track to show it on.
+            args (dict): Any details to show with the event.
+        """
+        start = _trace_time(start)
+        event = {'name': name, 'ph': 'X', 'ts': start, 'dur': _trace_time(end) - start,
+                 'pid': self.pid, 'tid': tid}
+        if args:
+            event['args'] = args
+        self.events.append(event)
+
+    def instant(self, name, when, tid, args=None):
+        """
+        Record an event without a duration.
+
+        Args:
+            name (str): The event's name.
+            when (float): When it happened, as a ``time.time()`` value.
+            tid (int): The track to show it on.
+            args (dict): Any details to show with the event.
+        """
+        event = {'name': name, 'ph': 'i', 's': 't', 'ts': _trace_time(when), 'pid': self.pid,
+                 'tid': tid}
+        if args:
+            event['args'] = args
+        self.events.append(event)
+
+    def parsed(self, source, start, end):
+        """
+        Record the parsing of a command line.
+        """
+        t = threading.current_thread()
+        self.name_track(t.ident, t.name)
+        self.complete('parse', start, end, t.ident, {'source': source})
+
+    def spawned(self, command, process, end):
+        """
+        Record the spawning of a command's child process.
+        """
+        cmd = _command_line(command.args)
+        self.name_track(process.pid, '%s [%s]' % (cmd, process.pid))
+        self.complete('spawn', process.start_time, end, process.pid, {'command': cmd})
+
+    def exited(self, process):
+        """
+        Record the exit of a child process, and its lifetime.
+        """
+        args = {'returncode': process.returncode}
+        usage = getattr(process, 'resource_usage', None)
+        if usage is not None:
+            for k in usage.fields:
+                args[k] = getattr(usage, k)
+        self.complete('run', process.start_time, process.end_time, process.pid, args)
+        self.instant('exit', process.end_time, process.pid, {'returncode': process.returncode})
+
+    def to_json(self):
+        """
+        Return the recorded events as a dictionary in the Chrome trace event
+        format, ready to be serialized to JSON.
+        """
+        return {'traceEvents': list(self.events), 'displayTimeUnit': 'ms'}
+
+    def dump(self, dest):
+        """
+        Write the recorded events as JSON.
+
+        Args:
+            dest (str|file): The path of the file to write, or a text stream.
+        """
+        import json
+
+        if isinstance(dest, string_types):
+            with open(dest, 'w') as f:
+                json.dump(self.to_json(), f)
+        else:
+            json.dump(self.to_json(), dest)
+
+
+class ResourceUsage(object):
+    """
+    This class holds the resources used by a process, or the totals for
+    several processes, as reported by ``os.wait4()``.
+
+    Args:
+        user_time (float): CPU time spent in user mode, in seconds.
+        system_time (float): CPU time spent in the kernel, in seconds.
+        max_rss (int): The maximum resident set size, in kilobytes on Linux and
+                       bytes on macOS. For totals, the largest of these.
+        voluntary_switches (int): The number of voluntary context switches.
+        involuntary_switches (int): The number of involuntary context switches.
+        block_reads (int): The number of block input operations.
+        block_writes (int): The number of block output operations.
+    """
+
+    fields = ('user_time', 'system_time', 'max_rss', 'voluntary_switches',
+              'involuntary_switches', 'block_reads', 'block_writes')
+
+    def __init__(self, user_time=0.0, system_time=0.0, max_rss=0, voluntary_switches=0,
+                 involuntary_switches=0, block_reads=0, block_writes=0):
+        self.user_time = user_time
+        self.system_time = system_time
+        self.max_rss = max_rss
+        self.voluntary_switches = voluntary_switches
+        self.involuntary_switches = involuntary_switches
+        self.block_reads = block_reads
+        self.block_writes = block_writes
+
+    @classmethod
+    def from_rusage(cls, rusage):
+        """
+        Create an instance from a :class:`resource.struct_rusage`.
+        """
+        return cls(rusage.ru_utime, rusage.ru_stime, rusage.ru_maxrss, rusage.ru_nvcsw,
+                   rusage.ru_nivcsw, rusage.ru_inblock, rusage.ru_oublock)
+
+    @property
+    def cpu_time(self):
+        """
+        The total CPU time, in seconds.
+        """
+        return self.user_time + self.system_time
+
+    def __add__(self, other):
+        if not isinstance(other, ResourceUsage):
+            return NotImplemented
+        values = [getattr(self, k) + getattr(other, k) for k in self.fields]
+        values[2] = max(self.max_rss, other.max_rss)
+        return self.__class__(*values)
+
+    def __radd__(self, other):
+        # so that sum() works
+        if other == 0:
+            return self
+        return NotImplemented
+
+    def __eq__(self, other):
+        if not isinstance(other, ResourceUsage):
+            return NotImplemented
+        return all(getattr(self, k) == getattr(other, k) for k in self.fields)
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:  # pragma: no cover
+            return result
+        return not result
+
+    # Instances are mutable and compare by value, so they aren't hashable.
+    __hash__ = None
+
+    def __repr__(self):  # pragma: no cover
+        return '%s(%s)' % (self.__class__.__name__,
+                           ', '.join('%s=%r' % (k, getattr(self, k)) for k in self.fields))
+
+
+class Reaper(object):
+    """
+    This class notices when child processes exit, so that nothing needs to
+    poll them or block in a wait for each of them. On Linux, a pidfd is opened
+    for each registered child and added to an epoll set, which a single thread
+    waits on. When a child exits, its ``exited`` event is set and it is reaped,
+    if nothing else is already reaping it.
+
+    Where pidfds or epoll are unavailable, registering a child does nothing.
+    """
+
+    def __init__(self):
+        self.enabled = True
+        self.cond = threading.Condition()
+        self.exits = 0
+        self.pid = None
+        self.epoll = None
+        self.children = {}
+        self.pidfds = {}
+        self._available = None
+
+    @property
+    def available(self):
+        """
+        Whether children can be registered on this platform.
+        """
+        if self._available is None:
+            result = hasattr(os, 'pidfd_open') and hasattr(select, 'epoll')
+            if result:
+                try:
+                    os.close(os.pidfd_open(os.getpid()))
+                except OSError:  # pragma: no cover
+                    result = False  # not supported by the kernel
+            self._available = result
+        return self._available
+
+    def _start(self):
+        # Called with the condition's lock held. A forked child doesn't inherit
+        # the thread, so it needs its own.
+        if self.epoll is not None:
+            self.epoll.close()
+        self.epoll = select.epoll()
+        self.children = {}
+        self.pidfds = {}
+        self.pid = os.getpid()
+        t = threading.Thread(target=self._run, args=(self.epoll,), name='sarge-reaper')
+        t.daemon = True
+        t.start()
+
+    def register(self, process):
+        """
+        Register a child process to be reaped.
+
+        Args:
+            process (subprocess.Popen): The child process.
+
+        Returns:
+            threading.Event: An event which is set when the child exits, or
+                             ``None`` if the child couldn't be registered.
+        """
+        if not self.enabled or not self.available:
+            return None
+        try:
+            fd = os.pidfd_open(process.pid)
+        except OSError:  # pragma: no cover
+            return None  # already reaped
+        event = threading.Event()
+        with self.cond:
+            if self.pid != os.getpid():
+                self._start()
+            self.children[fd] = (process, event)
+            self.pidfds[process] = fd
+            self.epoll.register(fd, select.EPOLLIN)
+        return event
+
+    def send_signal(self, process, sig):
+        """
+        Send a signal to a registered child which hasn't yet exited, using its
+        pidfd. Unlike its pid, this can't refer to another process once the
+        child has been reaped.
+
+        Args:
+            process (subprocess.Popen): The child process.
+            sig (int): The signal to send.
+
+        Returns:
+            bool: Whether the signal was sent. If it wasn't, the child isn't
+                  registered, has exited or can't be signalled this way.
+        """
+        if not hasattr(signal, 'pidfd_send_signal'):
+            return False
+        with self.cond:
+            fd = self.pidfds.get(process)
+            if fd is None:
+                return False
+            try:
+                signal.pidfd_send_signal(fd, sig)
+            except OSError as e:
+                if e.errno != errno.ESRCH:  # pragma: no cover
+                    raise
+                return False
+        return True
+
+    def _run(self, epoll):
+        while True:
+            try:
+                ready = epoll.poll()
+            except (OSError, ValueError):  # pragma: no cover
+                break  # closed after a fork
+            with self.cond:
+                exited = []
+                for fd, _ in ready:
+                    epoll.unregister(fd)
+                    process, event = self.children.pop(fd)
+                    del self.pidfds[process]
+                    exited.append((process, event))
+                    os.close(fd)
+            for process, event in exited:
+                event.set()
+                # If another thread is waiting for the process, this doesn't
+                # block, and that thread reaps it.
+                process.poll()
+            with self.cond:
+                self.exits += len(exited)
+                self.cond.notify_all()
+
+    @property
+    def active(self):
+        """
+        The number of registered children which haven't yet exited.
+        """
+        return len(self.children)
+
+    def wait_for_exit(self, count, timeout=None):
+        """
+        Wait until a registered child exits.
+
+        Args:
+            count (int): The value of the ``exits`` attribute at the time the
+                         caller last looked for exited children. If it has
+                         changed since, this returns immediately.
+            timeout (float): The maximum time to wait, in seconds.
+
+        Returns:
+            int: The current value of the ``exits`` attribute.
+        """
+        with self.cond:
+            if self.exits == count:
+                self.cond.wait(timeout)
+            return self.exits
+
+
+reaper = Reaper()
+
+
 class Popen(subprocess.Popen):
     """
     This is a subclass of :class:`subprocess.Popen` which is there in case we
     need to provide specialised functionality for use in sarge. For example,
     we can't do >&2 redirection in subprocess.Popen, though we can do 2>&1
+
+    It also accepts a ``fast_spawn`` keyword argument, which defaults to the
+    module attribute ``default_fast_spawn``. If true, the child is spawned using
+    :func:`os.posix_spawn` whenever the other arguments allow it.
     """
 
+    fast_spawned = False
+    exited = None
+    rusage = None
+    end_time = None
+    exit_callbacks = None
+    exit_caller = None
+
+    def __init__(self, *args, **kwargs):
+        self.fast_spawn = kwargs.pop('fast_spawn', None)
+        if self.fast_spawn is None:
+            self.fast_spawn = default_fast_spawn
+        self.start_time = time.time()
+        super(Popen, self).__init__(*args, **kwargs)
+        self.exited = reaper.register(self)
+
+    if hasattr(os, 'wait4'):
+        # Reap using os.wait4() so that the child's resource usage is recorded.
+
+        def _wait4(self, pid, flags):
+            pid, sts, rusage = os.wait4(pid, flags)
+            if pid:
+                self.rusage = rusage
+                self.end_time = time.time()
+                if tracer is not None:
+                    # set the returncode now, so that it can be recorded
+                    self._handle_exitstatus(sts)
+                    tracer.exited(self)
+            return pid, sts
+
+        def _try_wait(self, wait_flags):
+            try:
+                return self._wait4(self.pid, wait_flags)
+            except OSError as e:
+                if e.errno != errno.ECHILD:  # pragma: no cover
+                    raise
+                # As for subprocess: the child is dead, but waiting for children
+                # has been disabled, so its status can't be got.
+                return self.pid, 0
+
+        def _internal_poll(self, *args, **kwargs):
+            kwargs['_waitpid'] = self._wait4
+            return super(Popen, self)._internal_poll(*args, **kwargs)
+
+    @property
+    def resource_usage(self):
+        """
+        The child's resource usage as a :class:`ResourceUsage`, or ``None`` if
+        it hasn't been reaped or the platform doesn't provide it.
+        """
+        if self.rusage is None:
+            return None
+        return ResourceUsage.from_rusage(self.rusage)
+
+    def poll(self):
+        # If the reaper is watching the child, there's no need for a system
+        # call until it has exited.
+        exited = self.exited
+        if exited is not None and not exited.is_set():
+            return self.returncode
+        result = super(Popen, self).poll()
+        if result is not None and self.exit_callbacks:
+            # The child is reaped with _waitpid_lock held, so exit callbacks
+            # are called here, once it has been released.
+            _call_exit_callbacks(self)
+        return result
+
+    def wait(self, timeout=None):
+        exited = self.exited
+        if exited is not None and self.returncode is None:
+            # Wait for the reaper rather than polling with sleeps, or blocking
+            # in waitpid() with the lock which stops others reaping the child
+            # held (see _signal_group()).
+            if not exited.wait(timeout):
+                raise _TimeoutExpired(self.args, timeout)
+            timeout = None
+        if timeout is None:
+            result = super(Popen, self).wait()
+        else:
+            result = super(Popen, self).wait(timeout)
+        # As for poll(), but if another thread is calling the exit callbacks,
+        # they're waited for too.
+        _call_exit_callbacks(self, True)
+        return result
+
     def _get_handles(self, stdin, stdout, stderr):
 
         def close(h):
@@ -648,6 +1339,90 @@ class Popen(subprocess.Popen):
             # preexec, rest),))
             super(Popen, self)._execute_child(args, executable, preexec, *rest)
 
+    if _CAN_FAST_SPAWN:
+
+        def _execute_child(self, *args):
+            if not (self.fast_spawn and self._fast_spawn(dict(zip(_EXECUTE_CHILD_PARAMS, args)))):
+                super(Popen, self)._execute_child(*args)
+
+        def _fast_spawn(self, params):
+            """
+            Try to spawn the child using os.posix_spawn(), which doesn't need to
+            copy the parent's page tables as fork() does. Return ``True`` if the
+            child was spawned, or ``False`` if the arguments need a fork-based
+            spawn (e.g. a ``preexec_fn`` or ``cwd`` was specified).
+
+            The handles passed in have already been set up by `_get_handles()`,
+            so the ``>&2`` and output swapping cases need no special treatment.
+            """
+            if (params['preexec_fn'] is not None or params['pass_fds']
+                    or params['cwd'] is not None or params.get('gid') is not None
+                    or params.get('gids') is not None or params.get('uid') is not None
+                    or params.get('umask', -1) >= 0):
+                return False
+            p2cread, p2cwrite = params['p2cread'], params['p2cwrite']
+            c2pread, c2pwrite = params['c2pread'], params['c2pwrite']
+            errread, errwrite = params['errread'], params['errwrite']
+            # A dup2() onto 0, 1 or 2 could clobber a source handle which is
+            # itself one of those.
+            for fd in (p2cread, c2pwrite, errwrite):
+                if 0 <= fd <= 2:
+                    return False
+            args, shell = params['args'], params['shell']
+            if isinstance(args, (str, bytes)):
+                args = [args]
+            elif isinstance(args, os.PathLike):
+                if shell:
+                    return False
+                args = [args]
+            else:
+                args = list(args)
+            executable = params['executable']
+            if shell:
+                args = ['/bin/sh', '-c'] + args
+                if executable:
+                    args[0] = executable
+            if executable is None:
+                executable = args[0]
+            if not isinstance(executable, str):
+                return False
+            env = params['env']
+            executable = _find_executable(executable, env)
+            if executable is None:
+                return False  # let the normal path report the error
+            to_close = []
+            if params['close_fds']:
+                to_close = _inheritable_fds()
+                if to_close is None:
+                    return False
+            kwargs = {}
+            if params['restore_signals']:
+                kwargs['setsigdef'] = [getattr(signal, name) for name in
+                                       ('SIGPIPE', 'SIGXFZ', 'SIGXFSZ') if hasattr(signal, name)]
+            if params['start_new_session']:
+                kwargs['setsid'] = True
+            if params.get('process_group', -1) != -1:
+                kwargs['setpgroup'] = params['process_group']
+            file_actions = []
+            for fd in (p2cwrite, c2pread, errread):
+                if fd != -1:
+                    file_actions.append((os.POSIX_SPAWN_CLOSE, fd))
+            for fd, fd2 in ((p2cread, 0), (c2pwrite, 1), (errwrite, 2)):
+                if fd != -1:
+                    file_actions.append((os.POSIX_SPAWN_DUP2, fd, fd2))
+            for fd in to_close:
+                file_actions.append((os.POSIX_SPAWN_CLOSE, fd))
+            if file_actions:
+                kwargs['file_actions'] = file_actions
+            sys.audit('subprocess.Popen', executable, args, None, env)
+            if env is None:
+                env = os.environ
+            self.pid = os.posix_spawn(executable, args, env, **kwargs)
+            self._child_created = True
+            self.fast_spawned = True
+            self._close_pipe_fds(p2cread, p2cwrite, c2pread, c2pwrite, errread, errwrite)
+            return True
+
     def __repr__(self):  # pragma: no cover
         values = []
         for attr in ('returncode', 'stdin', 'stdout', 'stderr'):
@@ -655,80 +1430,1511 @@ class Popen(subprocess.Popen):
         return '%s(%s)' % (self.__class__.__name__, ' '.join(values))
 
 
-def copier(src, dest):
-    shutil.copyfileobj(src, dest)
-    dest.close()
-
-
-class Command(object):
+class EnvironmentCache(object):
     """
-    This class represents a shell command to be run in a subprocess.
+    This class caches the results of merging environment overlays into
+    ``os.environ``, so that commands which are created with the same overlay
+    don't each decode and merge the whole environment: each gets its own copy
+    of a cached dict, which is much cheaper to make. The cache is invalidated
+    whenever ``os.environ`` changes.
 
     Args:
-        args (str|list[str]):   The command string or array or command/args to be run.
-
-        kwargs (dict): The same as you would pass to `subprocess.Popen`.
-                       However, the ``env`` parameter is handled differently: it
-                       is treated as a set of *additional* environment variables
-                       to be added to the values in ``os.environ``, unless the
-                       ``replace_env`` keyword argument is present and truthy, in
-                       which case the env value is used *in place of*
-                       ``os.environ``.
-
-    .. versionadded:: 0.1.6
-       The ``replace_env`` keyword argument was added.
+        maxsize (int): The maximum number of merged environments to keep. If
+                       zero, nothing is cached.
     """
 
-    def __init__(self, args, **kwargs):
-        replace_env = kwargs.pop('replace_env', False)
-        shell = kwargs.get('shell')
-        if not shell and isinstance(args, string_types):
-            args = list(shell_shlex(args, control='();>|&'))
-        self.args = args
-        self.kwargs = kwargs
-        # check for input specified
-        if kwargs.get('stdin'):
-            raise ValueError('Inputs need to be specified via the run method.')
-        # special handling of Capture instances in stdout, stderr
-        for attr in ('stdout', 'stderr'):
-            s = kwargs.get(attr)
-            if isinstance(s, Capture):
-                kwargs[attr] = subprocess.PIPE
-                setattr(self, attr, s)
-        # special handling: env is added to os.environ
-        e = kwargs.get('env')
-        if e:
-            if replace_env:
-                env = e
-            else:
-                env = dict(os.environ)
-                env.update(e)
-            kwargs['env'] = env
-        self.process_ready = threading.Event()
-        self.process = None
-        self.exception = None
-        logger.debug('%r created', self)
+    def __init__(self, maxsize=32):
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.snapshot = None
+        self.entries = OrderedDict()
 
-    def __repr__(self):  # pragma: no cover
-        if isinstance(self.args, basestring):
-            s = self.args
-        else:
-            s = ' '.join(self.args)
-        return '%s(%r)' % (self.__class__.__name__, s)
+    def clear(self):
+        """
+        Discard all cached environments.
+        """
+        with self.lock:
+            self.snapshot = None
+            self.entries.clear()
 
-    def run(self, input=None, async_=False):
+    def merged(self, overlay):
         """
-        Run the command with optional input and either synchronously or
-        asynchronously.
+        Get ``os.environ`` updated with an overlay.
 
         Args:
-            input (str|bytes|file): The input to pass to the command subprocess.
-                                        If this is text, it is encoded to bytes using UTF-8.
-                                        If it is a byte string, it is used as is. Otherwise, a
-                                        file-like object containing bytes should be passed: this
-                                        will be read to the end, but not closed.
-            async_ (bool): If ``True``, this method returns without waiting for the
-                           subprocess to complete. Otherwise, it awaits completion
+            overlay (dict): The environment variables to add.
+
+        Returns:
+            dict: The merged environment, which the caller can modify.
+        """
+        # The underlying data of os.environ is compared with a snapshot to see
+        # if the cache is stale. That's much cheaper than dict(os.environ), as
+        # it happens in C and doesn't need to decode anything.
+        data = getattr(os.environ, '_data', None)
+        if data is None:  # pragma: no cover
+            data = getattr(os.environ, 'data', None)
+        try:
+            key = frozenset(overlay.items())
+        except TypeError:  # pragma: no cover
+            key = None
+        if key is None or data is None or self.maxsize <= 0:
+            result = dict(os.environ)
+            result.update(overlay)
+            return result
+        with self.lock:
+            if self.snapshot != data:
+                self.entries.clear()
+                self.snapshot = dict(data)
+            result = self.entries.pop(key, None)
+            if result is None:
+                result = dict(os.environ)
+                result.update(overlay)
+                while len(self.entries) >= self.maxsize:
+                    self.entries.popitem(last=False)
+            self.entries[key] = result  # now the most recently used
+        return dict(result)  # the cached dict is never handed out
+
+
+env_cache = EnvironmentCache()
+
+
+class ParseCache(object):
+    """
+    This class caches the trees parsed from command lines, so that a command
+    line which is run repeatedly is only parsed once. The trees are shared,
+    so they mustn't be modified: the state of a run is kept in the
+    :class:`Pipeline` which runs a tree, not in the tree.
+
+    Args:
+        maxsize (int): The maximum number of trees to keep. The least recently
+                       used are discarded. If zero, nothing is cached.
+    """
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self):
+        """
+        Discard all cached trees, and reset the counts of hits and misses.
+        """
+        with self.lock:
+            self.entries.clear()
+            self.hits = self.misses = 0
+
+    @property
+    def hit_rate(self):
+        """
+        The proportion of lookups which found a tree, or ``None`` if there
+        haven't been any.
+        """
+        lookups = self.hits + self.misses
+        return self.hits / float(lookups) if lookups else None
+
+    def _key(self, source, posix):
+        if sys.platform == 'win32':  # pragma: no cover
+            # Commands are looked up on the path when parsing on Windows (see
+            # CommandLineParser.parse_command), so trees depend on the path and
+            # on the current directory, which is searched first.
+            return source, posix, os.environ.get('PATH'), os.getcwd()
+        return source, posix
+
+    def get(self, source, posix):
+        """
+        Look up the tree for a command line.
+
+        Args:
+            source (str): The command line.
+            posix (bool): Whether POSIX conventions are used in the lexer.
+
+        Returns:
+            Node|None: The tree, or ``None`` if it isn't in the cache.
+        """
+        if self.maxsize <= 0:
+            return None
+        key = self._key(source, posix)
+        with self.lock:
+            result = self.entries.pop(key, None)
+            if result is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries[key] = result  # now the most recently used
+        return result
+
+    def put(self, source, posix, tree):
+        """
+        Cache the tree for a command line.
+
+        Args:
+            source (str): The command line.
+            posix (bool): Whether POSIX conventions are used in the lexer.
+            tree (Node): The tree parsed from it.
+        """
+        if self.maxsize <= 0:
+            return
+        with self.lock:
+            self.entries[self._key(source, posix)] = tree
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+
+parse_cache = ParseCache()
+
+
+class _CachedProcess(object):
+    """
+    This stands in for the process of a command whose result came from a
+    :class:`ResultCache`.
+    """
+
+    pid = None
+    stdin = stdout = stderr = None
+    resource_usage = start_time = end_time = None
+
+    def __init__(self, returncode):
+        self.returncode = returncode
+
+    def poll(self):
+        return self.returncode
+
+    def wait(self, timeout=None):
+        return self.returncode
+
+
+class ResultCache(object):
+    """
+    This class caches the results of running deterministic commands: their
+    return codes and captured output. Results are kept in memory, and also
+    written to a directory if one is specified, so that they can be shared
+    between processes and survive restarts.
+
+    A result is looked up using a digest of the command line, the keyword
+    arguments, the working directory, the input, any environment variables
+    named by the caller and the sizes and modification times of any files
+    named by the caller.
+
+    Args:
+        maxsize (int): The maximum number of results to keep in memory.
+        directory (str): A directory to store results in, or ``None``.
+        max_bytes (int): The maximum total size of the results in
+                         ``directory``. The least recently used results are
+                         deleted when this is exceeded.
+    """
+
+    def __init__(self, maxsize=256, directory=None, max_bytes=64 * 1024 * 1024):
+        self.maxsize = maxsize
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.disk_bytes = None  # worked out when first needed
+        self.hits = self.misses = self.disk_hits = self.evictions = 0
+
+    def clear(self):
+        """
+        Discard all cached results, including those in the directory.
+        """
+        with self.lock:
+            self.entries.clear()
+            if self.directory and os.path.isdir(self.directory):
+                for fn in os.listdir(self.directory):
+                    if fn.endswith('.result'):
+                        os.remove(os.path.join(self.directory, fn))
+            self.disk_bytes = None
+
+    def key(self, cmd, input=None, kwargs=None, env_names=(), files=()):
+        """
+        Compute the key for running a command.
+
+        Args:
+            cmd (str|list[str]): The command line.
+            input (str|bytes): The input to the command.
+            kwargs (dict): The keyword arguments for running the command.
+            env_names (list[str]): The names of environment variables whose
+                                   values affect the command's result.
+            files (list[str]): The paths of files whose contents affect the
+                               command's result.
+
+        Returns:
+            str|None: The key, or ``None`` if the result can't be cached
+                      (because the input is a stream, or output is sent
+                      somewhere other than a :class:`Capture`).
+        """
+        kwargs = kwargs or {}
+        if isinstance(input, text_type):
+            input = input.encode('utf-8')
+        if input is not None and not isinstance(input, bytes):
+            return None
+        parts = [cmd, hashlib.sha256(input).hexdigest() if input is not None else None,
+                 os.path.abspath(kwargs.get('cwd') or os.curdir)]
+        env = kwargs.get('env') or {}
+        for k, v in sorted(kwargs.items()):
+            if k in ('stdout', 'stderr'):
+                if isinstance(v, Capture):
+                    v = 'capture'
+                elif v not in (None, STDERR, subprocess.STDOUT):
+                    return None
+            elif k in ('cwd', 'env') or callable(v):
+                continue
+            parts.append((k, v))
+        parts.append(sorted(env.items()))
+        if not kwargs.get('replace_env'):
+            parts.append([(n, os.environ.get(n)) for n in sorted(env_names) if n not in env])
+        for fn in files:
+            try:
+                st = os.stat(fn)
+                parts.append((fn, st.st_size, getattr(st, 'st_mtime_ns', st.st_mtime)))
+            except OSError:
+                parts.append((fn, None))
+        return hashlib.sha256(repr(parts).encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """
+        Get a cached result.
+
+        Args:
+            key (str): The key for the result, from :meth:`key`.
+
+        Returns:
+            tuple|None: The command arguments, return codes, ``stdout`` bytes
+                        and ``stderr`` bytes of the result, or ``None`` if
+                        there's no cached result.
+        """
+        with self.lock:
+            result = self.entries.pop(key, None)
+            if result is not None:
+                self.entries[key] = result  # now the most recently used
+                self.hits += 1
+                return result
+        if self.directory:
+            result = self._load(key)
+            if result is not None:
+                with self.lock:
+                    self.hits += 1
+                    self.disk_hits += 1
+                    self._remember(key, result)
+                return result
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, result):
+        """
+        Cache a result.
+
+        Args:
+            key (str): The key for the result, from :meth:`key`.
+            result (tuple): The command arguments, return codes, ``stdout``
+                            bytes and ``stderr`` bytes of the result.
+        """
+        with self.lock:
+            self._remember(key, result)
+        if self.directory:
+            self._save(key, result)
+
+    def _remember(self, key, result):
+        self.entries.pop(key, None)
+        self.entries[key] = result
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def _path(self, key):
+        return os.path.join(self.directory, '%s.result' % key)
+
+    def _load(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                header = json.loads(f.readline().decode('utf-8'))
+                data = f.read()
+            os.utime(path, None)  # for least-recently-used eviction
+        except (IOError, OSError, ValueError):
+            return None
+        nout = header['stdout']
+        stdout = None if nout is None else data[:nout]
+        stderr = None if header['stderr'] is None else data[nout or 0:]
+        return header['args'], header['returncodes'], stdout, stderr
+
+    def _save(self, key, result):
+        args, returncodes, stdout, stderr = result
+        header = {'args': args, 'returncodes': returncodes,
+                  'stdout': None if stdout is None else len(stdout),
+                  'stderr': None if stderr is None else len(stderr)}
+        data = json.dumps(header).encode('utf-8') + b'\n' + (stdout or b'') + (stderr or b'')
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        path = self._path(key)
+        # Write to a temporary file and rename it, so that readers never see
+        # a partly written result.
+        tmp = '%s.%d.%d.tmp' % (path, os.getpid(), threading.current_thread().ident)
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        if os.name == 'nt':  # pragma: no cover
+            if os.path.exists(path):
+                os.remove(path)
+        os.rename(tmp, path)
+        with self.lock:
+            if self.disk_bytes is None:
+                self.disk_bytes = sum(size for size, mtime, fn in self._disk_entries())
+            else:
+                self.disk_bytes += len(data)
+            if self.disk_bytes > self.max_bytes:
+                self._evict()
+
+    def _disk_entries(self):
+        result = []
+        for fn in os.listdir(self.directory):
+            if fn.endswith('.result'):
+                fn = os.path.join(self.directory, fn)
+                try:
+                    st = os.stat(fn)
+                except OSError:
+                    continue  # removed by another process
+                result.append((st.st_size, st.st_mtime, fn))
+        return result
+
+    def _evict(self):
+        # Delete the least recently used results until comfortably under the limit
+        entries = self._disk_entries()
+        entries.sort(key=lambda e: e[1])
+        total = sum(e[0] for e in entries)
+        target = self.max_bytes * 3 // 4
+        for size, mtime, fn in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(fn)
+            except OSError:
+                pass
+            total -= size
+            self.evictions += 1
+        self.disk_bytes = total
+
+
+result_cache = ResultCache()
+
+
+def _file_digest(path):
+    """
+    Return the SHA-256 digest of a file's contents, as hex.
+    """
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(65536)
+            if not data:
+                break
+            h.update(data)
+    return h.hexdigest()
+
+
+class StageState(object):
+    """
+    This class records the stages of incremental pipelines which have been
+    run, so that stages whose outputs are up to date with respect to their
+    inputs can be skipped when a pipeline is run again. A stage is a command
+    whose output is redirected to files with ``>``. The state is kept in a
+    JSON file.
+
+    A stage is up to date if its outputs all exist and either:
+
+    * it has been run before with the same command line, and its inputs and
+      outputs are unchanged since then -- a file whose size or modification
+      time has changed still counts as unchanged if its contents hash the
+      same -- or
+    * it hasn't been run before, but all its inputs exist and are older than
+      all its outputs, as with ``make``.
+
+    Args:
+        path (str): The path of the file to keep the state in.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        try:
+            with open(path) as f:
+                self.stages = json.load(f)
+        except (IOError, OSError, ValueError):
+            self.stages = {}
+
+    def save(self):
+        """
+        Save the state to its file.
+        """
+        with self.lock:
+            tmp = '%s.%d.tmp' % (self.path, os.getpid())
+            with open(tmp, 'w') as f:
+                json.dump(self.stages, f, indent=1, sort_keys=True)
+            if os.name == 'nt':  # pragma: no cover
+                if os.path.exists(self.path):
+                    os.remove(self.path)
+            os.rename(tmp, self.path)
+
+    def key(self, args, outputs):
+        """
+        Compute the key for a stage.
+
+        Args:
+            args (list[str]): The stage's command line.
+            outputs (list[str]): The absolute paths of the stage's outputs.
+
+        Returns:
+            str: The key.
+        """
+        return hashlib.sha256(repr([list(args), sorted(outputs)]).encode('utf-8')).hexdigest()
+
+    def _unchanged(self, path, recorded):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return False
+        size, mtime, digest = recorded
+        if st.st_size == size and getattr(st, 'st_mtime_ns', st.st_mtime) == mtime:
+            return True
+        return st.st_size == size and _file_digest(path) == digest
+
+    def up_to_date(self, key, inputs, outputs):
+        """
+        See if a stage is up to date.
+
+        Args:
+            key (str): The key for the stage, from :meth:`key`.
+            inputs (list[str]): The absolute paths of the stage's inputs.
+            outputs (list[str]): The absolute paths of the stage's outputs.
+
+        Returns:
+            bool: ``True`` if the stage can be skipped, else ``False``.
+        """
+        if not all(os.path.exists(p) for p in outputs):
+            return False
+        with self.lock:
+            record = self.stages.get(key)
+        if record is not None:
+            if sorted(record['inputs']) != sorted(inputs):
+                return False
+            for kind in ('inputs', 'outputs'):
+                for path, recorded in record[kind].items():
+                    if not self._unchanged(path, recorded):
+                        return False
+            return True
+        if not inputs or not all(os.path.exists(p) for p in inputs):
+            return False
+        newest = max(os.path.getmtime(p) for p in inputs)
+        return newest <= min(os.path.getmtime(p) for p in outputs)
+
+    def record(self, key, args, inputs, outputs):
+        """
+        Record that a stage has been run successfully.
+
+        Args:
+            key (str): The key for the stage, from :meth:`key`.
+            args (list[str]): The stage's command line.
+            inputs (list[str]): The absolute paths of the stage's inputs.
+            outputs (list[str]): The absolute paths of the stage's outputs.
+        """
+        record = {'args': list(args), 'inputs': {}, 'outputs': {}}
+        for kind, paths in (('inputs', inputs), ('outputs', outputs)):
+            for path in paths:
+                try:
+                    st = os.stat(path)
+                    record[kind][path] = (st.st_size, getattr(st, 'st_mtime_ns', st.st_mtime),
+                                          _file_digest(path))
+                except (IOError, OSError):
+                    return  # it's gone, so the stage can't be skipped next time
+        with self.lock:
+            self.stages[key] = record
+
+
+class LatencyHistogram(object):
+    """
+    This class keeps the durations of the most recent successful runs of
+    commands, per command signature, from which percentiles can be computed.
+    It's used by :func:`run_hedged` to decide when to start another copy of a
+    command which is taking longer than usual.
+
+    Args:
+        window (int): The number of durations to keep for each signature.
+    """
+
+    def __init__(self, window=100):
+        self.window = window
+        self.lock = threading.Lock()
+        self.samples = {}
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def clear(self):
+        """
+        Discard all the durations and counts.
+        """
+        with self.lock:
+            self.samples.clear()
+            self.hedges = self.hedge_wins = 0
+
+    def signature(self, cmd, cwd=None):
+        """
+        Compute the signature of a command, under which its durations are kept.
+
+        Args:
+            cmd (str|list[str]): The command string or array of command/args.
+            cwd (str): The working directory for the command.
+
+        Returns:
+            tuple: The signature.
+        """
+        if not isinstance(cmd, string_types):
+            cmd = tuple(cmd)
+        return cmd, cwd
+
+    def record(self, signature, duration):
+        """
+        Record the duration of a successful run of a command.
+
+        Args:
+            signature (tuple): The command's signature, from :meth:`signature`.
+            duration (float): How long the command took, in seconds.
+        """
+        with self.lock:
+            samples = self.samples.get(signature)
+            if samples is None:
+                samples = self.samples[signature] = deque(maxlen=self.window)
+            samples.append(duration)
+
+    def count(self, signature):
+        """
+        Return the number of durations kept for a command signature.
+        """
+        with self.lock:
+            return len(self.samples.get(signature, ()))
+
+    def percentile(self, signature, pct=95, min_samples=10):
+        """
+        Return a percentile of the durations of a command.
+
+        Args:
+            signature (tuple): The command's signature, from :meth:`signature`.
+            pct (float): The percentile to compute, from 0 to 100.
+            min_samples (int): The number of durations needed for a result.
+
+        Returns:
+            float|None: The percentile, in seconds, or ``None`` if there are
+                        fewer than ``min_samples`` durations.
+        """
+        with self.lock:
+            samples = sorted(self.samples.get(signature, ()))
+        if not samples or len(samples) < min_samples:
+            return None
+        # nearest-rank method
+        rank = int(math.ceil(pct / 100.0 * len(samples)))
+        return samples[max(rank, 1) - 1]
+
+
+latency_histogram = LatencyHistogram()
+
+
+class NodeExecutor(object):
+    """
+    This class runs the parts of pipelines which need to run concurrently with
+    their callers (asynchronously run pipelines and the ``&`` parts of command
+    lines) on a process-wide pool of worker threads, which are reused rather than
+    created and destroyed for each part.
+
+    At most ``max_workers`` workers run parts submitted from outside the pool;
+    other such parts are queued. Two cases are handled specially, as they could
+    otherwise deadlock:
+
+    * Parts submitted from a worker (such as the ``&`` parts of an
+      asynchronously run list) are never queued behind other work: if no worker
+      is idle, an extra one is started, so they run concurrently with the part
+      which submitted them, as a shell would run them.
+
+    * A worker which is waiting for a child process or for parts of a pipeline
+      to complete doesn't count towards ``max_workers`` while it waits, so queued
+      parts (which the wait might depend on) can still be started.
+
+    Args:
+        max_workers (int): The maximum number of workers which can be running
+                           (rather than waiting) at any time.
+        idle_timeout (float): How long, in seconds, an idle worker waits for work
+                              before exiting.
+    """
+
+    def __init__(self, max_workers=32, idle_timeout=60.0):
+        self.max_workers = max_workers
+        self.idle_timeout = idle_timeout
+        self.cond = threading.Condition()
+        self.queue = deque()
+        self.local = threading.local()
+        self.threads = 0
+        self.idle = 0
+        self.waiting = 0
+        self.threads_created = 0
+        self.overflow_threads = 0
+
+    @property
+    def queue_depth(self):
+        """
+        The number of submitted parts waiting for a worker.
+        """
+        return len(self.queue)
+
+    @property
+    def active_workers(self):
+        """
+        The number of workers running a submitted part, including any which are
+        waiting for child processes.
+        """
+        return self.threads - self.idle
+
+    @property
+    def waiting_workers(self):
+        """
+        The number of workers waiting for child processes or pipeline parts.
+        """
+        return self.waiting
+
+    def in_worker(self):
+        """
+        Return whether the current thread is one of this executor's workers.
+        """
+        return getattr(self.local, 'worker', False)
+
+    def submit(self, func, *args):
+        """
+        Arrange for a callable to be run by a worker. Exceptions raised by it are
+        logged.
+
+        Args:
+            func (callable): The callable to run.
+            args (tuple): The positional arguments to call it with.
+        """
+        nested = self.in_worker()
+        with self.cond:
+            self.queue.append((func, args))
+            if self.idle >= len(self.queue):
+                self.cond.notify()
+            elif nested:
+                self.overflow_threads += 1
+                self._start_worker()
+            elif self.threads - self.idle - self.waiting < self.max_workers:
+                self._start_worker()
+
+    def _start_worker(self):
+        # Called with the condition's lock held
+        self.threads += 1
+        self.threads_created += 1
+        t = threading.Thread(target=self._work, name='sarge-worker-%d' % self.threads_created)
+        t.daemon = True
+        t.start()
+
+    def _work(self):
+        self.local.worker = True
+        cond = self.cond
+        cond.acquire()
+        try:
+            while True:
+                start = time.time()
+                while not self.queue:
+                    remaining = self.idle_timeout - (time.time() - start)
+                    if remaining <= 0:
+                        self.threads -= 1
+                        return
+                    self.idle += 1
+                    try:
+                        cond.wait(remaining)
+                    finally:
+                        self.idle -= 1
+                func, args = self.queue.popleft()
+                cond.release()
+                try:
+                    func(*args)
+                except Exception as e:
+                    logger.exception('Failed in worker: %s', e)
+                finally:
+                    cond.acquire()
+        finally:
+            cond.release()
+
+    def begin_wait(self):
+        """
+        Note that the current thread is about to wait for something which
+        queued work might be needed for. Call :meth:`end_wait` after waiting.
+        Both do nothing if not called from a worker.
+        """
+        if self.in_worker():
+            with self.cond:
+                self.waiting += 1
+                if (self.queue and self.idle < len(self.queue)
+                        and self.threads - self.idle - self.waiting < self.max_workers):
+                    self._start_worker()
+
+    def end_wait(self):
+        """
+        Note that the current thread has finished waiting.
+        """
+        if self.in_worker():
+            with self.cond:
+                self.waiting -= 1
+
+
+node_executor = NodeExecutor()
+
+
+def _process_rss(pid):
+    """
+    Return the resident set size of a process in bytes, or 0 if it can't be
+    found.
+    """
+    try:
+        with open('/proc/%d/statm' % pid) as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, IndexError):
+        return 0
+
+
+class SpawnLimiter(object):
+    """
+    This class limits the rate at which child processes are spawned, using a
+    token bucket, and the number of them running at once. The concurrency
+    limit is adjusted in the manner of TCP congestion control (additive
+    increase, multiplicative decrease): it's cut when the host is overloaded,
+    as judged by the load average, the number of runnable tasks or the memory
+    used by the children, and raised by one otherwise.
+
+    The commands of a pipeline share one concurrency slot, which is held until
+    they've all exited, so that a pipeline can't be starved of the later
+    commands which read the output of its earlier ones.
+
+    Args:
+        rate (float): The number of spawns allowed per second, or ``None``
+                      for no limit.
+        burst (int): The number of spawns allowed in a burst. Defaults to
+                     ``rate``, or 1 if that's less.
+        max_concurrency (int): The maximum number of commands or pipelines
+                               with children running, or ``None`` for no
+                               limit.
+        min_concurrency (int): The lowest the concurrency limit is cut to.
+        target_load (float): The 1-minute load average per CPU above which
+                             the host is regarded as overloaded.
+        target_runnable (float): The number of runnable tasks per CPU above
+                                 which the host is regarded as overloaded.
+        max_child_rss (int): The total resident set size, in bytes, of the
+                             running children above which the host is
+                             regarded as overloaded.
+        adjust_interval (float): How often, in seconds, the concurrency limit
+                                 is adjusted.
+        timeout (float): How long a spawn can wait before it's rejected, or
+                         ``None`` to wait indefinitely.
+        max_queue (int): The number of spawns which can wait at once before
+                         further ones are rejected, or ``None`` for no limit.
+    """
+
+    decrease = 0.5
+
+    def __init__(self, rate=None, burst=None, max_concurrency=None, min_concurrency=1,
+                 target_load=None, target_runnable=None, max_child_rss=None,
+                 adjust_interval=1.0, timeout=None, max_queue=None):
+        if rate is not None and rate <= 0:
+            raise ValueError('rate must be positive')
+        if max_concurrency is not None and max_concurrency < min_concurrency:
+            raise ValueError('max_concurrency must be at least min_concurrency')
+        self.rate = rate
+        self.burst = burst or max(1, rate or 1)
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.limit = max_concurrency
+        self.target_load = target_load
+        self.target_runnable = target_runnable
+        self.max_child_rss = max_child_rss
+        self.adjust_interval = adjust_interval
+        self.timeout = timeout
+        self.max_queue = max_queue
+        self.cond = threading.Condition()
+        self.tokens = float(self.burst)
+        self.last_refill = self.last_adjust = _clock()
+        # owner -> [spawns in progress, running processes]
+        self.holders = {}
+        # callables from try_acquire(), to call when a slot is freed
+        self.waiters = []
+        self.spawns = 0
+        self.rejections = 0
+        self.waiting = 0
+        self.queue_delay = 0.0
+        self.max_queue_delay = 0.0
+        self.decreases = 0
+
+    @property
+    def running(self):
+        """
+        The number of concurrency slots in use.
+        """
+        with self.cond:
+            return len(self.holders)
+
+    @property
+    def mean_queue_delay(self):
+        """
+        The mean time, in seconds, which spawns have waited.
+        """
+        return self.queue_delay / self.spawns if self.spawns else 0.0
+
+    def _release(self, owner):
+        # Called with the condition's lock held. Free the owner's slot if
+        # nothing is being spawned for it and its children have all exited.
+        holder = self.holders.get(owner)
+        if holder is not None and not holder[0] and not holder[1]:
+            del self.holders[owner]
+            self.cond.notify_all()
+            waiters, self.waiters = self.waiters, []
+            for waiter in waiters:
+                waiter()
+
+    def _refill(self, now):
+        if self.rate is not None:
+            self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def overloaded(self):
+        """
+        See if the host is overloaded, according to the configured targets.
+        Override this to use other signals.
+
+        Returns:
+            bool: ``True`` if the host is overloaded, else ``False``.
+        """
+        cpus = cpu_count()
+        if self.target_load is not None and hasattr(os, 'getloadavg'):
+            if os.getloadavg()[0] / cpus > self.target_load:
+                return True
+        if self.target_runnable is not None:
+            try:
+                with open('/proc/loadavg') as f:
+                    runnable = int(f.read().split()[3].split('/')[0])
+            except (IOError, OSError, ValueError, IndexError):
+                runnable = None
+            # discount the caller, which is running
+            if runnable is not None and (runnable - 1) / float(cpus) > self.target_runnable:
+                return True
+        if self.max_child_rss is not None:
+            rss = sum(_process_rss(p.pid) for starting, processes in self.holders.values()
+                      for p in processes if p.pid is not None)
+            if rss > self.max_child_rss:
+                return True
+        return False
+
+    def _adjust(self, now):
+        # Called with the condition's lock held.
+        if self.limit is None or now - self.last_adjust < self.adjust_interval:
+            return
+        self.last_adjust = now
+        if self.overloaded():
+            limit = max(self.min_concurrency, int(self.limit * self.decrease))
+            if limit < self.limit:
+                logger.debug('spawn concurrency limit cut to %d', limit)
+                self.decreases += 1
+            self.limit = limit
+        elif self.limit < self.max_concurrency:
+            self.limit += 1
+
+    def acquire(self, owner, timeout=None):
+        """
+        Wait until a child process can be spawned for an owner, which is a
+        :class:`Command` or :class:`Pipeline`. Each successful call must be
+        followed by a call to :meth:`started` or :meth:`failed`.
+
+        Args:
+            owner (object): What the child is being spawned for.
+            timeout (float): How long to wait before rejecting the spawn. If
+                             not specified, the ``timeout`` attribute is used.
+
+        Raises:
+            ValueError: If the spawn is rejected.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        start = _clock()
+        deadline = None if timeout is None else start + timeout
+        with self.cond:
+            if self.max_queue is not None and self.waiting >= self.max_queue:
+                self.rejections += 1
+                raise ValueError('Spawn rejected: too many spawns waiting')
+            self.waiting += 1
+            try:
+                while True:
+                    now = _clock()
+                    acquired, wait = self._take(owner, now, now - start)
+                    if acquired:
+                        break
+                    if deadline is not None:
+                        left = deadline - now
+                        if left <= 0:
+                            self.rejections += 1
+                            raise ValueError('Spawn rejected: timed out after %s seconds'
+                                             % timeout)
+                        wait = left if wait is None else min(wait, left)
+                    self.cond.wait(wait)
+            finally:
+                self.waiting -= 1
+
+    def try_acquire(self, owner, waited=0.0, waiter=None):
+        """
+        Acquire what's needed to spawn a child process for an owner if that can
+        be done without waiting. This is for callers which mustn't block, such
+        as coroutines: they try again when told to. Each successful call must be
+        followed by a call to :meth:`started` or :meth:`failed`.
+
+        Args:
+            owner (object): What the child is being spawned for.
+            waited (float): How long, in seconds, the caller has been trying to
+                            spawn this child. It's checked against the
+                            ``timeout`` attribute and recorded as the spawn's
+                            queueing delay.
+            waiter (callable): If the spawn must wait for a concurrency slot,
+                               this is called once, with no arguments, when
+                               one is freed. It's called from the thread which
+                               frees the slot, with the limiter's lock held,
+                               so it should just wake the caller.
+
+        Returns:
+            tuple: ``(True, None)`` if the child can be spawned. Otherwise,
+                   ``(False, wait)``, where ``wait`` is how long to wait before
+                   trying again, or ``None`` to wait for ``waiter`` to be
+                   called.
+
+        Raises:
+            ValueError: If the spawn is rejected.
+        """
+        timeout = self.timeout
+        with self.cond:
+            acquired, wait = self._take(owner, _clock(), waited)
+            if acquired:
+                return acquired, wait
+            if timeout is not None:
+                left = timeout - waited
+                if left <= 0:
+                    self.rejections += 1
+                    raise ValueError('Spawn rejected: timed out after %s seconds' % timeout)
+                wait = left if wait is None else min(wait, left)
+            if waiter is not None:
+                self.waiters.append(waiter)
+            return acquired, wait
+
+    def _take(self, owner, now, waited):
+        # Called with the condition's lock held. Take a concurrency slot and a
+        # token for the owner if they're available, and return (True, None).
+        # Otherwise, return (False, wait), where wait is how long until they
+        # might be, or None if that's when a slot is freed.
+        self._refill(now)
+        self._adjust(now)
+        slot = (owner in self.holders or self.limit is None
+                or len(self.holders) < self.limit)
+        if not slot:
+            if self.limit < self.max_concurrency:
+                # We're notified when a slot is freed, but the limit could
+                # also be raised when it's next adjusted.
+                return False, max(self.last_adjust + self.adjust_interval - now, 0.001)
+            return False, None  # until a slot is freed
+        if self.tokens < 1:
+            return False, (1 - self.tokens) / self.rate
+        if self.rate is not None:
+            self.tokens -= 1
+        holder = self.holders.setdefault(owner, [0, []])
+        holder[0] += 1
+        self.spawns += 1
+        self.queue_delay += waited
+        self.max_queue_delay = max(self.max_queue_delay, waited)
+        return True, None
+
+    def started(self, owner, process):
+        """
+        Note that a child process has been spawned for an owner. For a
+        :class:`Popen` or :class:`~sarge.spawnserver.RemoteProcess`, the
+        owner's slot is freed when the process has exited (as noticed by
+        whichever thread reaps it, such as the reaper's). For other processes,
+        the caller must call :meth:`exited` when it has.
+
+        Args:
+            owner (object): What the child was spawned for.
+            process (subprocess.Popen): The child process.
+        """
+        with self.cond:
+            holder = self.holders[owner]
+            holder[0] -= 1
+            holder[1].append(process)
+        if hasattr(process, 'exit_callbacks'):
+            _on_exit(process, functools.partial(self.exited, owner))
+
+    def exited(self, owner, process):
+        """
+        Note that a child process spawned for an owner has exited.
+
+        Args:
+            owner (object): What the child was spawned for.
+            process (subprocess.Popen): The child process.
+        """
+        with self.cond:
+            holder = self.holders.get(owner)
+            if holder is not None and process in holder[1]:
+                holder[1].remove(process)
+                self._release(owner)
+
+    def failed(self, owner):
+        """
+        Note that spawning a child process for an owner failed.
+
+        Args:
+            owner (object): What the child was to be spawned for.
+        """
+        with self.cond:
+            self.holders[owner][0] -= 1
+            self._release(owner)
+
+
+# A SpawnLimiter which all commands' children are spawned through, unless
+# overridden using the ``spawn_limiter`` keyword argument to Command.
+default_spawn_limiter = None
+
+
+def copier(src, dest):
+    shutil.copyfileobj(src, dest)
+    dest.close()
+
+
+_clock = getattr(time, 'monotonic', time.time)
+
+
+def _remaining(deadline):
+    """
+    Return the time left until a deadline, or ``None`` if there isn't one.
+    """
+    if deadline is None:
+        return None
+    return max(0, deadline - _clock())
+
+
+def _wait_processes(processes, deadline=None):
+    """
+    Wait until processes have terminated or a deadline is reached.
+
+    Processes registered with the reaper are waited for using their ``exited``
+    events. Others are, on Linux, all waited for at once with a single poll()
+    call on their pidfds. Elsewhere, each process is waited for in turn with the
+    time remaining until the deadline.
+
+    Args:
+        processes (list): The processes (:class:`subprocess.Popen` instances or
+                          objects with the same interface) to wait for.
+        deadline (float): The deadline, in terms of ``_clock()``. If ``None``,
+                          wait for as long as it takes.
+
+    Returns:
+        list: Those of the processes which were still running at the deadline.
+    """
+    pending = [p for p in processes if p.poll() is None]
+    if pending and hasattr(os, 'pidfd_open'):
+        import select
+
+        poller = select.poll()
+        fds = {}
+        try:
+            for p in pending:
+                if not isinstance(p, subprocess.Popen) or getattr(p, 'exited', None):
+                    continue  # waiting for it below is efficient enough
+                try:
+                    fd = os.pidfd_open(p.pid)
+                except OSError:  # already reaped, or pidfds not supported
+                    continue
+                fds[fd] = p
+                poller.register(fd, select.POLLIN)
+            while fds:
+                timeout = _remaining(deadline)
+                if timeout is not None:
+                    timeout = int(timeout * 1000 + 0.5)
+                ready = poller.poll(timeout)
+                if not ready:
+                    break
+                for fd, _ in ready:
+                    poller.unregister(fd)
+                    os.close(fd)
+                    p = fds.pop(fd)
+                    # It has exited, so this won't take long, even if another
+                    # thread is reaping it right now.
+                    p.wait()
+        finally:
+            for fd in fds:
+                os.close(fd)
+        pending = [p for p in pending if p.poll() is None]
+    result = []
+    for p in pending:
+        try:
+            if not _wait_has_timeout:
+                p.wait()
+            else:
+                p.wait(_remaining(deadline))
+        except _TimeoutExpired:
+            result.append(p)
+    return result
+
+
+def _signal_process(p, sig):
+    """
+    Send a signal to a process, unless it's known to have exited. The reaper's
+    pidfd for the process is used where possible.
+
+    Args:
+        p: The process (a :class:`subprocess.Popen` instance or an object with
+           the same interface) to signal.
+        sig (int): The signal to send.
+    """
+    if not reaper.send_signal(p, sig) and p.returncode is None:
+        try:
+            p.send_signal(sig)
+        except OSError:  # pragma: no cover
+            pass  # already gone
+
+
+def _signal_group(pgid, sig, members):
+    """
+    Send a signal to a process group, but only while one of its members is
+    known not to have been reaped. Once they all have been, the group may have
+    gone, and the kernel could have given its ID to an unrelated group.
+
+    Args:
+        pgid (int): The process group to signal.
+        sig (int): The signal to send.
+        members (list): Processes we started in the group.
+
+    Returns:
+        bool: Whether the group was signalled.
+    """
+    for p in members:
+        if p.returncode is not None:
+            continue
+        signal_group = getattr(p, 'signal_group', None)
+        if signal_group is not None:
+            # The spawn server checks that the child hasn't been reaped.
+            signal_group(pgid, sig)
+            return True
+        lock = getattr(p, '_waitpid_lock', None)
+        if lock is None:
+            # There's no lock to stop the child being reaped on Python 2, or
+            # for asyncio processes, which are reaped by the event loop.
+            if getattr(p, 'poll', None) is not None and p.poll() is not None:
+                continue
+        elif not (lock.acquire(True, 0.1) if PY3 else lock.acquire(False)):
+            continue  # being reaped right now
+        try:
+            # Reaping is done with the lock held, so the child can't be reaped
+            # until it's released.
+            if p.returncode is None:
+                try:
+                    os.killpg(pgid, sig)
+                except OSError:  # pragma: no cover
+                    pass
+                return True
+        finally:
+            if lock is not None:
+                lock.release()
+    return False
+
+
+def _stop_process(p, kill=False, pgid=None, members=None):
+    """
+    Terminate or kill a process, if it's still running, and optionally a
+    process group.
+
+    Args:
+        p: The process (a :class:`subprocess.Popen` instance or an object with
+           the same interface) to stop.
+        kill (bool): If ``True``, kill the process rather than terminating it.
+        pgid (int): If specified, the process group to signal as well, so that
+                    the process's descendants are stopped too. The group is
+                    only signalled while it has a member which hasn't been
+                    reaped.
+        members (list): The processes we started in the group, if not just
+                        ``p``.
+    """
+    if pgid and hasattr(os, 'killpg'):
+        _signal_group(pgid, signal.SIGKILL if kill else signal.SIGTERM, members or [p])
+    if p.returncode is None:
+        if os.name == 'posix':
+            _signal_process(p, signal.SIGKILL if kill else signal.SIGTERM)
+        else:  # pragma: no cover
+            try:
+                if kill:
+                    p.kill()
+                else:
+                    p.terminate()
+            except OSError:
+                pass  # already gone
+
+
+def _emulate_process_group(kwargs):
+    """
+    Return :class:`subprocess.Popen` keyword arguments in which a
+    ``process_group`` argument, which Popen only accepts from Python 3.11, has
+    been replaced by a ``preexec_fn`` which does the same thing, if need be.
+    """
+    group = kwargs.get('process_group')
+    if group is None or _has_process_group:
+        return kwargs
+    kwargs = dict(kwargs)
+    del kwargs['process_group']
+    preexec_fn = kwargs.get('preexec_fn')
+
+    def preexec():
+        try:
+            os.setpgid(0, group)
+        except OSError:
+            # The group has gone, as all its members have exited.
+            os.setpgid(0, 0)
+        if preexec_fn:
+            preexec_fn()
+
+    kwargs['preexec_fn'] = preexec
+    return kwargs
+
+
+# The keyword arguments for settings which are applied in a child before it execs
+_CHILD_SETTINGS = ('rlimits', 'nice', 'ionice', 'cpu_affinity')
+
+# I/O scheduling classes, and the number of the ioprio_set() system call by machine
+_IOPRIO_CLASSES = {'realtime': 1, 'best-effort': 2, 'idle': 3}
+_IOPRIO_SET = {'x86_64': 251, 'amd64': 251, 'i386': 289, 'i686': 289, 'aarch64': 30,
+               'arm64': 30, 'armv7l': 314, 'ppc64le': 273, 's390x': 282}
+
+
+def _ionice_value(ionice):
+    """
+    Return the ioprio_set() system call number and the I/O priority value for
+    an ``ionice`` setting, as the ``ionice`` utility would use them.
+    """
+    import platform
+
+    if isinstance(ionice, (tuple, list)):
+        cls, level = ionice
+    else:
+        cls, level = ionice, None
+    cls = _IOPRIO_CLASSES.get(cls, cls)
+    if cls not in (1, 2, 3):
+        raise ValueError('invalid I/O scheduling class: %r' % (ionice,))
+    if level is None:
+        level = 0 if cls == 3 else 4
+    if not 0 <= level <= 7:
+        raise ValueError('invalid I/O scheduling level: %r' % (ionice,))
+    nr = _IOPRIO_SET.get(platform.machine())
+    if nr is None or not sys.platform.startswith('linux'):
+        raise ValueError('ionice is not supported on this platform')
+    return nr, (cls << 13) | level
+
+
+def _settings_action(settings):
+    """
+    Return a callable which applies settings returned by
+    :func:`_apply_child_settings` to the calling process. It's meant to be
+    called in a child before it execs, so anything it needs is set up here,
+    before the fork.
+
+    Args:
+        settings (dict): The settings.
+    """
+    import resource
+
+    rlimits = settings.get('rlimits', ())
+    nice = settings.get('nice')
+    ionice = settings.get('ionice')
+    cpu_affinity = settings.get('cpu_affinity')
+    if ionice is not None:
+        import ctypes
+
+        libc = ctypes.CDLL(None, use_errno=True)
+        get_errno = ctypes.get_errno
+
+    def apply_settings():
+        for key, soft, hard in rlimits:
+            resource.setrlimit(key, (soft, hard))
+        if nice:
+            os.nice(nice)
+        if ionice is not None:
+            nr, value = ionice
+            # IOPRIO_WHO_PROCESS, for the calling process
+            if libc.syscall(nr, 1, 0, value) != 0:
+                err = get_errno()
+                raise OSError(err, os.strerror(err))
+        if cpu_affinity is not None:
+            os.sched_setaffinity(0, cpu_affinity)
+
+    return apply_settings
+
+
+def _apply_child_settings(kwargs):
+    """
+    Remove any ``rlimits``, ``nice``, ``ionice`` and ``cpu_affinity`` arguments
+    from :class:`subprocess.Popen` keyword arguments. Invalid settings are
+    reported here, in the parent, by raising ``ValueError``.
+
+    The settings are returned in a form which can be sent to a spawn server,
+    and are applied in the child before it execs, either by the spawn server
+    or by a ``preexec_fn`` added by :func:`_settings_preexec`.
+
+    Returns:
+        tuple: The keyword arguments, and the settings (or ``None``).
+    """
+    if all(kwargs.get(k) is None for k in _CHILD_SETTINGS):
+        return kwargs, None
+    kwargs = dict(kwargs)
+    rlimits, nice, ionice, cpu_affinity = [kwargs.pop(k, None) for k in _CHILD_SETTINGS]
+    if os.name != 'posix':
+        raise ValueError('resource limits and scheduling settings are only '
+                         'supported on POSIX')
+    settings = {}
+    if rlimits:
+        import resource
+
+        limits = []
+        for name, value in rlimits.items():
+            if isinstance(name, string_types):
+                key = getattr(resource, 'RLIMIT_%s' % name.upper(), None)
+                if key is None:
+                    raise ValueError('unknown resource limit: %s' % name)
+            else:
+                key = name
+            if isinstance(value, (tuple, list)):
+                soft, hard = value
+            else:
+                # Just set the soft limit, so that e.g. SIGXCPU can be handled
+                soft, hard = value, resource.getrlimit(key)[1]
+                if hard != resource.RLIM_INFINITY and soft > hard:
+                    raise ValueError('%s limit %s exceeds the hard limit %s' % (name, soft, hard))
+            limits.append([key, soft, hard])
+        settings['rlimits'] = limits
+    if nice:
+        settings['nice'] = nice
+    if ionice is not None:
+        settings['ionice'] = _ionice_value(ionice)
+    if cpu_affinity is not None:
+        if not hasattr(os, 'sched_setaffinity'):
+            raise ValueError('cpu_affinity is not supported on this platform')
+        settings['cpu_affinity'] = sorted(cpu_affinity)
+    return kwargs, settings or None
+
+
+def _settings_preexec(kwargs, settings):
+    """
+    Return :class:`subprocess.Popen` keyword arguments with a ``preexec_fn``
+    which applies settings returned by :func:`_apply_child_settings` in the
+    child before it execs, and then calls any ``preexec_fn`` already given.
+    As with any ``preexec_fn``, the child is spawned using ``fork()``.
+    """
+    if settings is None:
+        return kwargs
+    action = _settings_action(settings)
+    preexec_fn = kwargs.get('preexec_fn')
+
+    def preexec():
+        action()
+        if preexec_fn:
+            preexec_fn()
+
+    return dict(kwargs, preexec_fn=preexec)
+
+
+class Command(object):
+    """
+    This class represents a shell command to be run in a subprocess.
+
+    Args:
+        args (str|list[str]):   The command string or array or command/args to be run.
+
+        kwargs (dict): The same as you would pass to `subprocess.Popen`.
+                       However, the ``env`` parameter is handled differently: it
+                       is treated as a set of *additional* environment variables
+                       to be added to the values in ``os.environ``, unless the
+                       ``replace_env`` keyword argument is present and truthy, in
+                       which case the env value is used *in place of*
+                       ``os.environ``. Merged environments are cached in
+                       ``env_cache``, and each command gets its own copy.
+                       The ``on_spawn``, ``on_first_output`` and ``on_exit``
+                       keyword arguments specify callbacks for events in the
+                       command's life. The ``rlimits``, ``nice``, ``ionice``
+                       and ``cpu_affinity`` keyword arguments specify resource
+                       limits and scheduling settings for the subprocess.
+                       The ``spawn_limiter`` keyword argument specifies a
+                       :class:`SpawnLimiter` to spawn it through, overriding
+                       ``default_spawn_limiter``.
+
+    .. versionadded:: 0.1.6
+       The ``replace_env`` keyword argument was added.
+
+    .. versionadded:: 0.1.9
+       The ``spawn_server``, ``on_spawn``, ``on_first_output``, ``on_exit``,
+       ``rlimits``, ``nice``, ``ionice``, ``cpu_affinity`` and ``spawn_limiter``
+       keyword arguments were added.
+    """
+
+    pipeline = None
+
+    def __init__(self, args, **kwargs):
+        replace_env = kwargs.pop('replace_env', False)
+        self.spawn_server = kwargs.pop('spawn_server', None) or default_spawn_server
+        self.spawn_limiter = kwargs.pop('spawn_limiter', None) or default_spawn_limiter
+        self.on_spawn = kwargs.pop('on_spawn', None)
+        self.on_first_output = kwargs.pop('on_first_output', None)
+        self.on_exit = kwargs.pop('on_exit', None)
+        self.exit_notified = False
+        shell = kwargs.get('shell')
+        if not shell and isinstance(args, string_types):
+            args = list(shell_shlex(args, control='();>|&'))
+        self.args = args
+        self.kwargs = kwargs
+        # check for input specified
+        if kwargs.get('stdin'):
+            raise ValueError('Inputs need to be specified via the run method.')
+        # special handling of Capture instances in stdout, stderr
+        for attr in ('stdout', 'stderr'):
+            s = kwargs.get(attr)
+            if isinstance(s, Capture):
+                kwargs[attr] = subprocess.PIPE
+                setattr(self, attr, s)
+        # special handling: env is added to os.environ
+        e = kwargs.get('env')
+        if e:
+            if replace_env:
+                env = e
+            else:
+                env = env_cache.merged(e)
+            kwargs['env'] = env
+        self.process_ready = threading.Event()
+        self.process = None
+        self.process_group = None
+        self.exception = None
+        logger.debug('%r created', self)
+
+    def __repr__(self):  # pragma: no cover
+        if isinstance(self.args, basestring):
+            s = self.args
+        else:
+            s = ' '.join(self.args)
+        return '%s(%r)' % (self.__class__.__name__, s)
+
+    def run(self, input=None, async_=False):
+        """
+        Run the command with optional input and either synchronously or
+        asynchronously.
+
+        Args:
+            input (str|bytes|file): The input to pass to the command subprocess.
+                                        If this is text, it is encoded to bytes using UTF-8.
+                                        If it is a byte string, it is used as is. Otherwise, a
+                                        file-like object containing bytes should be passed: this
+                                        will be read to the end, but not closed.
+            async_ (bool): If ``True``, this method returns without waiting for the
+                           subprocess to complete. Otherwise, it awaits completion
                            by calling the `subprocess.Popen.wait()` method.
         """
         # noinspection PyBroadException
@@ -742,9 +2948,36 @@ class Command(object):
                 self.kwargs['stdin'] = input
             else:
                 self.kwargs['stdin'] = subprocess.PIPE
-        logger.debug('About to call Popen: %s, %s', self.args, self.kwargs)
+        kwargs = self.kwargs
+        if (not kwargs.get('shell') and not kwargs.get('executable')
+                and not isinstance(self.args, string_types) and self.args
+                and isinstance(self.args[0], string_types)):
+            # Look up the executable here, where the result can be cached.
+            if os.name == 'posix':
+                # As execvp() would in the child, after changing directory
+                exe = _find_executable(self.args[0], kwargs.get('env'), kwargs.get('cwd'))
+            else:
+                # CreateProcess() searches our path and current directory, and
+                # only adds the .exe extension.
+                exe = _find_executable(self.args[0], None)
+                if exe and not exe.lower().endswith('.exe'):
+                    exe = None
+            if exe:
+                kwargs = dict(kwargs, executable=exe)
+        group = kwargs.get('process_group')
+        kwargs = _emulate_process_group(kwargs)
+        logger.debug('About to call Popen: %s, %s', self.args, kwargs)
         try:
-            self.process = p = Popen(self.args, **self.kwargs)
+            kwargs, settings = _apply_child_settings(kwargs)
+            try:
+                self.process = p = self._spawn(kwargs, settings)
+            except OSError as e:
+                if not group or e.errno != errno.EPERM or 'process_group' not in kwargs:
+                    raise
+                # The group to join has gone, as all its members have exited:
+                # start a new one instead.
+                group = 0
+                self.process = p = self._spawn(dict(kwargs, process_group=0), settings)
         except (OSError, Exception) as e:  # pragma: no cover
             self.process_ready.set()
             if isinstance(e, OSError) and e.errno == errno.ENOENT:
@@ -755,6 +2988,13 @@ class Command(object):
             logger.exception('Popen call failed: %s: %s', type(e), e)
             self.exception = e
             raise
+        if kwargs.get('start_new_session'):
+            self.process_group = p.pid
+        elif group is not None:
+            self.process_group = group or p.pid
+        pipeline = self.pipeline
+        if pipeline is not None and pipeline.new_group and pipeline.process_group is None:
+            pipeline.process_group = self.process_group
         self.stdin = p.stdin
         logger.debug('Popen: %s, %s -> %s', self, self.kwargs, p.__dict__)
         if isinstance(input, BytesIO):
@@ -770,61 +3010,173 @@ class Command(object):
             # set after a chunk has been written in the copier and which we
             # wait for here, but that doesn't seem to work reliably.
             t.join(0.0001)
+        if tracer is not None:
+            tracer.spawned(self, p, time.time())
         for attr in ('stdout', 'stderr'):
             s = getattr(self, attr, None)
             if isinstance(s, Capture):
-                s.add_stream(getattr(p, attr))
+                s.add_stream(getattr(p, attr), (self, attr))
         self.process_ready.set()
+        if self.on_exit is not None or (self.pipeline is not None
+                                        and self.pipeline.on_complete is not None):
+            _on_exit(p, self._process_exited)
+        if self.on_spawn is not None:
+            _call_hook(self.on_spawn, self)
+        if pipeline is not None and pipeline.cancelled:
+            # The pipeline was cancelled while this was being spawned.
+            _stop_process(p, pipeline.cancel_kill,
+                          self.process_group if pipeline.cancel_group else None)
         if not async_:
             logger.debug('about to wait for process %s', self)
-            p.wait()
+            node_executor.begin_wait()
+            try:
+                p.wait()
+            finally:
+                node_executor.end_wait()
         logger.debug('returning %s (%s)', self, self.process)
         return self
 
+    def _spawn(self, kwargs, settings=None):
+        limiter = self.spawn_limiter
+        if limiter is None:
+            return self._create_process(kwargs, settings)
+        owner = self if self.pipeline is None else self.pipeline
+        limiter.acquire(owner)
+        try:
+            p = self._create_process(kwargs, settings)
+        except BaseException:
+            limiter.failed(owner)
+            raise
+        limiter.started(owner, p)
+        return p
+
+    def _create_process(self, kwargs, settings=None):
+        server = self.spawn_server
+        if server is not None and server.can_spawn(kwargs):
+            # The server applies any settings in the child before it execs.
+            return server.spawn(self.args, settings=settings, **kwargs)
+        return Popen(self.args, **_settings_preexec(kwargs, settings))
+
     def wait(self, timeout=None):
         """
         Wait for a command's underlying sub-process to complete.
 
         Args:
-            timeout (float): How many seconds to wait.
-                                This parameter only applies for
-                                Python >= 3.3 and has no effect otherwise.
+            timeout (float): How many seconds to wait. This covers waiting for
+                             the sub-process to be created, as well as for it
+                             to finish. This parameter only applies for
+                             Python >= 3.3 and has no effect otherwise.
         """
-        self.process_ready.wait()
+        if not _wait_has_timeout:
+            timeout = None
+        deadline = None if timeout is None else _clock() + timeout
+        if not self.process_ready.wait(timeout):
+            raise _TimeoutExpired(self.args, timeout)
         p = self.process
         if not p:  # pragma: no cover
             logger.warning('No process found for %s', self)
             result = None
         else:
-            if _wait_has_timeout:
-                result = p.wait(timeout)
-            else:
-                result = p.wait()
+            node_executor.begin_wait()
+            try:
+                if deadline is None:
+                    result = p.wait()
+                else:
+                    result = p.wait(_remaining(deadline))
+            finally:
+                node_executor.end_wait()
         return result
 
-    def terminate(self):
+    def terminate(self, group=False):
         """
         Terminate a command's underlying subprocess.
 
+        Args:
+            group (bool): If ``True`` and the command was started in a new
+                          process group or session, terminate the whole group.
+
         .. versionadded:: 0.1.1
+
+        .. versionchanged:: 0.1.9
+           The ``group`` parameter was added.
         """
         self.process_ready.wait()
         p = self.process
         if not p:  # pragma: no cover
             raise ValueError('There is no subprocess')
-        p.terminate()
+        _stop_process(p, False, self.process_group if group else None)
 
-    def kill(self):
+    def kill(self, group=False):
         """
         Kill a command's underlying subprocess.
 
+        Args:
+            group (bool): If ``True`` and the command was started in a new
+                          process group or session, kill the whole group.
+
         .. versionadded:: 0.1.1
+
+        .. versionchanged:: 0.1.9
+           The ``group`` parameter was added.
+        """
+        self.process_ready.wait()
+        p = self.process
+        if not p:  # pragma: no cover
+            raise ValueError('There is no subprocess')
+        _stop_process(p, True, self.process_group if group else None)
+
+    def send_signal(self, sig, group=False):
+        """
+        Send a signal to a command's underlying subprocess.
+
+        Args:
+            sig (int): The signal to send.
+            group (bool): If ``True`` and the command was started in a new
+                          process group or session, signal the whole group.
+
+        .. versionadded:: 0.1.9
         """
         self.process_ready.wait()
         p = self.process
         if not p:  # pragma: no cover
             raise ValueError('There is no subprocess')
-        p.kill()
+        if group and self.process_group and hasattr(os, 'killpg'):
+            _signal_group(self.process_group, sig, [p])
+        elif os.name == 'posix':
+            _signal_process(p, sig)
+        else:  # pragma: no cover
+            p.send_signal(sig)
+
+    def orphans(self):
+        """
+        Find the processes which are keeping this command's captured output
+        open after it has exited. These are normally descendants of the
+        command which are still running, and readers of the output won't see
+        its end until they exit or close it.
+
+        Returns:
+            list[int]|None: The process IDs, which are empty if the command is
+                            still running. ``None`` is returned if this
+                            can't be determined on this platform.
+        """
+        from .utils import pipe_holders
+
+        p = self.process
+        if p is None or p.poll() is None:
+            return []
+        result = set()
+        for attr in ('stdout', 'stderr'):
+            if not isinstance(getattr(self, attr, None), Capture):
+                continue
+            try:
+                fd = getattr(p, attr).fileno()
+            except (AttributeError, ValueError):
+                continue  # closed, as all the output has been read
+            holders = pipe_holders(fd)
+            if holders is None:
+                return None
+            result.update(holders)
+        return sorted(result)
 
     def poll(self):
         """
@@ -843,24 +3195,245 @@ class Command(object):
         self.process_ready.wait()
         return self.process.returncode if self.process else None
 
+    def _process_exited(self, process):
+        # Called when the process has been reaped, at least once, from any
+        # thread. Only the first call does anything.
+        with _hook_lock:
+            if self.exit_notified:
+                return
+            self.exit_notified = True
+        if self.on_exit is not None:
+            _call_hook(self.on_exit, self, process.returncode,
+                       getattr(process, 'resource_usage', None))
+        if self.pipeline is not None:
+            self.pipeline._check_complete()
+
+    @property
+    def resource_usage(self):
+        """
+        The resources used by the command's sub-process, as a
+        :class:`ResourceUsage`, once it has been reaped. This is ``None`` until
+        then, or if the information isn't available.
+
+        .. versionadded:: 0.1.9
+        """
+        return getattr(self.process, 'resource_usage', None)
+
+    @property
+    def start_time(self):
+        """
+        When the command's sub-process was started, as a ``time.time()`` value.
+        """
+        return getattr(self.process, 'start_time', None)
+
+    @property
+    def end_time(self):
+        """
+        When the command's sub-process was reaped, as a ``time.time()`` value.
+        """
+        return getattr(self.process, 'end_time', None)
+
+
+# The operators which separate the parts of compound nodes, indexed by the
+# small-int opcodes stored in the nodes.
+OPERATORS = ('|', '|&', '&&', '||', ';', '&')
+OPCODES = dict((op, code) for code, op in enumerate(OPERATORS))
+
 
 class Node(object):
     """
-    This class represents a node in the AST built while parsing command lines.
-    It's basically an object container for various attributes, with a slightly
-    specialised representation to make it a little easier to debug the parser.
+    This is the base class for the nodes in the AST built while parsing command
+    lines. Parsed trees can be held in memory in large numbers (for example, by
+    ``parse_cache``), so nodes use ``__slots__`` rather than a ``__dict__``. The
+    root of a tree may also have a ``source`` attribute, which is the command
+    line it represents. Nodes have a slightly specialised representation to make
+    it a little easier to debug the parser.
     """
 
-    def __init__(self, **kwargs):
-        self.__dict__.update(kwargs)
+    __slots__ = ('source', 'slots')
+
+    kind = None
+
+    # The names of the attributes shown in the representation
+    fields = ()
+
+    def copy(self, **kwargs):
+        """
+        Return a shallow copy of this node.
+
+        Args:
+            kwargs (dict): Attributes to set in the copy, instead of copying
+                           them. An attribute given as ``None`` is left unset.
+        """
+        result = object.__new__(self.__class__)
+        for cls in self.__class__.__mro__:
+            for name in cls.__dict__.get('__slots__', ()):
+                if name in kwargs:
+                    value = kwargs[name]
+                else:
+                    value = getattr(self, name, None)
+                if value is not None:
+                    setattr(result, name, value)
+        return result
 
     def __repr__(self):  # pragma: no cover
-        chunks = []
-        d = dict(self.__dict__)
-        kind = d.pop('kind')
-        for k, v in sorted(d.items()):
-            chunks.append('%s=%s' % (k, v))
-        return '%sNode(%s)' % (kind.title(), ' '.join(chunks))
+        names = list(self.fields)
+        names.extend(name for name in Node.__slots__ if hasattr(self, name))
+        chunks = ['%s=%s' % (name, getattr(self, name)) for name in sorted(names)]
+        return '%sNode(%s)' % (self.kind.title(), ' '.join(chunks))
+
+
+class CommandNode(Node):
+    """
+    This class represents a simple command in a parsed command line.
+
+    Args:
+        command (list[str]): The command and its arguments.
+        redirects (dict): A mapping of file descriptors (1 and 2) to tuples of
+                          ``('>' or '>>', target)``, where the target is a
+                          filename or ``('&', fd)``.
+    """
+
+    __slots__ = ('command', 'redirects')
+
+    kind = 'command'
+
+    fields = __slots__
+
+    def __init__(self, command, redirects=None):
+        self.command = command
+        self.redirects = {} if redirects is None else redirects
+
+    @property
+    def args(self):
+        """
+        A copy of the command and its arguments (or, for a shell command, the
+        string), for a :class:`Command` run for this node to own. Trees can be
+        shared (by ``parse_cache``, for example), so they aren't given the
+        node's own list.
+        """
+        command = self.command
+        return command if isinstance(command, string_types) else list(command)
+
+
+class CompoundNode(Node):
+    """
+    This is the base class for nodes which combine others using operators. The
+    combined nodes are held in ``children``, and the operators between them in
+    ``ops`` as opcodes, which index ``OPERATORS``.
+
+    Args:
+        children (list[Node]): The combined nodes.
+        ops (list[int]): The opcodes of the operators, one fewer than the
+                         children.
+    """
+
+    __slots__ = ('children', 'ops')
+
+    fields = ('parts',)
+
+    def __init__(self, children, ops):
+        self.children = tuple(children)
+        self.ops = tuple(ops)
+
+    @property
+    def parts(self):
+        """
+        The children, with separator nodes for the operators interleaved
+        between them.
+        """
+        children = self.children
+        result = [children[0]]
+        for i, op in enumerate(self.ops):
+            result.append(SEPARATORS[op])
+            result.append(children[i + 1])
+        return result
+
+
+class LogicalNode(CompoundNode):
+    """
+    This class represents commands connected with ``|`` or ``|&``.
+    """
+
+    __slots__ = ()
+
+    kind = 'logical'
+
+
+class PipelineNode(CompoundNode):
+    """
+    This class represents parts of a command line connected with ``&&`` or
+    ``||``.
+    """
+
+    __slots__ = ()
+
+    kind = 'pipeline'
+
+
+class ListNode(CompoundNode):
+    """
+    This class represents parts of a command line separated by ``;`` or ``&``.
+    """
+
+    __slots__ = ()
+
+    kind = 'list'
+
+
+class SeparatorNode(Node):
+    """
+    This is the base class for the nodes which represent operators in the
+    ``parts`` of compound nodes. There is only one instance for each operator,
+    in ``SEPARATORS``.
+
+    Args:
+        op (int): The opcode of the operator.
+    """
+
+    __slots__ = ('op',)
+
+    def __init__(self, op):
+        self.op = op
+
+
+class PipeNode(SeparatorNode):
+    __slots__ = ()
+
+    kind = 'pipe'
+
+    fields = ('pipe',)
+
+    @property
+    def pipe(self):
+        return OPERATORS[self.op]
+
+
+class CheckNode(SeparatorNode):
+    __slots__ = ()
+
+    kind = 'check'
+
+    fields = ('check',)
+
+    @property
+    def check(self):
+        return OPERATORS[self.op]
+
+
+class SyncNode(SeparatorNode):
+    __slots__ = ()
+
+    kind = 'sync'
+
+    fields = ('sync',)
+
+    @property
+    def sync(self):
+        return OPERATORS[self.op]
+
+
+SEPARATORS = (PipeNode(0), PipeNode(1), CheckNode(2), CheckNode(3), SyncNode(4), SyncNode(5))
 
 
 class CommandLineParser(object):
@@ -872,7 +3445,13 @@ class CommandLineParser(object):
 
     permitted_tokens = ('&&', '||', '|&', '>>')
 
+    # Whether to tokenize using scan_tokens() where possible, rather than a
+    # shell_shlex lexer, which is much slower.
+    use_scanner = True
+
     def next_token(self):
+        if self.lex is None:
+            return next(self.tokens, self.eof)
         t = self.lex.get_token()
         if not t:
             tt = None
@@ -902,6 +3481,38 @@ class CommandLineParser(object):
                 tt = t
         return tt, t, self.lex.preceding
 
+    def classify_tokens(self, raw):
+        """
+        Convert the tokens from `scan_tokens()` to what `next_token()` returns
+        for them when they come from a `shell_shlex` lexer.
+        """
+        result = []
+        for t, tt, preceding in raw:
+            if not t:
+                tt = None
+            elif tt in ('"', "'"):
+                tt = 'word'
+                t = t[1:-1]
+            elif tt == 'a':
+                tt = 'word'
+                # int() ignores surrounding whitespace, and most words don't
+                # end with a digit, so this saves raising most ValueErrors.
+                last = t[-1]
+                if last.isdigit() or last.isspace():
+                    try:
+                        int(t)
+                        tt = 'number'
+                    except ValueError:
+                        pass
+            elif tt == 'c':
+                if len(t) > 1:
+                    for valid in self.get_valid_controls(t):
+                        result.append((valid, valid, preceding))
+                    continue
+                tt = t
+            result.append((tt, t, preceding))
+        return result
+
     def get_valid_controls(self, t):
         if len(t) == 1:
             result = [t]
@@ -938,11 +3549,32 @@ class CommandLineParser(object):
             raise ValueError('consume: expected %r', tt)
 
     def parse(self, source, posix=None):
+        if posix is None:
+            posix = os.name == 'posix'
+        result = parse_cache.get(source, posix)
+        if result is not None:
+            return result
+        if tracer is not None:
+            start = time.time()
+            result = self._parse(source, posix)
+            tracer.parsed(source, start, time.time())
+        else:
+            result = self._parse(source, posix)
+        parse_cache.put(source, posix, result)
+        return result
+
+    def _parse(self, source, posix):
         self.source = source
         parse_logger.debug('starting parse of %r', source)
         if posix is None:
             posix = os.name == 'posix'
-        self.lex = shell_shlex(source, posix=posix, control=True)
+        raw = scan_tokens(source, posix) if self.use_scanner else None
+        if raw is None:
+            self.lex = shell_shlex(source, posix=posix, control=True)
+        else:
+            self.lex = None
+            self.tokens = iter(self.classify_tokens(raw))
+            self.eof = (None, None if posix else '', '')
         self.token = None
         self.peek = None
         self.peek_token()
@@ -950,34 +3582,34 @@ class CommandLineParser(object):
         return result
 
     def parse_list(self):
-        parts = [self.parse_pipeline()]
+        children = [self.parse_pipeline()]
+        ops = []
         tt = self.peek_token()
         while tt in (';', '&'):
             self.consume(tt)
-            part = self.parse_pipeline()
-            parts.append(Node(kind='sync', sync=tt))
-            parts.append(part)
+            children.append(self.parse_pipeline())
+            ops.append(OPCODES[tt])
             tt = self.peek_token()
-        if len(parts) == 1:
-            node = parts[0]
+        if not ops:
+            node = children[0]
         else:
-            node = Node(kind='list', parts=parts)
+            node = ListNode(children, ops)
         parse_logger.debug('returning %r', node)
         return node
 
     def parse_pipeline(self):
-        parts = [self.parse_logical()]
+        children = [self.parse_logical()]
+        ops = []
         tt = self.peek_token()
         while tt in ('&&', '||'):
             self.consume(tt)
-            part = self.parse_logical()
-            parts.append(Node(kind='check', check=tt))
-            parts.append(part)
+            children.append(self.parse_logical())
+            ops.append(OPCODES[tt])
             tt = self.peek_token()
-        if len(parts) == 1:
-            node = parts[0]
+        if not ops:
+            node = children[0]
         else:
-            node = Node(kind='pipeline', parts=parts)
+            node = PipelineNode(children, ops)
         parse_logger.debug('returning %r', node)
         return node
 
@@ -988,24 +3620,24 @@ class CommandLineParser(object):
             node = self.parse_list()
             self.consume(')')
         else:
-            parts = [self.parse_command()]
+            children = [self.parse_command()]
+            ops = []
             tt = self.peek_token()
             while tt in ('|', '|&'):
-                last_part = parts[-1]
+                last_part = children[-1]
                 if ((tt == '|' and 1 in last_part.redirects)
                         or (tt == '|&' and 2 in last_part.redirects)):
                     if last_part.redirects != SWAP_OUTPUTS:
                         raise ValueError('semantics: cannot redirect and pipe the '
                                          'same stream')
                 self.consume(tt)
-                part = self.parse_command()
-                parts.append(Node(kind='pipe', pipe=tt))
-                parts.append(part)
+                children.append(self.parse_command())
+                ops.append(OPCODES[tt])
                 tt = self.peek_token()
-            if len(parts) == 1:
-                node = parts[0]
+            if not ops:
+                node = children[0]
             else:
-                node = Node(kind='logical', parts=parts)
+                node = LogicalNode(children, ops)
         parse_logger.debug('returning %r', node)
         return node
 
@@ -1043,7 +3675,7 @@ class CommandLineParser(object):
         return node
 
     def parse_command_part(self):
-        node = Node(kind='command', command=[self.peek[1]], redirects={})
+        node = CommandNode([self.peek[1]])
         if self.peek[0] == 'word':
             self.consume('word')
         else:
@@ -1094,21 +3726,38 @@ class Pipeline(WithMixin):
         Initialize a new instance.
 
         Args:
-            source (str|list|tuple): The command line.
+            source (str|list|tuple|Node): The command line, or a tree
+                                          already parsed from one, such as
+                                          one bound by a
+                                          :class:`PipelineTemplate`.
             posix (bool): Whether POSIX conventions are used in the lexer.
             kwargs (dict): Whatever you might pass to `subprocess.Popen`.
+                           Additionally, ``incremental`` can be a
+                           :class:`StageState`, the path of a file to keep
+                           one in, or ``True`` to keep one in
+                           ``.sarge-stages.json`` in the working directory;
+                           commands whose outputs are up to date are then
+                           skipped. ``stage_inputs`` gives the files read by
+                           such commands, in addition to the arguments which
+                           name existing files: it's either a list for all
+                           commands or a dict mapping the index of a command
+                           in the command line to a list.
         """
         if posix is None:
             posix = os.name == 'posix'
         is_shell = kwargs.get('shell', False)
-        if isinstance(source, (list, tuple)) or is_shell:
+        if isinstance(source, Node):
+            self.source = getattr(source, 'source', None)
+            t = source
+        elif isinstance(source, (list, tuple)) or is_shell:
             if is_shell:
                 self.source = source
             else:
                 self.source = ' '.join(source)
-            t = Node(kind='command', command=source, redirects={})
+            t = CommandNode(source)
         else:
             self.source = source
+            # This may be a cached tree, shared with other pipelines.
             t = CommandLineParser().parse(source, posix=posix)
         logger.debug('command tree: %s', t)
         self.tree = t
@@ -1117,8 +3766,34 @@ class Pipeline(WithMixin):
         self.kwargs = kwargs
         self.stdout = kwargs.pop('stdout', None)
         self.stderr = kwargs.pop('stderr', None)
+        self.on_complete = kwargs.pop('on_complete', None)
+        self.starting = False
+        self.completed = False
+        self.new_group = kwargs.pop('new_group', False)
+        self.process_group = None
+        incremental = kwargs.pop('incremental', None)
+        if incremental is True:
+            incremental = os.path.join(kwargs.get('cwd') or '', '.sarge-stages.json')
+        if isinstance(incremental, string_types):
+            incremental = StageState(incremental)
+        self.stage_state = incremental
+        self.stage_inputs = kwargs.pop('stage_inputs', None) or ()
+        self.stage_indexes = {}
+        if incremental:
+            for node in self.find_commands(t):
+                self.stage_indexes[id(node)] = len(self.stage_indexes)
+        self.stages = []
+        self.skipped = []
+        self.cancelled = False
+        self.cancel_kill = False
+        self.cancel_group = False
         self.lock = threading.RLock()
         self.commands = []
+        self.opened = []
+        # The state of a run is kept here rather than in the tree, which may
+        # be shared with other pipelines.
+        self.node_commands = {}
+        self.node_exceptions = {}
 
     def find_last_command(self, node):
         """
@@ -1127,18 +3802,35 @@ class Pipeline(WithMixin):
         Args:
             node (Node): The root of the sub-tree to search.
         """
-        if not hasattr(node, 'parts'):
+        if node.kind == 'command':
             result = node
         else:
-            result = self.find_last_command(node.parts[-1])
+            result = self.find_last_command(node.children[-1])
         assert result.kind == 'command'
         return result
 
+    def find_commands(self, node):
+        """
+        Find all the command nodes in a parse sub-tree, in order.
+
+        Args:
+            node (Node): The root of the sub-tree to search.
+
+        Returns:
+            list[Node]: The command nodes.
+        """
+        if node.kind == 'command':
+            return [node]
+        result = []
+        for child in node.children:
+            result.extend(self.find_commands(child))
+        return result
+
     def run_node_in_thread(self, node, input, async_):
         """
-        Run a node in a separate thread. A thread is created and
-        the `run_node()` method is run with the specified arguments
-        in that thread.
+        Run a node concurrently with the caller. The `run_node()` method is
+        run with the specified arguments by a worker thread of
+        ``node_executor``.
 
         Args:
             node (Node): The node to run.
@@ -1155,10 +3847,8 @@ class Pipeline(WithMixin):
         e = threading.Event()
         with self.lock:
             self.events.append(e)
-        t = threading.Thread(target=self.run_node, args=(node, input, async_, e))
-        t.daemon = True
-        logger.debug('thread %s started to run node: %s', t.name, node)
-        t.start()
+        logger.debug('submitting node to run in worker: %s', node)
+        node_executor.submit(self.run_node, node, input, async_, e)
 
     def run(self, input=None, async_=False):
         """
@@ -1169,15 +3859,65 @@ class Pipeline(WithMixin):
             async_ (bool): If `True`, don't wait for the pipeline to
                            complete before returning.
         """
+        self._start(input, async_)
+        return self
+
+    def _start(self, input, async_, in_thread=True):
+        """
+        Reset the state of running the pipeline, and start running it.
+
+        Args:
+            input (str|bytes|file): The data to pass to the command.
+            async_ (bool): If `True`, don't wait for the pipeline to
+                           complete before returning.
+            in_thread (bool): If `True` and ``async_`` is `True`, run the tree
+                              in a helper thread. Otherwise, it's started in
+                              the calling thread, which only returns promptly
+                              for trees which don't wait for any of their
+                              parts, such as 'command' and 'logical' trees.
+        """
         self.commands = []
         self.opened = []
+        self.node_commands = {}
+        self.node_exceptions = {}
+        self.stages = []
+        self.skipped = []
+        self.completed = False
+        self.cancelled = False
+        self.process_group = None
+        self.starting = True
         node = self.tree
-        # Issue #20: run in thread if async
-        if async_:
-            self.run_node_in_thread(node, input, async_=True)
-        else:
-            self.run_node(node, input=input, async_=False)
-        return self
+        try:
+            # Issue #20: run in thread if async
+            if async_ and in_thread:
+                self.run_node_in_thread(node, input, async_=True)
+            else:
+                self.run_node(node, input=input, async_=async_)
+        finally:
+            self.starting = False
+            self._check_complete()
+
+    def _check_complete(self):
+        """
+        Call the ``on_complete`` callback if everything in the pipeline has been
+        started and has exited, and it hasn't been called already.
+        """
+        if self.on_complete is None or self.completed or self.starting:
+            return
+        with self.lock:
+            if self.completed:
+                return
+            for e in self.events:
+                if not e.is_set():
+                    return
+            for c in self.commands:
+                if c.process is None:
+                    if c.exception is None:
+                        return  # still being started
+                elif c.process.returncode is None:
+                    return
+            self.completed = True
+        _call_hook(self.on_complete, self)
 
     @property
     def returncode(self):
@@ -1213,6 +3953,43 @@ class Pipeline(WithMixin):
                 result.append(rc)
         return result
 
+    @property
+    def resource_usages(self):
+        """
+        A list of the resources used by each command which has been run, as
+        :class:`ResourceUsage` instances. An entry is ``None`` if the command's
+        sub-process hasn't been reaped or the information isn't available.
+        """
+        return [c.resource_usage for c in self.commands]
+
+    @property
+    def resource_usage(self):
+        """
+        The total resources used by the commands which have been run, as a
+        :class:`ResourceUsage`, or ``None`` if none are available.
+        """
+        usages = [u for u in self.resource_usages if u is not None]
+        return sum(usages) if usages else None
+
+    @property
+    def start_time(self):
+        """
+        When the first command was started, as a ``time.time()`` value.
+        """
+        times = [c.start_time for c in self.commands if c.start_time is not None]
+        return min(times) if times else None
+
+    @property
+    def end_time(self):
+        """
+        When the last command finished, as a ``time.time()`` value, or ``None``
+        if any command hasn't yet been reaped.
+        """
+        times = [c.end_time for c in self.commands]
+        if not times or None in times:
+            return None
+        return max(times)
+
     @property
     def exceptions(self):
         """
@@ -1221,29 +3998,205 @@ class Pipeline(WithMixin):
         result = [c.exception for c in self.commands if c]
         return result
 
-    def wait_events(self):
+    def wait_events(self, timeout=None):
         """
-        Wait for all the events in the pipeline to be set
+        Wait for all the events in the pipeline to be set.
+
+        Args:
+            timeout (float): The timeout in seconds, for all the events together.
+
+        Returns:
+            bool: ``True`` if all the events were set, else ``False``.
         """
-        for e in self.events:
-            e.wait()
+        deadline = None if timeout is None else _clock() + timeout
+        node_executor.begin_wait()
+        try:
+            for e in self.events:
+                if not e.wait(_remaining(deadline)):
+                    return False
+        finally:
+            node_executor.end_wait()
+        return True
 
-    def wait(self, timeout=None):
+    def wait(self, timeout=None, raise_on_timeout=True, escalate=None):
         """
         Wait for all the commands in the pipeline to complete.
 
         Args:
-            timeout (float): The timeout in seconds.
-                                This parameter only applies for
-                                Python >= 3.3 and has no effect otherwise.
-                                It will be applied to each command in turn,
-                                so the effect could be cumulative.
+            timeout (float): The timeout in seconds. This is a single deadline
+                             for the whole pipeline, including any parts of it
+                             which are still being started.
+                             This parameter only applies for
+                             Python >= 3.3 and has no effect otherwise.
+            raise_on_timeout (bool): If ``True``, raise a
+                                     ``subprocess.TimeoutExpired`` exception
+                                     if the timeout expires. Its ``running``
+                                     attribute holds the commands still running.
+            escalate (float): If specified, commands still running when the
+                              timeout expires are terminated, and any still
+                              running this many seconds later are killed.
+
+        Returns:
+            list[Command]: The commands which were still running when the
+                           timeout expired. This is empty if there was no timeout.
         """
         logger.debug('pipeline waiting')
+        if not _wait_has_timeout:
+            timeout = None
+        deadline = None if timeout is None else _clock() + timeout
+        self.wait_events(timeout)
+        # Only commands whose processes exist can be waited for. Parts which
+        # haven't finished starting by the deadline have commands with no process.
+        commands = list(self.commands)
+        started = [c for c in commands if c.process is not None]
+        processes = _wait_processes([c.process for c in started], deadline)
+        running = [c for c in started if c.process in processes]
+        if deadline is not None and not all(e.is_set() for e in self.events):
+            running.extend(c for c in self.commands if c.process is None)
+        if running:
+            if escalate is not None:
+                self.escalate(running, escalate)
+            if raise_on_timeout:
+                e = _TimeoutExpired(self.source, timeout)
+                e.running = running
+                raise e
+        return running
+
+    def escalate(self, commands, grace):
+        """
+        Terminate commands, and kill any which are still running after a grace
+        period. This waits until they have all exited.
+
+        Args:
+            commands (list[Command]): The commands to stop.
+            grace (float): How long to wait, in seconds, after terminating the
+                           commands before killing them.
+        """
+        processes = [c.process for c in commands if c.process is not None]
+        for p in processes:
+            try:
+                p.terminate()
+            except OSError:  # pragma: no cover
+                pass  # already gone
+        processes = _wait_processes(processes, _clock() + grace)
+        for p in processes:
+            try:
+                p.kill()
+            except OSError:  # pragma: no cover
+                pass
+        _wait_processes(processes)
+
+    def cancel(self, grace=1.0, group=False):
+        """
+        Cancel the pipeline. No more of its commands are started, those which
+        are running are terminated, and any still running after a grace period
+        are killed. This then waits for the parts of the pipeline being run in
+        other threads to finish, and for captured output to be read.
+
+        Captured output is read for at most another ``grace`` seconds after
+        the commands have been killed: descendants of a command which outlive
+        it can keep its output pipes open. Use ``group=True`` to stop those too,
+        for commands started in their own process group or session.
+
+        Args:
+            grace (float): How long to wait, in seconds, after terminating the
+                           commands before killing them.
+            group (bool): If ``True``, also signal the process group of each
+                          command which was started in a new process group or
+                          session, so that its descendants are stopped too.
+        """
+        logger.debug('pipeline cancelling')
+        with self.lock:
+            self.cancelled = True
+            self.cancel_kill = False
+            self.cancel_group = group
+        deadline = _clock() + grace
+        self._stop_commands()
+        # Parts being run in other threads stop once their current command exits.
+        self.wait_events(grace)
+        commands = list(self.commands)
+        _wait_processes([c.process for c in commands if c.process is not None], deadline)
+        with self.lock:
+            self.cancel_kill = True
+        self._stop_commands()
         self.wait_events()
-        for cmd in self.commands:
-            logger.debug('waiting for command %s', cmd)
-            cmd.wait(timeout)
+        commands = list(self.commands)
+        _wait_processes([c.process for c in commands if c.process is not None])
+        deadline = _clock() + grace
+        drained = True
+        for attr in ('stdout', 'stderr'):
+            s = getattr(self, attr)
+            if isinstance(s, Capture):
+                for t in list(s.threads):
+                    t.join(_remaining(deadline))
+                    if t.is_alive():
+                        drained = False
+                        s._done = True  # the reader stops when it next gets data
+        if drained:
+            self.close()
+        else:
+            logger.warning('output of cancelled pipeline not drained: %s (held open by %s)',
+                           self.source, self.orphans())
+            for stream in self.opened:
+                stream.close()
+
+    def _stop_commands(self):
+        """
+        Terminate, or kill if the grace period for cancellation has expired,
+        all the commands started by the pipeline.
+        """
+        with self.lock:
+            commands = list(self.commands)
+        for c in commands:
+            if c.process is not None:
+                pgid = c.process_group if self.cancel_group else None
+                members = [m.process for m in commands
+                           if pgid and m.process_group == pgid and m.process is not None]
+                _stop_process(c.process, self.cancel_kill, pgid, members)
+
+    def send_signal(self, sig, group=False):
+        """
+        Send a signal to all the commands in the pipeline which are running.
+
+        Args:
+            sig (int): The signal to send.
+            group (bool): If ``True``, signal the process group of each command
+                          which was started in a new process group or session
+                          rather than just the command's process.
+        """
+        with self.lock:
+            commands = list(self.commands)
+        signalled = set()
+        for c in commands:
+            p = c.process
+            if p is None:
+                continue
+            pgid = c.process_group if group else None
+            if pgid and hasattr(os, 'killpg'):
+                if pgid not in signalled:
+                    signalled.add(pgid)
+                    members = [m.process for m in commands
+                               if m.process_group == pgid and m.process is not None]
+                    _signal_group(pgid, sig, members)
+            elif p.poll() is None:
+                _signal_process(p, sig)
+
+    def orphans(self):
+        """
+        Find the processes which are keeping the captured output of commands
+        in the pipeline open after those commands have exited.
+
+        Returns:
+            list[int]|None: The process IDs, or ``None`` if this can't be
+                            determined on this platform.
+        """
+        result = set()
+        for c in list(self.commands):
+            pids = c.orphans()
+            if pids is None:
+                return None
+            result.update(pids)
+        return sorted(result)
 
     def close(self):
         """
@@ -1270,6 +4223,89 @@ class Pipeline(WithMixin):
                 p.stderr.close()
         for stream in self.opened:
             stream.close()
+        self.record_stages()
+
+    def get_stage(self, node, input):
+        """
+        Work out the inputs and outputs of a command node in an incremental
+        pipeline. Only commands whose output goes to files with ``>``, and
+        which aren't given input by the caller, can be skipped.
+
+        Args:
+            node (Node): The command node.
+            input (str|bytes|file): The data to pass to the command.
+
+        Returns:
+            tuple|None: The stage's key, inputs and outputs, or ``None`` if
+                        the command isn't a stage which can be skipped.
+        """
+        if not self.stage_state or input is not None or self.kwargs.get('shell'):
+            return None
+        if node.redirects == SWAP_OUTPUTS:
+            return None
+        base = self.kwargs.get('cwd') or ''
+        outputs = []
+        for pos, fn in node.redirects.values():
+            if not isinstance(fn, string_types):
+                continue
+            if pos != '>':
+                return None  # appending isn't idempotent
+            outputs.append(os.path.abspath(os.path.join(base, fn)))
+        if not outputs:
+            return None
+        inputs = set()
+        for arg in node.command[1:]:
+            path = os.path.abspath(os.path.join(base, arg))
+            if path not in outputs and os.path.isfile(path):
+                inputs.add(path)
+        declared = self.stage_inputs
+        if isinstance(declared, dict):
+            declared = declared.get(self.stage_indexes[id(node)], ())
+        for fn in declared:
+            inputs.add(os.path.abspath(os.path.join(base, fn)))
+        outputs = sorted(outputs)
+        return self.stage_state.key(node.command, outputs), sorted(inputs), outputs
+
+    def skip_stage(self, node):
+        """
+        Skip an up-to-date stage of an incremental pipeline, recording a
+        command for it which succeeded without running.
+
+        Args:
+            node (Node): The command node.
+
+        Returns:
+            Command: The command recorded for the stage.
+        """
+        logger.debug('skipping up-to-date stage: %s', node.command)
+        self.node_commands[node] = cmd = Command(node.args)
+        cmd.pipeline = self
+        cmd.process = _CachedProcess(0)
+        cmd.process_ready.set()
+        with self.lock:
+            self.commands.append(cmd)
+            self.skipped.append(cmd)
+        return cmd
+
+    def record_stages(self):
+        """
+        Record the stages of an incremental pipeline which have completed
+        successfully, so that they can be skipped next time.
+        """
+        recorded = False
+        with self.lock:
+            pending = self.stages
+            self.stages = []
+            for cmd, stage in pending:
+                rc = cmd.process.poll() if cmd.process else 1
+                if rc is None:
+                    self.stages.append((cmd, stage))
+                elif rc == 0:
+                    key, inputs, outputs = stage
+                    self.stage_state.record(key, cmd.args, inputs, outputs)
+                    recorded = True
+        if recorded:
+            self.stage_state.save()
 
     def poll_last(self):
         """
@@ -1312,11 +4348,12 @@ class Pipeline(WithMixin):
             return result
         except Exception as e:
             logger.exception('Failed: %s', e)
-            node.exception = e
+            self.node_exceptions[node] = e
             raise
         finally:
             if event:
                 event.set()
+                self._check_complete()
 
     def new_command(self, args, **kwargs):
         """
@@ -1326,7 +4363,12 @@ class Pipeline(WithMixin):
         Args:
             args (list[str]): The command and arguments to be created.
         """
+        if (self.new_group and kwargs.get('process_group') is None
+                and not kwargs.get('start_new_session')):
+            # The first command starts the group, and the others join it.
+            kwargs['process_group'] = self.process_group or 0
         cmd = Command(args, **kwargs)
+        cmd.pipeline = self
         with self.lock:
             self.commands.append(cmd)
         return cmd
@@ -1386,15 +4428,28 @@ class Pipeline(WithMixin):
         parts = node.parts
         last = len(parts) - 1
         assert last > 1
-        prev = pipe = None
+        prev = pipe = stage = None
         i = 0
-        while i <= last:
+        while i <= last and not self.cancelled:
             curr = parts[i]
             if prev is None:
                 if not input:
                     stdin = None
+                    # Only the first command can be a stage, as the others'
+                    # input comes from the pipe.
+                    stage = self.get_stage(curr, input)
+                    if stage is not None and self.stage_state.up_to_date(*stage):
+                        prev = self.skip_stage(curr)
+                        pipe = parts[i + 1].pipe
+                        i += 2
+                        continue
                 else:
                     stdin = ensure_stream(input)
+            elif isinstance(prev.process, _CachedProcess):
+                # The previous command was skipped, so there's no output to
+                # read, rather than the parent's stdin.
+                stdin = open(os.devnull, 'rb')
+                self.opened.append(stdin)
             else:
                 if pipe == '|':
                     stdin = prev.process.stdout
@@ -1425,15 +4480,20 @@ class Pipeline(WithMixin):
                 if stdout == STDERR:
                     assert self.stdout is None
                 use_async = async_
-            curr.cmd = self.new_command(curr.command,
-                                        stdout=stdout or self.stdout,
-                                        stderr=stderr or self.stderr,
-                                        **self.kwargs)
-            curr.cmd.run(input=stdin, async_=use_async)
+            cmd = self.new_command(curr.args,
+                                   stdout=stdout or self.stdout,
+                                   stderr=stderr or self.stderr,
+                                   **self.kwargs)
+            self.node_commands[curr] = cmd
+            if stage is not None:
+                with self.lock:
+                    self.stages.append((cmd, stage))
+                stage = None
+            cmd.run(input=stdin, async_=use_async)
             # Issue 12: close stdin after spawning the child that uses it
             if prev and stdin == prev.process.stdout:
                 stdin.close()
-            prev = curr.cmd
+            prev = cmd
             i += 2
 
     def run_command_node(self, node, input, async_):
@@ -1449,6 +4509,12 @@ class Pipeline(WithMixin):
                            complete before returning.
         """
         logger.debug('started: %s, %s, %s', node, input, async_)
+        if self.cancelled:
+            return
+        stage = self.get_stage(node, input)
+        if stage is not None and self.stage_state.up_to_date(*stage):
+            self.skip_stage(node)
+            return
         kwargs = dict(self.kwargs)
         stdout, stderr = self.get_redirects(node)
         if node != self.last:
@@ -1463,16 +4529,21 @@ class Pipeline(WithMixin):
                 raise ValueError('You cannot redirect one stream to two '
                                  'places')
             kwargs['stderr'] = self.stderr or stderr
-        node.cmd = self.new_command(node.command, **kwargs)
+        self.node_commands[node] = cmd = self.new_command(node.args, **kwargs)
+        if stage is not None:
+            with self.lock:
+                self.stages.append((cmd, stage))
         try:
-            node.cmd.run(input=input, async_=async_)
+            cmd.run(input=input, async_=async_)
         except Exception as e:
             from .utils import is_main_thread
             if is_main_thread():
                 raise
             # if not the main thread, then the exception should have been stored in
             # node, so just do nothing more
-            assert node.cmd.exception is not None
+            assert cmd.exception is not None
+        if stage is not None and not async_:
+            self.record_stages()
 
     def get_status(self, node):
         """
@@ -1490,7 +4561,7 @@ class Pipeline(WithMixin):
             last = node
         else:
             last = self.find_last_command(node)
-        return last.cmd.process.returncode
+        return self.node_commands[last].process.returncode
 
     def run_pipeline_node(self, node, input, async_):
         """
@@ -1523,6 +4594,8 @@ class Pipeline(WithMixin):
             else:
                 use_async = async_
             self.run_node(curr, input, async_=use_async)
+            if self.cancelled:
+                break
             if i < last:
                 check = parts[i + 1].check
                 if check == '&&':
@@ -1552,7 +4625,7 @@ class Pipeline(WithMixin):
         assert last > 1
         prev = None
         i = 0
-        while i <= last:
+        while i <= last and not self.cancelled:
             curr = parts[i]
             if prev is not None:
                 input = None
@@ -1594,15 +4667,85 @@ def run(cmd, **kwargs):
         async_ (bool): If `True`, this method returns without waiting for the
                        subprocess to complete. Otherwise, it awaits completion
                        by calling the `subprocess.Popen.wait()` method.
+
+        cache (ResultCache|bool): If specified, the result of a synchronous
+                                  run is looked up in this cache (or in
+                                  ``result_cache``, if ``True``), and stored
+                                  in it if not found.
+
+        cache_env (list[str]): The names of environment variables which
+                               affect the result, for caching.
+
+        cache_files (list[str]): The paths of files which affect the result,
+                                 for caching.
     """
     input = kwargs.pop('input', None)
     async_ = kwargs.pop('async_', False)
+    cache = kwargs.pop('cache', None)
+    cache_env = kwargs.pop('cache_env', ())
+    cache_files = kwargs.pop('cache_files', ())
+    key = None
+    if cache and not async_:
+        if cache is True:
+            cache = result_cache
+        key = cache.key(cmd, input, kwargs, cache_env, cache_files)
+        if key is not None:
+            result = cache.get(key)
+            if result is not None:
+                return _cached_pipeline(cmd, kwargs, result)
     if async_:
         p = Pipeline(cmd, **kwargs)
         p.run(input=input, async_=True)
     else:
         with Pipeline(cmd, **kwargs) as p:
             p.run(input=input, async_=async_)
+        if key is not None:
+            result = _pipeline_result(p)
+            if result is not None:
+                cache.put(key, result)
+    return p
+
+
+def _pipeline_result(p):
+    """
+    Get the result of a pipeline which has been run, for caching, or ``None``
+    if it can't be cached (for example, because output was redirected to a
+    file, or a command couldn't be run).
+    """
+    if p.opened or not p.commands:
+        return None
+    returncodes = p.returncodes
+    if None in returncodes:
+        return None
+    outputs = []
+    for attr in ('stdout', 'stderr'):
+        capture = getattr(p, attr)
+        data = None
+        if isinstance(capture, Capture) and (attr == 'stdout' or capture is not p.stdout):
+            # Read the captured data, and put it back for the caller.
+            data = capture.read()
+            if data:
+                capture.buffer.put_nowait(data)
+        outputs.append(data)
+    return [c.args for c in p.commands], returncodes, outputs[0], outputs[1]
+
+
+def _cached_pipeline(cmd, kwargs, result):
+    """
+    Make a pipeline which looks as if it has been run, from a cached result.
+    """
+    args, returncodes, stdout, stderr = result
+    p = Pipeline(cmd, **kwargs)
+    for a, returncode in zip(args, returncodes):
+        c = Command(a, shell=isinstance(a, string_types))
+        c.pipeline = p
+        c.process = _CachedProcess(returncode)
+        c.process_ready.set()
+        p.commands.append(c)
+    for attr, data in (('stdout', stdout), ('stderr', stderr)):
+        capture = getattr(p, attr)
+        if isinstance(capture, Capture) and data:
+            capture.buffer.put_nowait(data)
     return p
 
 
@@ -1695,6 +4838,379 @@ def get_both(cmd, **kwargs):
     return p.stdout.text, p.stderr.text
 
 
+def cpu_count():
+    """
+    Return the number of CPUs in the system, or 1 if it can't be determined.
+    """
+    if hasattr(os, 'cpu_count'):
+        result = os.cpu_count()
+    else:  # pragma: no cover
+        import multiprocessing
+
+        try:
+            result = multiprocessing.cpu_count()
+        except NotImplementedError:
+            result = None
+    return result or 1
+
+
+def run_many(commands, max_workers=None, ordered=True, capture_stdout=False,
+             capture_stderr=False, **kwargs):
+    """
+    Run many independent commands, keeping up to a maximum number of them
+    running at any one time and starting new ones as others finish. All the
+    waiting is done in the calling thread, and helper threads are only used for
+    commands which need them when run asynchronously (for example, ``a && b``).
+
+    Apart from the keyword arguments described below, other keyword arguments
+    are passed to the created :class:`Pipeline` instances, as for `run()`.
+
+    Args:
+        commands (iterable): The commands to run. Each is a command string or
+                             array of command/args.
+
+        max_workers (int): The maximum number of commands to run concurrently. If
+                           not specified, the number of CPUs is used.
+
+        ordered (bool): If ``True``, the results are returned in the order of
+                        ``commands``. Otherwise, they're returned in the order in
+                        which the commands completed.
+
+        capture_stdout (bool): If ``True``, capture each command's ``stdout``
+                               in its own :class:`Capture` instance.
+
+        capture_stderr (bool): If ``True``, capture each command's ``stderr``
+                               in its own :class:`Capture` instance.
+
+        input (str|bytes): The input to pass to each command's subprocess.
+
+        on_complete (callable): As for :class:`Pipeline`, called for each
+                                pipeline when it completes.
+
+    Returns:
+        list[Pipeline]: The pipelines which were run, all of which have been
+                        closed. Errors in starting a command are in the
+                        command's ``exception`` attribute.
+    """
+    input = kwargs.pop('input', None)
+    on_complete = kwargs.pop('on_complete', None)
+    if max_workers is None:
+        max_workers = cpu_count()
+    if max_workers < 1:
+        raise ValueError('max_workers must be at least 1')
+    pending = enumerate(commands)
+    running = []
+    results = []
+    exhausted = False
+    done = threading.Condition()
+    finished = []
+
+    def completed(p):
+        # Called by whichever thread notices that the pipeline has completed.
+        if on_complete is not None:
+            _call_hook(on_complete, p)
+        with done:
+            finished.append(p)
+            done.notify()
+
+    while True:
+        while not exhausted and len(running) < max_workers:
+            try:
+                index, cmd = next(pending)
+            except StopIteration:
+                exhausted = True
+                break
+            kw = dict(kwargs)
+            if capture_stdout:
+                kw['stdout'] = Capture()
+            if capture_stderr:
+                kw['stderr'] = Capture()
+            p = Pipeline(cmd, on_complete=completed, **kw)
+            running.append((index, p))
+            # These can be started without a helper thread
+            in_thread = p.tree.kind not in ('command', 'logical')
+            try:
+                p._start(input, True, in_thread)
+            except Exception as e:
+                # A failure to spawn is recorded in the failed command's
+                # exception attribute. Anything else is the caller's.
+                if not any(c.exception is e for c in p.commands):
+                    raise
+        if not running:
+            break
+        # Pipelines notify their completion, as their last children are reaped.
+        with done:
+            while not finished:
+                done.wait()
+            ended, finished[:] = finished[:], []
+        for p in ended:
+            t = next(t for t in running if t[1] is p)
+            running.remove(t)
+            p.close()
+            results.append(t)
+    if ordered:
+        results.sort(key=lambda t: t[0])
+    return [t[1] for t in results]
+
+
+def arg_max():
+    """
+    Return the maximum combined size of the arguments and environment for a
+    new process.
+    """
+    result = None
+    if hasattr(os, 'sysconf'):
+        try:
+            result = os.sysconf('SC_ARG_MAX')
+        except (ValueError, OSError):  # pragma: no cover
+            pass
+    if not result or result < 0:  # pragma: no cover
+        result = 32767  # the Windows limit on command line length
+    return result
+
+
+# Leave some headroom, as xargs does
+ARG_HEADROOM = 2048
+
+# The Linux limit on the length of a single argument, which matters when
+# running via the shell
+MAX_ARG_STRLEN = 131072
+
+_POINTER_SIZE = struct.calcsize('P')
+
+
+def _arg_size(arg):
+    # Each argument is NUL-terminated and needs a pointer in argv
+    if PY3:
+        arg = os.fsencode(arg)
+    return len(arg) + 1 + _POINTER_SIZE
+
+
+def batch_arguments(items, limit, max_args=None, quoted=False):
+    """
+    Split arguments into batches, each of whose total size is within a limit.
+
+    Args:
+        items (iterable): The arguments to batch.
+
+        limit (int): The maximum total size of the arguments in a batch, as
+                     computed for ``ARG_MAX``.
+
+        max_args (int): The maximum number of arguments in a batch.
+
+        quoted (bool): If ``True``, use the sizes of the arguments as quoted by
+                       `shell_quote()`.
+
+    Returns:
+        generator: The batches, each of which is a list of arguments.
+    """
+    batch = []
+    size = 0
+    for item in items:
+        item = str(item)
+        n = _arg_size(shell_quote(item) if quoted else item)
+        if n > limit:
+            raise ValueError('argument too long: %s...' % item[:40])
+        if batch and (size + n > limit or (max_args and len(batch) >= max_args)):
+            yield batch
+            batch = []
+            size = 0
+        batch.append(item)
+        size += n
+    if batch:
+        yield batch
+
+
+class _BatchFormatter(ShellFormatter):
+    # Each batch of arguments is expanded into several words, whether its
+    # placeholder is {0} or {0:*}.
+
+    def format_field(self, value, format_spec):
+        if isinstance(value, list) and not format_spec:
+            format_spec = '*'
+        return super(_BatchFormatter, self).format_field(value, format_spec)
+
+
+def run_batched(template, items, max_args=None, max_workers=1, **kwargs):
+    """
+    Run a command over many arguments, in the manner of ``xargs``: as many
+    arguments as the system allows are passed to each invocation of the
+    command, so that as few invocations as possible are needed.
+
+    The arguments in each batch are quoted using `shell_quote()` and are
+    substituted for the ``{0}`` placeholder in ``template`` using
+    `shell_format()`, as for a ``{0:*}`` placeholder. The limit on the size of each batch is computed from
+    `arg_max()` less the size of the environment and of the rest of the
+    command line.
+
+    Apart from the keyword arguments described below, other keyword arguments
+    are passed to `run_many()`, and thence to the created :class:`Pipeline`
+    instances.
+
+    Args:
+        template (str): The command line to run, as a format string for
+                        `shell_format()`. If it has no ``{0}`` placeholder,
+                        the arguments are appended to it.
+
+        items (iterable): The arguments to pass to the command.
+
+        max_args (int): The maximum number of arguments to pass to each
+                        invocation of the command.
+
+        max_workers (int): The maximum number of invocations to run
+                           concurrently.
+
+    Returns:
+        list[Pipeline]: The pipelines which were run, in the order of the
+                        batches of arguments.
+    """
+    if '{0' not in template:
+        template += ' {0}'
+    formatter = _BatchFormatter()
+    env = kwargs.get('env')
+    if not env:
+        env = os.environ
+    elif not kwargs.get('replace_env'):
+        env = env_cache.merged(env)
+    limit = arg_max() - ARG_HEADROOM
+    for k, v in env.items():
+        limit -= _arg_size(k + '=' + v)
+    # an over-estimate of the size of the rest of the command line
+    limit -= _arg_size(formatter.format(template, [])) * 2
+    if kwargs.get('shell'):
+        # the whole command line is a single argument
+        limit = min(limit, MAX_ARG_STRLEN - _arg_size(formatter.format(template, [])))
+    if limit <= 0:  # pragma: no cover
+        raise ValueError('no room for arguments')
+    # On Windows, the limit applies to the command line, in which the arguments
+    # are quoted.
+    quoted = kwargs.get('shell') or os.name == 'nt'
+    commands = (formatter.format(template, batch)
+                for batch in batch_arguments(items, limit, max_args, quoted))
+    return run_many(commands, max_workers=max_workers, **kwargs)
+
+
+def run_hedged(cmd, after=None, max_copies=2, percentile=95, histogram=None, **kwargs):
+    """
+    Run a command, starting a duplicate if it hasn't finished within a latency
+    threshold, and so on up to ``max_copies`` copies. This is for commands
+    which occasionally stall, and which can safely be run more than once at
+    the same time. The first copy to finish successfully wins, and the others
+    are killed. If none succeeds, the last one to finish is the result.
+
+    Each copy's ``stdout`` and ``stderr`` are captured in its own
+    :class:`Capture` instances, and the copies are run in their own process
+    groups so that any descendants are killed with them. Apart from the
+    keyword arguments described below, other keyword arguments are passed to
+    the created :class:`Pipeline` instances, as for `run()`.
+
+    Args:
+        cmd (str|list[str]): The command string or array of command/args.
+
+        after (float): How long to wait, in seconds, before starting another
+                       copy. If not specified, the ``percentile`` of the
+                       command's recent durations is used; until enough of
+                       those are known, no copies are started.
+
+        max_copies (int): The maximum number of copies to run.
+
+        percentile (float): The percentile of recent durations to use when
+                            ``after`` isn't specified.
+
+        histogram (LatencyHistogram): Where durations are kept. If not
+                                      specified, ``latency_histogram`` is used.
+
+        input (str|bytes): The input to pass to each copy's subprocess.
+
+    Returns:
+        Pipeline: The winning copy, which has been closed.
+    """
+    if max_copies < 1:
+        raise ValueError('max_copies must be at least 1')
+    if 'stdout' in kwargs or 'stderr' in kwargs:
+        raise ValueError('output is captured for each copy by run_hedged')
+    input = kwargs.pop('input', None)
+    on_complete = kwargs.pop('on_complete', None)
+    if histogram is None:
+        histogram = latency_histogram
+    signature = histogram.signature(cmd, kwargs.get('cwd'))
+    if after is None:
+        after = histogram.percentile(signature, percentile)
+    kwargs.setdefault('new_group', True)
+    done = threading.Condition()
+    finished = []
+    copies = []
+
+    def completed(p):
+        p.hedge_end = _clock()
+        with done:
+            finished.append(p)
+            done.notify()
+
+    def succeeded(p):
+        return bool(p.commands) and p.commands[-1].process is not None and p.returncode == 0
+
+    def start():
+        p = Pipeline(cmd, stdout=Capture(), stderr=Capture(), on_complete=completed, **kwargs)
+        p.hedge_start = _clock()
+        copies.append(p)
+        p.run(input=input, async_=True)
+        return p
+
+    deadline = None
+    if after is not None:
+        deadline = start().hedge_start + after
+    else:
+        start()
+    while True:
+        hedge = False
+        with done:
+            winner = None
+            for p in finished:
+                if succeeded(p):
+                    winner = p
+                    break
+            else:
+                if len(finished) == len(copies):
+                    # all have failed: hedging isn't retrying
+                    winner = finished[-1]
+            if winner is not None:
+                break
+            seen = len(finished)
+            if deadline is not None and len(copies) < max_copies:
+                while len(finished) == seen and _remaining(deadline):
+                    done.wait(_remaining(deadline))
+                hedge = len(finished) == seen
+            else:
+                while len(finished) == seen:
+                    done.wait()
+        if hedge:
+            logger.debug('hedging %s after %s', cmd, after)
+            with histogram.lock:
+                histogram.hedges += 1
+            deadline = start().hedge_start + after
+    with done:
+        ended = list(finished)
+    for p in copies:
+        if p is winner:
+            continue
+        if p in ended:
+            p.close()  # there's nothing left to stop
+        else:
+            # A copy which has finished by now isn't signalled, as
+            # cancel() only signals processes which haven't been reaped.
+            p.cancel(grace=0.1, group=True)
+    winner.close()
+    if succeeded(winner):
+        histogram.record(signature, winner.hedge_end - winner.hedge_start)
+        if winner is not copies[0]:
+            with histogram.lock:
+                histogram.hedge_wins += 1
+    if on_complete is not None:
+        _call_hook(on_complete, winner)
+    return winner
+
+
 def parse_command_line(source, posix=None):
     """
     Parse a command line into an AST.
@@ -1707,3 +5223,323 @@ def parse_command_line(source, posix=None):
     if posix is None:
         posix = os.name == 'posix'
     return CommandLineParser().parse(source, posix=posix)
+
+
+# The version of the serialized form of parse trees produced by dump_plan().
+PLAN_VERSION = 1
+
+_COMPOUND_NODES = {
+    'logical': (LogicalNode, ('|', '|&')),
+    'pipeline': (PipelineNode, ('&&', '||')),
+    'list': (ListNode, (';', '&')),
+}
+
+
+def _plan_node(node):
+    if node.kind == 'command':
+        redirects = []
+        for fd, (kind, target) in sorted(node.redirects.items()):
+            if isinstance(target, tuple):
+                target = target[1]  # ('&', fd)
+            elif not isinstance(target, string_types):
+                raise ValueError('cannot serialize redirection target: %r' % (target,))
+            redirects.append([fd, kind, target])
+        for word in node.command:
+            if not isinstance(word, string_types):
+                raise ValueError('cannot serialize command word: %r' % (word,))
+        return ['command', list(node.command), redirects]
+    return [node.kind, list(node.ops), [_plan_node(child) for child in node.children]]
+
+
+def dump_plan(source, posix=None):
+    """
+    Serialize a parsed command line, so that it can be loaded and run elsewhere
+    without being parsed again.
+
+    Args:
+        source (str|Node): The command line, or a tree returned by
+                           :func:`parse_command_line` or
+                           :meth:`PipelineTemplate.bind`.
+
+        posix (bool): Whether POSIX conventions are used in the lexer.
+
+    Returns:
+        str: The plan, as JSON text.
+    """
+    if isinstance(source, Node):
+        tree = source
+        source = getattr(tree, 'source', None)
+    else:
+        tree = parse_command_line(source, posix=posix)
+    plan = {'version': PLAN_VERSION, 'source': source, 'tree': _plan_node(tree)}
+    return json.dumps(plan, separators=(',', ':'), sort_keys=True)
+
+
+def _load_node(data):
+    if not isinstance(data, list) or len(data) != 3:
+        raise ValueError('invalid plan node: %r' % (data,))
+    kind, a, b = data
+    if kind == 'command':
+        if (not isinstance(a, list) or not a
+                or not all(isinstance(word, string_types) for word in a)):
+            raise ValueError('invalid command: %r' % (a,))
+        redirects = {}
+        for redirect in b:
+            try:
+                fd, rkind, target = redirect
+            except (TypeError, ValueError):
+                raise ValueError('invalid redirection: %r' % (redirect,))
+            if (not isinstance(fd, int) or isinstance(fd, bool) or fd in redirects
+                    or rkind not in ('>', '>>')):
+                raise ValueError('invalid redirection: %r' % (redirect,))
+            if isinstance(target, int) and not isinstance(target, bool):
+                if target < 0:
+                    # the parser only accepts an unsigned number after &
+                    raise ValueError('invalid redirection: %r' % (redirect,))
+                target = ('&', target)
+            elif not isinstance(target, string_types):
+                raise ValueError('invalid redirection: %r' % (redirect,))
+            redirects[fd] = (rkind, target)
+        if redirects != SWAP_OUTPUTS and set(redirects) - set((1, 2)):
+            raise ValueError('semantics: can only redirect stdout and stderr, '
+                             'not %s' % sorted(set(redirects) - set((1, 2))))
+        return CommandNode(a, redirects)
+    try:
+        cls, operators = _COMPOUND_NODES[kind]
+    except (KeyError, TypeError):
+        raise ValueError('invalid plan node kind: %r' % (kind,))
+    if (not isinstance(a, list) or not isinstance(b, list) or not a
+            or len(b) != len(a) + 1):
+        raise ValueError('invalid %s node: %r' % (kind, data))
+    for op in a:
+        if (not isinstance(op, int) or not 0 <= op < len(OPERATORS)
+                or OPERATORS[op] not in operators):
+            raise ValueError('invalid operator for %s node: %r' % (kind, op))
+    children = [_load_node(child) for child in b]
+    if cls is LogicalNode:
+        if any(child.kind != 'command' for child in children):
+            raise ValueError('invalid logical node: %r' % (data,))
+        for op, child in zip(a, children):
+            fd = 1 if OPERATORS[op] == '|' else 2
+            if fd in child.redirects and child.redirects != SWAP_OUTPUTS:
+                raise ValueError('semantics: cannot redirect and pipe the same stream')
+    return cls(children, a)
+
+
+def load_plan(data):
+    """
+    Load a command line serialized by :func:`dump_plan`, without parsing it.
+
+    Args:
+        data (str|bytes): The plan, as returned by :func:`dump_plan`.
+
+    Returns:
+        Node: A parse tree which can be passed to :class:`Pipeline`. Its
+              ``source`` attribute is the command line, if known.
+    """
+    if isinstance(data, bytes):
+        data = data.decode('utf-8')
+    plan = json.loads(data)
+    if not isinstance(plan, dict) or 'tree' not in plan:
+        raise ValueError('not a plan')
+    version = plan.get('version')
+    if version != PLAN_VERSION:
+        raise ValueError('unsupported plan version: %r' % (version,))
+    result = _load_node(plan['tree'])
+    source = plan.get('source')
+    if source is not None:
+        result.source = source
+    return result
+
+
+class _Slot(object):
+    """
+    This class represents a word of a command line template which contains
+    placeholders: a sequence of literal text and parameter keys.
+    """
+
+    __slots__ = ('pieces',)
+
+    def __init__(self, pieces):
+        self.pieces = pieces
+
+    def fill(self, values):
+        if len(self.pieces) == 1:
+            return values[self.pieces[0][1]]
+        return ''.join([values[k] if k is not None else text for text, k in self.pieces])
+
+    def __repr__(self):  # pragma: no cover
+        return '_Slot(%r)' % (self.pieces,)
+
+
+class PipelineTemplate(object):
+    """
+    This class represents a command line with placeholders for parameters,
+    which is parsed once so that it can be run many times with different
+    parameters without being parsed again. The placeholders are in
+    :meth:`str.format` style: ``{}``, ``{0}`` or ``{name}``, without
+    conversions or format specifications.
+
+    Parameters are bound directly into the words of the parsed command line,
+    so their values are never interpreted by the parser and don't need to be
+    quoted: a parameter can't add arguments, redirections or commands.
+
+    Args:
+        template (str): The command line template.
+        posix (bool): Whether POSIX conventions are used in the lexer.
+    """
+
+    sentinel = '__sarge_param_%d__'
+
+    def __init__(self, template, posix=None):
+        self.template = template
+        self.keys = []
+        chunks = []
+        auto = 0
+        for literal, field, spec, conversion in string.Formatter().parse(template):
+            chunks.append(literal)
+            if field is None:
+                continue
+            if spec or conversion:
+                raise ValueError('format specifications and conversions are '
+                                 'not supported: %r' % template)
+            if field == '':
+                key = auto
+                auto += 1
+            elif field.isdigit():
+                key = int(field)
+            elif re.match(r'^[A-Za-z_]\w*$', field):
+                key = field
+            else:
+                raise ValueError('invalid placeholder {%s} in %r' % (field, template))
+            if key not in self.keys:
+                self.keys.append(key)
+            chunks.append(self.sentinel % self.keys.index(key))
+        source = ''.join(chunks)
+        self.pattern = re.compile(self.sentinel.replace('%d', '(\\d+)'))
+        if self.pattern.search(template):
+            raise ValueError('template may not contain %r' % (self.sentinel % 0))
+        self.positional = sorted(k for k in self.keys if not isinstance(k, string_types))
+        if self.positional != list(range(len(self.positional))):
+            raise ValueError('positional placeholders must be numbered from 0: %r' % template)
+        self.tree = self._compile(parse_command_line(source, posix=posix))
+
+    def _slot(self, word):
+        # Return the word, or a _Slot if it contains placeholders.
+        if not isinstance(word, string_types) or '__sarge_param_' not in word:
+            return word
+        pieces = []
+        pos = 0
+        for m in self.pattern.finditer(word):
+            if m.start() > pos:
+                pieces.append((word[pos:m.start()], None))
+            pieces.append((None, self.keys[int(m.group(1))]))
+            pos = m.end()
+        if pos < len(word):
+            pieces.append((word[pos:], None))
+        return _Slot(tuple(pieces))
+
+    def _compile(self, node):
+        # Nodes with nothing to bind are shared by the trees bound from this
+        # one; the others are marked, to be copied when binding.
+        if node.kind != 'command':
+            children = tuple(self._compile(child) for child in node.children)
+            if all(a is b for a, b in zip(children, node.children)):
+                return node
+            return node.copy(children=children, slots=True)
+        command = [self._slot(word) for word in node.command]
+        redirects = node.redirects
+        if redirects != SWAP_OUTPUTS:
+            redirects = dict((fd, (pos, self._slot(fn))) for fd, (pos, fn) in redirects.items())
+        if not any(isinstance(w, _Slot) for w in command + [fn for pos, fn in redirects.values()]):
+            return node  # nothing to bind, so it can be shared
+        return node.copy(command=command, redirects=redirects, slots=True)
+
+    def _bind(self, node, values):
+        if not getattr(node, 'slots', False):
+            return node
+        if node.kind != 'command':
+            children = tuple(self._bind(child, values) for child in node.children)
+            return node.copy(children=children, slots=None)
+        command = [w.fill(values) if w.__class__ is _Slot else w for w in node.command]
+        redirects = node.redirects
+        if redirects and redirects != SWAP_OUTPUTS:
+            redirects = dict((fd, (pos, fn.fill(values) if fn.__class__ is _Slot else fn))
+                             for fd, (pos, fn) in redirects.items())
+        return node.copy(command=command, redirects=redirects, slots=None)
+
+    def bind(self, *args, **kwargs):
+        """
+        Bind parameters to the template.
+
+        Args:
+            args (list): The values of the positional placeholders.
+            kwargs (dict): The values of the named placeholders.
+
+        Returns:
+            Node: A parse tree which can be passed to :class:`Pipeline`.
+        """
+        if len(args) != len(self.positional):
+            raise ValueError('expected %d positional parameters, got %d' %
+                             (len(self.positional), len(args)))
+        values = {}
+        for k, v in enumerate(args):
+            values[k] = v if isinstance(v, string_types) else str(v)
+        for k in self.keys:
+            if isinstance(k, string_types):
+                try:
+                    v = kwargs[k]
+                except KeyError:
+                    raise ValueError('no value for parameter %r' % k)
+                values[k] = v if isinstance(v, string_types) else str(v)
+        # The template's text isn't the bound command line, so the result has
+        # no source.
+        return self._bind(self.tree, values).copy(source=None)
+
+    def pipeline(self, *args, **kwargs):
+        """
+        Bind parameters to the template and create a :class:`Pipeline` from
+        the result.
+
+        Args:
+            args (list): The values of the positional placeholders.
+            params (dict): The values of the named placeholders.
+            kwargs (dict): Passed to :class:`Pipeline`.
+
+        Returns:
+            Pipeline: The pipeline, which hasn't been run.
+        """
+        params = kwargs.pop('params', None) or {}
+        return Pipeline(self.bind(*args, **params), **kwargs)
+
+    def run(self, *args, **kwargs):
+        """
+        Bind parameters to the template and run the result, as `run()` does.
+
+        Args:
+            args (list): The values of the positional placeholders.
+            params (dict): The values of the named placeholders.
+            kwargs (dict): Passed to `run()`.
+
+        Returns:
+            Pipeline: The pipeline which was run.
+        """
+        params = kwargs.pop('params', None) or {}
+        return run(self.bind(*args, **params), **kwargs)
+
+
+def compile_pipeline(template, posix=None):
+    """
+    Parse a command line template once, for running many times with different
+    parameters.
+
+    Args:
+        template (str): The command line template, with placeholders as for
+                        :meth:`str.format`.
+
+        posix (bool): Whether POSIX conventions are used in the lexer.
+
+    Returns:
+        PipelineTemplate: The compiled template.
+    """
+    return PipelineTemplate(template, posix=posix)
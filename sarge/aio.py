@@ -0,0 +1,700 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2026 Vinay M. Sajip. See LICENSE for licensing information.
+#
+# An asyncio-based execution engine for sarge pipelines. Requires Python 3.5 or
+# later: import it explicitly, as it isn't imported by the sarge package itself.
+#
+import asyncio
+import errno
+import logging
+import os
+import subprocess
+import sys
+from io import BytesIO
+
+from . import (Capture, Pipeline, STDERR, SWAP_OUTPUTS, _apply_child_settings, _call_hook,
+               _emulate_process_group, _settings_preexec, _stop_process, ensure_stream,
+               env_cache)
+
+logger = logging.getLogger(__name__)
+
+__all__ = ['AsyncCommand', 'AsyncPipeline', 'run']
+
+# Popen keyword arguments which are handled by AsyncPipeline itself, or which
+# make no sense for asyncio subprocesses.
+_UNSUPPORTED_KWARGS = ('bufsize', 'fast_spawn', 'spawn_server')
+
+try:
+    _get_running_loop = asyncio.get_running_loop
+except AttributeError:  # pragma: no cover
+    # Python < 3.7, where get_event_loop() returns the running loop in a
+    # coroutine.
+    _get_running_loop = asyncio.get_event_loop
+
+
+class _StreamState(object):
+    """
+    Stands in for a child's output stream in a :class:`~sarge.Capture`'s list of
+    streams, so that synchronous reads on the capture know when no more data is
+    to be expected.
+    """
+    closed = False
+
+
+async def _feed_capture(capture, reader, state, source):
+    """
+    Read a child's output from an asyncio stream into a capture, in the same way
+    that the capture's reader threads would.
+    """
+    chunk_size = capture.buffer_size
+    command, name = source
+    first = command.on_first_output is not None
+    try:
+        while True:
+            if chunk_size < 0:
+                chunk = await reader.readline()
+            else:
+                chunk = await reader.read(chunk_size)
+            if not chunk:
+                break
+            if first:
+                first = False
+                _call_hook(command.on_first_output, command, name)
+            capture.buffer.put_nowait(chunk)
+            if capture.pattern and not capture.matched.is_set():
+                capture._try_match()
+    finally:
+        state.closed = True
+
+
+class AsyncCommand(object):
+    """
+    A command run by an :class:`AsyncPipeline`. This has the same attributes as
+    a :class:`~sarge.Command`, but its ``process`` is an
+    :class:`asyncio.subprocess.Process` and its :meth:`wait` method is a
+    coroutine.
+
+    Args:
+        args (str|list[str]): The command string or command/args to be run.
+
+        kwargs (dict): The keyword arguments used to create the process.
+    """
+
+    def __init__(self, args, **kwargs):
+        self.args = args
+        self.on_spawn = kwargs.pop('on_spawn', None)
+        self.on_first_output = kwargs.pop('on_first_output', None)
+        self.on_exit = kwargs.pop('on_exit', None)
+        self.spawn_limiter = (kwargs.pop('spawn_limiter', None)
+                              or sys.modules[__package__].default_spawn_limiter)
+        self.kwargs = kwargs
+        self.process = None
+        self.process_group = None
+        self.exception = None
+
+    def __repr__(self):  # pragma: no cover
+        if isinstance(self.args, str):
+            s = self.args
+        else:
+            s = ' '.join(self.args)
+        return '%s(%r)' % (self.__class__.__name__, s)
+
+    @property
+    def returncode(self):
+        return self.process.returncode if self.process else None
+
+    def poll(self):
+        """
+        Return the command's return code if it has terminated, else ``None``.
+        """
+        return self.returncode
+
+    async def wait(self):
+        """
+        Wait for the command's underlying sub-process to complete.
+
+        Returns:
+            int|None: The return code of the sub-process.
+        """
+        p = self.process
+        if p is None:  # pragma: no cover
+            logger.warning('No process found for %s', self)
+            return None
+        return await p.wait()
+
+    def terminate(self):
+        """
+        Terminate the command's underlying sub-process.
+        """
+        if not self.process:  # pragma: no cover
+            raise ValueError('There is no subprocess')
+        self.process.terminate()
+
+    def kill(self):
+        """
+        Kill the command's underlying sub-process.
+        """
+        if not self.process:  # pragma: no cover
+            raise ValueError('There is no subprocess')
+        self.process.kill()
+
+
+class AsyncPipeline(Pipeline):
+    """
+    A pipeline which runs on an asyncio event loop rather than in threads. It
+    accepts the same command lines and arguments as :class:`~sarge.Pipeline`, but
+    children are spawned and waited for using asyncio's subprocess support, the
+    pipes between them are created directly, and captured output is read by
+    tasks on the loop. Background (``&``) parts of a command line become tasks
+    too, so no helper threads are used by sarge.
+
+    The :meth:`run`, :meth:`wait` and :meth:`close` methods are coroutines.
+    Callbacks passed as ``on_spawn``, ``on_first_output``, ``on_exit`` and
+    ``on_complete`` are called from the event loop; ``on_complete`` is called
+    when the pipeline has been waited for.
+    """
+
+    def __init__(self, source, posix=None, **kwargs):
+        if kwargs.get('incremental'):
+            raise ValueError('Incremental pipelines are not supported by AsyncPipeline')
+        super(AsyncPipeline, self).__init__(source, posix, **kwargs)
+        self.tasks = []
+
+    def new_command(self, args, **kwargs):
+        """
+        Create a new :class:`AsyncCommand` from the provided arguments, and
+        append it to the list of commands.
+
+        Args:
+            args (list[str]): The command and arguments to be created.
+        """
+        cmd = AsyncCommand(args, **kwargs)
+        self.commands.append(cmd)
+        return cmd
+
+    async def run(self, input=None, async_=False):
+        """
+        Run the commands in the pipeline.
+
+        Args:
+            input (str|bytes|file): The data to pass to the command.
+            async_ (bool): If `True`, run the pipeline in a task and return
+                           without waiting for it.
+        """
+        self.commands = []
+        self.opened = []
+        self.tasks = []
+        self.node_commands = {}
+        self.node_exceptions = {}
+        self.cancelled = False
+        if async_:
+            self._add_task(self.run_node(self.tree, input, False))
+        else:
+            await self.run_node(self.tree, input, False)
+        return self
+
+    def _add_task(self, coro):
+        task = asyncio.ensure_future(coro)
+        self.tasks.append(task)
+        return task
+
+    @property
+    def returncodes(self):
+        """
+        A list of the return codes for all the commands which have been run.
+        """
+        return [c.returncode for c in self.commands]
+
+    async def wait(self):
+        """
+        Wait for all the commands in the pipeline, any background parts of it
+        and the reading of any captured output to complete.
+        """
+        logger.debug('pipeline waiting')
+        # Tasks may add further tasks and commands as they run.
+        done = 0
+        while done < len(self.tasks):
+            tasks = self.tasks[done:]
+            done = len(self.tasks)
+            await asyncio.gather(*tasks, return_exceptions=True)
+        for cmd in list(self.commands):
+            await cmd.wait()
+        if self.on_complete is not None and not self.completed:
+            self.completed = True
+            _call_hook(self.on_complete, self)
+
+    async def cancel(self, grace=1.0, group=False):
+        """
+        Cancel the pipeline, as :meth:`sarge.Pipeline.cancel` does. No more of
+        its commands are started, those which are running are terminated, and
+        any still running after ``grace`` seconds are killed. Tasks which are
+        still reading captured output after another ``grace`` seconds are
+        cancelled, and the pipeline is then closed.
+
+        Args:
+            grace (float): How long to wait, in seconds, after terminating the
+                           commands before killing them.
+            group (bool): If ``True``, also signal the process group of each
+                          command which was started in a new process group or
+                          session.
+        """
+        logger.debug('pipeline cancelling')
+        self.cancelled = True
+        self.cancel_kill = False
+        self.cancel_group = group
+        self._stop_commands()
+        waits = [asyncio.ensure_future(c.wait()) for c in self.commands if c.process is not None]
+        if waits:
+            await asyncio.wait(waits, timeout=grace)
+        self.cancel_kill = True
+        self._stop_commands()
+        loop = _get_running_loop()
+        deadline = loop.time() + grace
+        done = 0
+        while done < len(self.tasks):
+            tasks = self.tasks[done:]
+            done = len(self.tasks)
+            _, pending = await asyncio.wait(tasks, timeout=max(0, deadline - loop.time()))
+            for task in pending:
+                task.cancel()
+        await self.close()
+
+    async def close(self):
+        """
+        Close the pipeline. This waits for everything in it to complete, and then
+        closes all the opened streams.
+        """
+        logger.debug('pipeline closing')
+        try:
+            await self.wait()
+        finally:
+            for stream in self.opened:
+                stream.close()
+
+    def __enter__(self):
+        # close() is a coroutine, so a plain with statement couldn't close the
+        # pipeline.
+        raise TypeError('Use async with, not with, for an %s' % self.__class__.__name__)
+
+    def __exit__(self, *args):  # pragma: no cover
+        raise TypeError('Use async with, not with, for an %s' % self.__class__.__name__)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def run_node(self, node, input, async_):
+        """
+        This runs a single node in the parse tree.
+
+        Args:
+            node (Node): The node to run.
+
+            input (str|bytes|file): The data to pass to the command.
+
+            async_ (bool): If `True`, don't wait for the node to complete
+                           before returning.
+        """
+        method = 'run_%s_node' % node.kind
+        logger.debug('%s %s', method, async_)
+        try:
+            return await getattr(self, method)(node, input, async_)
+        except Exception as e:
+            logger.exception('Failed: %s', e)
+            self.node_exceptions[node] = e
+            raise
+
+    def get_status(self, node):
+        """
+        Get the return code for a node. For a node with multiple commands, the
+        return code of the last command is returned.
+
+        Args:
+            node (Node): The node to query.
+
+        Returns:
+            int|None: The return code for the node.
+        """
+        if node.kind != 'command':
+            node = self.find_last_command(node)
+        return self.node_commands[node].returncode
+
+    def _input_fd(self, input, to_close):
+        """
+        Return a file descriptor from which a child can read the specified input.
+        Data is written to a pipe by the event loop.
+        """
+        if input is None:
+            return None
+        input = ensure_stream(input)
+        if isinstance(input, BytesIO):
+            data = input.getvalue()[input.tell():]
+            r, w = os.pipe()
+            to_close.append(r)
+            self._add_task(self._write_input(w, data))
+            return r
+        if hasattr(input, 'fileno'):
+            return input.fileno()
+        return input
+
+    async def _write_input(self, fd, data):
+        loop = _get_running_loop()
+        transport, protocol = await loop.connect_write_pipe(asyncio.Protocol,
+                                                            os.fdopen(fd, 'wb', 0))
+        # Buffered data is flushed before the pipe is actually closed.
+        transport.write(data)
+        transport.close()
+
+    async def _capture_fd(self, capture, to_close, source):
+        """
+        Return the write end of a pipe whose read end is read into a capture by
+        a task on the event loop.
+        """
+        r, w = os.pipe()
+        to_close.append(w)
+        loop = _get_running_loop()
+        reader = asyncio.StreamReader()
+        protocol = asyncio.StreamReaderProtocol(reader)
+        transport, _ = await loop.connect_read_pipe(lambda: protocol, os.fdopen(r, 'rb', 0))
+        state = _StreamState()
+        capture.streams.append(state)
+
+        async def feed():
+            try:
+                await _feed_capture(capture, reader, state, source)
+            finally:
+                transport.close()
+
+        self._add_task(feed())
+        return w
+
+    async def _output_fd(self, target, to_close, source):
+        if isinstance(target, Capture):
+            return await self._capture_fd(target, to_close, source)
+        if target is None or isinstance(target, int):
+            return target
+        return target.fileno()
+
+    async def spawn(self, node, stdin, stdout, stderr, to_close):
+        """
+        Spawn the child process for a command node.
+
+        Args:
+            node (Node): The node to run.
+            stdin (int): A file descriptor for the child's stdin, or ``None``.
+            stdout: The child's stdout: ``None``, a file descriptor, a stream,
+                    a :class:`~sarge.Capture`, or ``sarge.STDERR``.
+            stderr: The child's stderr: ``None``, a file descriptor, a stream,
+                    a :class:`~sarge.Capture`, or ``subprocess.STDOUT``.
+            to_close (list[int]): File descriptors to close in the parent once
+                                  the child has been spawned.
+
+        Returns:
+            AsyncCommand: The command for the node.
+        """
+        kwargs = dict(self.kwargs)
+        for k in _UNSUPPORTED_KWARGS:
+            kwargs.pop(k, None)
+        replace_env = kwargs.pop('replace_env', False)
+        shell = kwargs.pop('shell', False)
+        env = kwargs.get('env')
+        if env and not replace_env:
+            kwargs['env'] = env_cache.merged(env)
+        if (self.new_group and kwargs.get('process_group') is None
+                and not kwargs.get('start_new_session')):
+            # The first command starts the group, and the others join it.
+            kwargs['process_group'] = self.process_group or 0
+        cmd = self.new_command(node.args, **kwargs)
+        self.node_commands[node] = cmd
+        try:
+            kwargs, settings = _apply_child_settings(cmd.kwargs)  # without the callbacks
+            kwargs = _settings_preexec(kwargs, settings)
+        except ValueError as e:
+            cmd.exception = e
+            raise
+        group = kwargs.get('process_group')
+        if stdout == STDERR and stderr == subprocess.STDOUT:
+            # swap the outputs: each goes where the other would have gone
+            out = await self._output_fd(self.stdout, to_close, (cmd, 'stderr'))
+            err = await self._output_fd(self.stderr, to_close, (cmd, 'stdout'))
+            out, err = (2 if err is None else err), (1 if out is None else out)
+        elif stdout == STDERR:
+            err = await self._output_fd(stderr, to_close, (cmd, 'stdout'))
+            out = 2 if err is None else err
+        elif stderr == subprocess.STDOUT:
+            out = await self._output_fd(stdout, to_close, (cmd, 'stdout'))
+            err = 1 if out is None else out
+        else:
+            out = await self._output_fd(stdout, to_close, (cmd, 'stdout'))
+            err = await self._output_fd(stderr, to_close, (cmd, 'stderr'))
+        logger.debug('About to spawn: %s, %s, %s, %s', node.command, stdin, out, err)
+        limiter = cmd.spawn_limiter
+        acquired = spawned = False
+        try:
+            if limiter is not None:
+                await self._acquire_slot(cmd, limiter)
+                acquired = True
+            try:
+                cmd.process = await self._create_process(node, shell, stdin, out, err,
+                                                         _emulate_process_group(kwargs))
+            except OSError as e:
+                if not group or e.errno != errno.EPERM:
+                    raise
+                # The group to join has gone, as all its members have exited:
+                # start a new one instead.
+                group = 0
+                kwargs = _emulate_process_group(dict(kwargs, process_group=0))
+                cmd.process = await self._create_process(node, shell, stdin, out, err, kwargs)
+            if kwargs.get('start_new_session'):
+                cmd.process_group = cmd.process.pid
+            elif group is not None:
+                cmd.process_group = group or cmd.process.pid
+            if self.new_group and self.process_group is None:
+                self.process_group = cmd.process_group
+            if self.cancelled:
+                # The pipeline was cancelled while this was being spawned.
+                _stop_process(cmd.process, self.cancel_kill,
+                              cmd.process_group if self.cancel_group else None)
+            spawned = True
+        except (OSError, subprocess.SubprocessError) as e:
+            if isinstance(e, OSError) and e.errno == errno.ENOENT:
+                e = ValueError('Command not found: %s' % node.command[0])
+            cmd.exception = e
+            raise e
+        finally:
+            for fd in to_close:
+                os.close(fd)
+            del to_close[:]
+            if acquired and not spawned:
+                limiter.failed(self)
+        if limiter is not None:
+            limiter.started(self, cmd.process)
+            self._add_task(self._release_slot(limiter, cmd.process))
+        if cmd.on_spawn is not None:
+            _call_hook(cmd.on_spawn, cmd)
+        if cmd.on_exit is not None:
+            self._add_task(self._notify_exit(cmd))
+        return cmd
+
+    def _create_process(self, node, shell, stdin, stdout, stderr, kwargs):
+        if shell:
+            return asyncio.create_subprocess_shell(node.command, stdin=stdin, stdout=stdout,
+                                                   stderr=stderr, **kwargs)
+        return asyncio.create_subprocess_exec(*node.command, stdin=stdin, stdout=stdout,
+                                              stderr=stderr, **kwargs)
+
+    async def _acquire_slot(self, cmd, limiter):
+        # SpawnLimiter.acquire() blocks, so try_acquire() is used instead. In
+        # between tries, this sleeps until the limiter says to try again: a
+        # freed slot wakes it early.
+        loop = _get_running_loop()
+        start = loop.time()
+        while True:
+            future = loop.create_future()
+
+            def wake(future=future):
+                if not future.done():
+                    future.set_result(None)
+
+            def waiter(wake=wake):
+                try:
+                    loop.call_soon_threadsafe(wake)
+                except RuntimeError:  # pragma: no cover
+                    pass  # the loop has been closed
+
+            try:
+                acquired, wait = limiter.try_acquire(self, loop.time() - start, waiter)
+            except ValueError as e:
+                cmd.exception = e
+                raise
+            if acquired:
+                return
+            try:
+                await asyncio.wait_for(future, wait)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _release_slot(self, limiter, process):
+        await process.wait()
+        limiter.exited(self, process)
+
+    async def _notify_exit(self, cmd):
+        returncode = await cmd.process.wait()
+        _call_hook(cmd.on_exit, cmd, returncode, None)
+
+    async def run_command_node(self, node, input, async_):
+        """
+        This runs a 'command' node in the parse tree.
+
+        Args:
+            node (Node): The node to run.
+
+            input (str|bytes|file): The data to pass to the command.
+
+            async_ (bool): If `True`, don't wait for the command to complete
+                           before returning.
+        """
+        if self.cancelled:
+            return
+        if node.redirects == SWAP_OUTPUTS:
+            stdout, stderr = STDERR, subprocess.STDOUT
+        else:
+            stdout, stderr = self.get_redirects(node)
+            if node is self.last:
+                if (self.stdout and stdout) or (self.stderr and stderr):
+                    raise ValueError('You cannot redirect one stream to two places')
+            stdout = stdout or self.stdout
+            stderr = stderr or self.stderr
+        to_close = []
+        stdin = self._input_fd(input, to_close)
+        cmd = await self.spawn(node, stdin, stdout, stderr, to_close)
+        if not async_:
+            await cmd.wait()
+
+    async def run_logical_node(self, node, input, async_):
+        """
+        This runs a 'logical' node (commands connected with ``|`` or ``|&``) in
+        the parse tree.
+
+        Args:
+            node (Node): The node to run.
+
+            input (str|bytes|file): The data to pass to the command.
+
+            async_ (bool): If `True`, don't wait for the last command to
+                           complete before returning.
+        """
+        parts = node.parts
+        last = len(parts) - 1
+        assert last > 1
+        to_close = []
+        stdin = self._input_fd(input, to_close)
+        cmd = None
+        i = 0
+        while i <= last and not self.cancelled:
+            curr = parts[i]
+            if curr.redirects == SWAP_OUTPUTS:
+                stdout, stderr = STDERR, subprocess.STDOUT
+            else:
+                stdout, stderr = self.get_redirects(curr)
+            next_stdin = None
+            if i < last:
+                r, w = os.pipe()
+                next_stdin = r
+                # As in a shell, an explicit redirection wins over the pipe.
+                if parts[i + 1].pipe == '|':
+                    if stdout == STDERR and stderr == subprocess.STDOUT:
+                        # As with Pipeline, a swapped child's stdout still
+                        # feeds the next command.
+                        stdout, stderr = w, None
+                    elif stdout is None:
+                        stdout = w
+                elif stderr is None:
+                    stderr = w
+                to_close.append(w)
+            if stdout != STDERR:
+                stdout = stdout or self.stdout
+            if stderr != subprocess.STDOUT:
+                stderr = stderr or self.stderr
+            if stdin is not None and i > 0:
+                to_close.append(stdin)
+            try:
+                cmd = await self.spawn(curr, stdin, stdout, stderr, to_close)
+            except Exception:
+                if next_stdin is not None:
+                    os.close(next_stdin)
+                raise
+            stdin = next_stdin
+            i += 2
+        if i <= last:
+            # Cancelled before all the commands were spawned
+            if i > 0:
+                os.close(stdin)
+            for fd in to_close:
+                os.close(fd)
+        if cmd is not None and not async_:
+            await cmd.wait()
+
+    async def run_pipeline_node(self, node, input, async_):
+        """
+        This runs a 'pipeline' node (commands connected with ``&&`` or ``||``)
+        in the parse tree.
+
+        Args:
+            node (Node): The node to run.
+
+            input (str|bytes|file): The data to pass to the command.
+
+            async_ (bool): If `True`, don't wait for the last part to complete
+                           before returning.
+        """
+        parts = node.parts
+        last = len(parts) - 1
+        assert last > 1
+        i = 0
+        while i <= last:
+            curr = parts[i]
+            # need to know the status of all but the last part
+            await self.run_node(curr, input, async_ if i == last else False)
+            input = None
+            if self.cancelled:
+                break
+            if i < last:
+                status = self.get_status(curr)
+                if (status != 0) == (parts[i + 1].check == '&&'):
+                    break
+            i += 2
+
+    async def run_list_node(self, node, input, async_):
+        """
+        This runs a 'list' node (commands separated with ``;`` or ``&``) in the
+        parse tree.
+
+        Args:
+            node (Node): The node to run.
+
+            input (str|bytes|file): The data to pass to the command.
+
+            async_ (bool): If `True`, don't wait for the last part to complete
+                           before returning.
+        """
+        parts = node.parts
+        last = len(parts) - 1
+        assert last > 1
+        i = 0
+        while i <= last and not self.cancelled:
+            curr = parts[i]
+            if i < last and parts[i + 1].sync == '&':
+                self._add_task(self.run_node(curr, input, False))
+            else:
+                await self.run_node(curr, input, async_ if i == last else False)
+            input = None
+            i += 2
+
+
+async def run(cmd, **kwargs):
+    """
+    Run a command line using an :class:`AsyncPipeline`. This is the asyncio
+    counterpart of :func:`sarge.run`.
+
+    Args:
+        cmd (str|list[str]): The command string or array or command/args to be run.
+
+        input (str|bytes|file): The input to pass to the command subprocess.
+
+        async_ (bool): If `True`, this returns once the pipeline has been
+                       started. Otherwise, it returns once everything in the
+                       pipeline has completed.
+    """
+    input = kwargs.pop('input', None)
+    async_ = kwargs.pop('async_', False)
+    p = AsyncPipeline(cmd, **kwargs)
+    if async_:
+        await p.run(input=input, async_=True)
+    else:
+        async with p:
+            await p.run(input=input)
+    return p
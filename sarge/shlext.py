@@ -5,6 +5,7 @@
 # Enhancements in shlex to tokenize closer to the way real shells do
 #
 from collections import deque
+import re
 import shlex
 import sys
 
@@ -205,3 +206,90 @@ class shell_shlex(shlex.shlex):
             else:
                 print("shlex: raw token=EOF")
         return result
+
+
+# Compiled regular expressions and other data for scan_tokens(), keyed by posix.
+_scanners = {}
+
+# The quoted and unquoted parts of a word, in POSIX mode.
+_posix_piece = re.compile('\'([^\']*)\'|"([^"]*)"|([^\'"]+)')
+
+
+def _get_scanner(posix):
+    result = _scanners.get(posix)
+    if result is None:
+        lex = shell_shlex('', posix=posix, control=True)
+        wordchars = lex.wordchars
+        if posix:
+            # A backslash is an escape, which scan_tokens() doesn't handle.
+            wordchars = wordchars.replace('\\', '')
+        w = ''.join(re.escape(c) for c in wordchars)
+        ctl = '[%s]+' % re.escape(lex.control)
+        if posix:
+            # Quoted text is part of the surrounding word, and the quotes are
+            # removed. A quote straight after a control character would be
+            # part of the control token, so that isn't matched.
+            word = '(?:[%s]|\'[^\']*\'|"[^"]*")+' % w
+            quoted = '(?!)'
+            ctl += '(?![\'"])'
+        else:
+            # Quotes are word characters within words, and otherwise delimit
+            # tokens which keep them.
+            word = '[%s][%s\'"]*' % (w, w)
+            quoted = '\'[^\']*\'|"[^"]*"'
+        # Each match is a token and the whitespace before it.
+        pattern = re.compile('([%s]*)(?:(%s)|(%s)|(%s))' % (re.escape(lex.whitespace), word,
+                                                            quoted, ctl))
+        unsupported = set(lex.commenters)
+        if posix:
+            unsupported.update(lex.escape)
+        result = _scanners[posix] = (pattern, unsupported, lex.whitespace)
+    return result
+
+
+def scan_tokens(source, posix):
+    """
+    Tokenize a command line as ``shell_shlex(source, posix=posix,
+    control=True)`` would, but using regular expressions to match whole tokens
+    at a time rather than a state machine which reads a character at a time.
+
+    Returns a list of the ``(token, token_type, preceding)`` values which
+    successive calls to the lexer's ``get_token()`` would produce, ending with
+    the end-of-input token, or ``None`` if the source uses something which
+    only ``shell_shlex`` handles: comments, escapes (in POSIX mode),
+    characters which are neither word characters, whitespace, quotes nor
+    control characters, unterminated quotes and, in POSIX mode, empty quotes
+    and quotes immediately after control characters.
+    """
+    if not PY3 or not isinstance(source, text_type):
+        return None
+    pattern, unsupported, whitespace = _get_scanner(posix)
+    if unsupported.intersection(source):
+        return None
+    result = []
+    append = result.append
+    pos = 0
+    for space, word, quoted, ctl in pattern.findall(source):
+        # The lexer's preceding attribute is the last whitespace character it
+        # read before the token.
+        preceding = space[-1:]
+        if word:
+            pos += len(space) + len(word)
+            if posix and ('"' in word or "'" in word):
+                word = ''.join([''.join(p) for p in _posix_piece.findall(word)])
+                if not word:
+                    return None  # the lexer's handling of these is quirky
+            append((word, 'a', preceding))
+        elif quoted:
+            pos += len(space) + len(quoted)
+            append((quoted, quoted[0], preceding))
+        else:
+            pos += len(space) + len(ctl)
+            append((ctl, 'c', preceding))
+    # findall() skips what it can't match, so check that only whitespace is
+    # left over.
+    rest = source[pos:]
+    if rest.strip(whitespace):
+        return None
+    append((None if posix else '', ' ', rest[-1:]))
+    return result
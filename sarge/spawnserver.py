@@ -0,0 +1,498 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2026 Vinay M. Sajip. See LICENSE for licensing information.
+#
+# A small helper process which spawns children on behalf of a (possibly large,
+# multi-threaded) parent process. The parent sends spawn requests over a Unix
+# socket, passing the child's standard streams as file descriptors using
+# SCM_RIGHTS. The server spawns the children, reaps them and reports their exit
+# statuses back to the parent.
+#
+import array
+import errno
+import json
+import logging
+import os
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+
+from . import ResourceUsage, _call_exit_callbacks, _settings_action
+
+logger = logging.getLogger(__name__)
+
+HEADER = struct.Struct('!I')
+
+# The Popen keyword arguments which can be honoured by the server. Commands using
+# others are spawned locally.
+SUPPORTED_KWARGS = frozenset(('stdin', 'stdout', 'stderr', 'env', 'cwd', 'shell', 'executable',
+                              'close_fds', 'bufsize', 'restore_signals', 'start_new_session',
+                              'fast_spawn'))
+if sys.version_info[:2] >= (3, 11):
+    SUPPORTED_KWARGS |= frozenset(('process_group',))
+
+available = (os.name == 'posix' and hasattr(socket, 'AF_UNIX')
+             and hasattr(socket.socket, 'sendmsg'))
+
+
+def send_message(sock, message, fds=()):
+    """
+    Send a message, optionally with some file descriptors.
+
+    Args:
+        sock (socket.socket): The socket to send on.
+        message (dict): The message, which must be serializable to JSON.
+        fds (list[int]): The file descriptors to send with the message.
+    """
+    data = json.dumps(message).encode('utf-8')
+    data = HEADER.pack(len(data)) + data
+    if fds:
+        ancillary = [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', fds))]
+    else:
+        ancillary = []
+    n = sock.sendmsg([data], ancillary)
+    if n < len(data):
+        sock.sendall(data[n:])
+
+
+def _recv_exactly(sock, size):
+    chunks = []
+    while size > 0:
+        chunk = sock.recv(size)
+        if not chunk:
+            raise EOFError('connection closed')
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def recv_message(sock, maxfds=3):
+    """
+    Receive a message, together with any file descriptors sent with it.
+
+    Args:
+        sock (socket.socket): The socket to receive from.
+        maxfds (int): The maximum number of file descriptors expected.
+
+    Returns:
+        tuple: The message (a dict) and a list of the file descriptors received.
+    """
+    fds = array.array('i')
+    data, ancillary, flags, addr = sock.recvmsg(HEADER.size,
+                                                socket.CMSG_SPACE(maxfds * fds.itemsize))
+    for level, kind, cdata in ancillary:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            cdata = cdata[:len(cdata) - (len(cdata) % fds.itemsize)]
+            fds.frombytes(cdata)
+    if not data:
+        raise EOFError('connection closed')
+    if len(data) < HEADER.size:
+        data += _recv_exactly(sock, HEADER.size - len(data))
+    size = HEADER.unpack(data)[0]
+    message = json.loads(_recv_exactly(sock, size).decode('utf-8'))
+    return message, list(fds)
+
+
+def _returncode(status):
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+class Server(object):
+    """
+    The server side, which runs in the helper process.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.lock = threading.Lock()
+        self.children_present = threading.Condition(self.lock)
+        self.children = {}
+
+    def send(self, message):
+        # callers hold the lock, so that messages are never interleaved
+        send_message(self.sock, message)
+
+    def reap(self):
+        """
+        Reap children as they exit and report their exit statuses. This runs in
+        its own thread.
+        """
+        while True:
+            with self.lock:
+                while not self.children:
+                    self.children_present.wait()
+            try:
+                # Find an exited child without reaping it, so that its pid
+                # can't be reused while it's still in self.children.
+                info = os.waitid(os.P_ALL, 0, os.WEXITED | os.WNOWAIT)
+            except ChildProcessError:
+                # The children we know of have all been reaped elsewhere (for
+                # example, by subprocess after a failed spawn).
+                with self.lock:
+                    for pid in list(self.children):
+                        self.exited(pid, None, None)
+                continue
+            except InterruptedError:  # pragma: no cover
+                continue
+            if info is None:  # pragma: no cover
+                continue
+            pid = info.si_pid
+            with self.lock:
+                try:
+                    _, status, ru = os.wait4(pid, 0)
+                except ChildProcessError:
+                    status = ru = None  # already reaped elsewhere
+                self.exited(pid, status, ru)
+
+    def exited(self, pid, status, ru):
+        # Called with the lock held, to report that a child has exited. If it
+        # was reaped elsewhere, status and ru are None.
+        p = self.children.pop(pid, None)
+        if p is None:
+            return
+        if status is not None:
+            p.returncode = rc = _returncode(status)
+            rusage = [ru.ru_utime, ru.ru_stime, ru.ru_maxrss, ru.ru_nvcsw, ru.ru_nivcsw,
+                      ru.ru_inblock, ru.ru_oublock]
+        else:
+            # As for subprocess, when a child's status can't be got
+            rc = p.returncode if p.returncode is not None else 0
+            rusage = [0.0, 0.0, 0, 0, 0, 0, 0]
+        self.send({'op': 'exit', 'pid': pid, 'returncode': rc, 'rusage': rusage})
+
+    def spawn(self, request, fds):
+        streams = {}
+        for name in request['fds']:
+            streams[name] = fds.pop(0)
+        kwargs = {}
+        if request.get('process_group') is not None:
+            kwargs['process_group'] = request['process_group']
+        if request.get('settings'):
+            # Applied in the child before it execs
+            kwargs['preexec_fn'] = _settings_action(request['settings'])
+        try:
+            with self.lock:
+                try:
+                    p = subprocess.Popen(request['args'], executable=request.get('executable'),
+                                         env=request.get('env'), cwd=request.get('cwd'),
+                                         restore_signals=request.get('restore_signals', True),
+                                         start_new_session=request.get('start_new_session', False),
+                                         stdin=streams.get('stdin'), stdout=streams.get('stdout'),
+                                         stderr=streams.get('stderr'), **kwargs)
+                except (OSError, subprocess.SubprocessError) as e:
+                    self.send({'op': 'spawned', 'id': request['id'],
+                               'errno': getattr(e, 'errno', None), 'error': str(e)})
+                else:
+                    self.children[p.pid] = p
+                    self.children_present.notify()
+                    self.send({'op': 'spawned', 'id': request['id'], 'pid': p.pid})
+        finally:
+            for fd in streams.values():
+                os.close(fd)
+
+    def signal(self, request):
+        # Children are only reaped with the lock held, so one which is in
+        # self.children (and its process group) can be signalled safely.
+        with self.lock:
+            if request['pid'] in self.children:
+                if request.get('group'):
+                    try:
+                        os.killpg(request['group'], request['signal'])
+                    except OSError:  # pragma: no cover
+                        pass
+                else:
+                    os.kill(request['pid'], request['signal'])
+
+    def serve(self):
+        t = threading.Thread(target=self.reap)
+        t.daemon = True
+        t.start()
+        while True:
+            try:
+                request, fds = recv_message(self.sock)
+            except EOFError:
+                break
+            op = request['op']
+            if op == 'spawn':
+                self.spawn(request, fds)
+            elif op == 'signal':
+                self.signal(request)
+            else:  # pragma: no cover
+                logger.warning('unknown request: %s', request)
+
+
+def serve(fd):
+    """
+    Run the server on the socket with the specified file descriptor. This
+    returns when the other end of the socket is closed.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM, fileno=fd)
+    Server(sock).serve()
+
+
+class RemoteProcess(object):
+    """
+    This represents a child process spawned by a :class:`SpawnServer`. It
+    provides the parts of the :class:`subprocess.Popen` interface used by
+    sarge.
+    """
+
+    def __init__(self, server, args):
+        self.server = server
+        self.args = args
+        self.pid = None
+        self.returncode = None
+        self.stdin = self.stdout = self.stderr = None
+        self.exited = threading.Event()
+        self.exit_callbacks = None
+        self.exit_caller = None
+        self.resource_usage = None
+        self.start_time = time.time()
+        self.end_time = None
+
+    def poll(self):
+        return self.returncode
+
+    def wait(self, timeout=None):
+        if not self.exited.wait(timeout):
+            raise subprocess.TimeoutExpired(self.args, timeout)
+        if self.returncode is None:
+            raise OSError(errno.ECHILD, 'spawn server exited before child %s' % self.pid)
+        # The exit callbacks may still be being called by the reader thread.
+        _call_exit_callbacks(self, True)
+        return self.returncode
+
+    def send_signal(self, sig):
+        if self.returncode is None:
+            self.server.signal(self.pid, sig)
+
+    def signal_group(self, pgid, sig):
+        """
+        Signal a process group which this process is in, provided the server
+        hasn't yet reaped this process.
+        """
+        if self.returncode is None:
+            self.server.signal(self.pid, sig, pgid)
+
+    def terminate(self):
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+
+    def __repr__(self):  # pragma: no cover
+        return '%s(pid=%s returncode=%s)' % (self.__class__.__name__, self.pid, self.returncode)
+
+
+class SpawnServer(object):
+    """
+    The client side of a spawn server. Create an instance and call
+    :meth:`start` early in the life of your process, while it's still small.
+    Then pass it as the ``spawn_server`` keyword argument to :class:`Command`,
+    :class:`Pipeline` or :func:`run`, or set it as the module attribute
+    ``sarge.default_spawn_server``.
+    """
+
+    def __init__(self):
+        self.sock = None
+        self.process = None
+        self.lock = threading.Lock()
+        self.counter = 0
+        self.pending = {}
+        self.processes = {}
+
+    def start(self):
+        """
+        Start the helper process.
+        """
+        if not available:  # pragma: no cover
+            raise OSError(errno.ENOSYS, 'A spawn server is not available on this platform')
+        ours, theirs = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        code = 'import sys; sys.path.insert(0, %r); from sarge.spawnserver import serve; serve(%d)'
+        try:
+            self.process = subprocess.Popen([sys.executable, '-c', code % (path, theirs.fileno())],
+                                            pass_fds=(theirs.fileno(), ), stdin=subprocess.DEVNULL)
+        finally:
+            theirs.close()
+        self.sock = ours
+        t = threading.Thread(target=self.reader)
+        t.daemon = True
+        t.start()
+        return self
+
+    def stop(self):
+        """
+        Stop the helper process. Children which are still running are not
+        affected, but their exit statuses will no longer be available.
+        """
+        if self.sock is not None:
+            self.sock.shutdown(socket.SHUT_RDWR)
+            self.sock.close()
+            self.sock = None
+            self.process.wait()
+
+    def can_spawn(self, kwargs):
+        """
+        See if the server can honour a set of :class:`subprocess.Popen`
+        keyword arguments.
+        """
+        if self.sock is None:
+            return False
+        for k, v in kwargs.items():
+            if v and k not in SUPPORTED_KWARGS:
+                return False
+        return True
+
+    def reader(self):
+        sock = self.sock
+        while True:
+            try:
+                message, fds = recv_message(sock, 0)
+            except (EOFError, OSError):
+                break
+            op = message['op']
+            exited = None
+            with self.lock:
+                if op == 'spawned':
+                    done, p, result = self.pending.pop(message['id'])
+                    result.append(message)
+                    if 'pid' in message:
+                        # register now, as the exit message could be next
+                        p.pid = message['pid']
+                        self.processes[p.pid] = p
+                    done.set()
+                elif op == 'exit':
+                    p = self.processes.pop(message['pid'], None)
+                    if p is not None:
+                        p.returncode = message['returncode']
+                        p.resource_usage = ResourceUsage(*message['rusage'])
+                        p.end_time = time.time()
+                        p.exited.set()
+                        tracer = sys.modules[__package__].tracer
+                        if tracer is not None:
+                            tracer.exited(p)
+                        exited = p
+            # Run exit callbacks outside the lock, as they may spawn more children
+            if exited is not None:
+                _call_exit_callbacks(exited)
+        # The server has gone away: release anyone still waiting.
+        with self.lock:
+            for done, p, result in self.pending.values():
+                done.set()
+            self.pending.clear()
+            for p in self.processes.values():
+                p.exited.set()
+            self.processes.clear()
+
+    def signal(self, pid, sig, group=None):
+        with self.lock:
+            send_message(self.sock, {'op': 'signal', 'pid': pid, 'signal': int(sig),
+                                     'group': group})
+
+    def spawn(self, args, settings=None, **kwargs):
+        """
+        Spawn a child process, taking the same arguments as
+        :class:`subprocess.Popen` (though only some keyword arguments are
+        supported - see :meth:`can_spawn`). Returns a :class:`RemoteProcess`.
+        Any resource limits and scheduling settings, as prepared by
+        :class:`~sarge.Command`, are applied in the child before it execs.
+        """
+        from . import STDERR
+
+        if kwargs.get('shell'):
+            if not isinstance(args, str):
+                args = ' '.join(args)
+            args = ['/bin/sh', '-c', args]
+        elif isinstance(args, str):
+            args = [args]
+        else:
+            args = list(args)
+        bufsize = kwargs.get('bufsize', -1)
+        to_close = []  # fds to close in this process once the child is spawned
+        parents = {}  # our ends of any pipes
+
+        def child_fd(name, value, default):
+            if value is None:
+                return default
+            if value == subprocess.PIPE:
+                r, w = os.pipe()
+                if name == 'stdin':
+                    parents[name] = (w, 'wb')
+                    to_close.append(r)
+                    return r
+                parents[name] = (r, 'rb')
+                to_close.append(w)
+                return w
+            if value == subprocess.DEVNULL:
+                fd = os.open(os.devnull, os.O_RDWR)
+                to_close.append(fd)
+                return fd
+            if hasattr(value, 'fileno'):
+                return value.fileno()
+            return value
+
+        stdin, stdout, stderr = kwargs.get('stdin'), kwargs.get('stdout'), kwargs.get('stderr')
+        fds = {'stdin': child_fd('stdin', stdin, 0)}
+        if stdout == STDERR and stderr == subprocess.STDOUT:
+            # swap the output streams, as sarge's Popen does
+            fds['stdout'] = child_fd('stderr', subprocess.PIPE, None)
+            fds['stderr'] = child_fd('stdout', subprocess.PIPE, None)
+        elif stdout == STDERR:
+            fds['stderr'] = child_fd('stderr', stderr, 2)
+            fds['stdout'] = fds['stderr']
+            if 'stderr' in parents:
+                fd, mode = parents['stderr']
+                parents['stdout'] = (os.dup(fd), mode)
+        else:
+            fds['stdout'] = child_fd('stdout', stdout, 1)
+            if stderr == subprocess.STDOUT:
+                fds['stderr'] = fds['stdout']
+            else:
+                fds['stderr'] = child_fd('stderr', stderr, 2)
+        names = ('stdin', 'stdout', 'stderr')
+        request = {
+            'op': 'spawn',
+            'args': args,
+            'executable': kwargs.get('executable'),
+            'env': None if kwargs.get('env') is None else dict(kwargs['env']),
+            'cwd': kwargs.get('cwd'),
+            'restore_signals': kwargs.get('restore_signals', True),
+            'start_new_session': kwargs.get('start_new_session', False),
+            'process_group': kwargs.get('process_group'),
+            'settings': settings,
+            'fds': names,
+        }
+        p = RemoteProcess(self, args)
+        done = threading.Event()
+        result = []
+        try:
+            with self.lock:
+                if self.sock is None:
+                    raise OSError(errno.EPIPE, 'spawn server is not running')
+                self.counter += 1
+                request['id'] = self.counter
+                self.pending[self.counter] = (done, p, result)
+                send_message(self.sock, request, [fds[name] for name in names])
+            done.wait()
+        finally:
+            for fd in to_close:
+                os.close(fd)
+        if not result or 'pid' not in result[0]:
+            for fd, mode in parents.values():
+                os.close(fd)
+            if not result:
+                raise OSError(errno.EPIPE, 'spawn server exited')
+            if result[0]['errno'] is None:
+                # the settings couldn't be applied in the child
+                raise subprocess.SubprocessError(result[0]['error'])
+            raise OSError(result[0]['errno'], result[0]['error'])
+        for name, (fd, mode) in parents.items():
+            setattr(p, name, os.fdopen(fd, mode, bufsize))
+        return p
@@ -4,10 +4,12 @@
 #
 # sarge: Subprocess Allegedly Rewards Good Encapsulation :-)
 #
+from collections import OrderedDict
 import os
 import re
 import sys
 import threading
+import time
 
 try:
     from shutil import which
@@ -76,6 +78,179 @@ except ImportError:
         return None
 
 
+def _mtime(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return getattr(st, 'st_mtime_ns', st.st_mtime)
+
+
+def _file_state(path):
+    # Enough of a file's status to tell if it's been replaced, rewritten or
+    # had its permissions changed.
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return getattr(st, 'st_mtime_ns', st.st_mtime), st.st_ino, st.st_mode
+
+
+class ExecutableCache(object):
+    """
+    This class caches the results of looking up executables on a search path.
+    A result is reused until the modification time of one of the directories
+    searched to obtain it changes, which happens when entries are added to,
+    removed from or renamed in that directory. Checking this takes one
+    ``stat()`` per directory, rather than several per directory for a fresh
+    search, and is done at most once every ``check_interval`` seconds. The
+    executable found is also checked, with one ``stat()``, each time the
+    result is reused: if its modification time, inode or mode has changed, the
+    search is done again.
+
+    Args:
+        maxsize (int): The maximum number of results to keep.
+        check_interval (float): The minimum time between checks of whether a
+                                result is still valid.
+    """
+
+    def __init__(self, maxsize=256, check_interval=1.0):
+        self.maxsize = maxsize
+        self.check_interval = check_interval
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.path_dirs = {}
+        self.hits = self.misses = 0
+
+    def clear(self):
+        """
+        Discard all cached results.
+        """
+        with self.lock:
+            self.entries.clear()
+            self.path_dirs.clear()
+
+    def find(self, cmd, path=None, cwd=None):
+        """
+        Find an executable on a search path.
+
+        Args:
+            cmd (str): The name of the executable. If it has a directory part,
+                       it's returned unchanged.
+            path (str): The search path, which defaults to the ``PATH`` in
+                        ``os.environ``.
+            cwd (str): The directory which relative directories in ``path`` are
+                       relative to. It defaults to the current directory.
+
+        Returns:
+            str|None: The path to the executable, or ``None`` if not found.
+        """
+        if os.path.dirname(cmd):
+            return cmd
+        if path is None:
+            path = os.environ.get('PATH', os.defpath)
+        with self.lock:
+            dirs = self.path_dirs.get(path)
+        if dirs is None:
+            dirs = path.split(os.pathsep)
+            if sys.platform == 'win32':  # pragma: no cover
+                # The current directory takes precedence on Windows.
+                if os.curdir not in dirs:
+                    dirs.insert(0, os.curdir)
+            dirs = (dirs, all(os.path.isabs(d) for d in dirs))
+            with self.lock:
+                if len(self.path_dirs) >= self.maxsize:
+                    self.path_dirs.clear()
+                self.path_dirs[path] = dirs
+        dirs, absolute = dirs
+        # The current directory only matters if there are relative entries.
+        if absolute:
+            cwd = None
+        elif cwd is None:
+            cwd = os.getcwd()
+        key = (cmd, path, cwd)
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.entries[key] = entry  # now the most recently used
+        if entry is not None:
+            result, mtimes, state, checked = entry
+            valid = result is None or _file_state(result) == state
+            now = None
+            if valid and time.time() - checked >= self.check_interval:
+                now = time.time()
+                valid = all(_mtime(d) == m for d, m in mtimes)
+            if valid:
+                with self.lock:
+                    self.hits += 1
+                    if now is not None and key in self.entries:
+                        self.entries[key] = (result, mtimes, state, now)
+                return result
+        with self.lock:
+            self.misses += 1
+        result = None
+        mtimes = []
+        seen = set()
+        for d in dirs:
+            if cwd is not None:
+                d = os.path.join(cwd, d)
+            normdir = os.path.normcase(d)
+            if normdir in seen:
+                continue
+            seen.add(normdir)
+            mtimes.append((d, _mtime(d)))
+            result = which(cmd, path=d)
+            if result:
+                break
+        state = None if result is None else _file_state(result)
+        with self.lock:
+            self.entries[key] = (result, tuple(mtimes), state, time.time())
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+        return result
+
+
+executable_cache = ExecutableCache()
+
+
+def pipe_holders(fd):
+    """
+    Find the processes, other than this one, which have a pipe open. This uses
+    ``/proc``, so it's only available on Linux; elsewhere, ``None`` is returned.
+
+    Args:
+        fd (int): A file descriptor for either end of the pipe.
+
+    Returns:
+        list[int]|None: The IDs of the processes which have either end of the
+                        pipe open.
+    """
+    if not os.path.isdir('/proc/self/fd'):
+        return None
+    try:
+        target = 'pipe:[%d]' % os.fstat(fd).st_ino
+    except OSError:
+        return []
+    me = os.getpid()
+    result = []
+    for name in os.listdir('/proc'):
+        if not name.isdigit() or int(name) == me:
+            continue
+        fddir = os.path.join('/proc', name, 'fd')
+        try:
+            fds = os.listdir(fddir)
+        except OSError:
+            continue  # it has exited, or isn't ours to look at
+        for n in fds:
+            try:
+                if os.readlink(os.path.join(fddir, n)) == target:
+                    result.append(int(name))
+                    break
+            except OSError:
+                continue
+    return sorted(result)
+
+
 if sys.platform == 'win32':
     try:
         import winreg
@@ -96,7 +271,7 @@ if sys.platform == 'win32':
                   (r'c:/Python/python.exe', r'c:/MyTools/hello.py').
         """
         result = None
-        cmd = which(cmd)
+        cmd = executable_cache.find(cmd)
         if cmd:
             if cmd.startswith('.\\'):  # pragma: no cover
                 cmd = cmd[2:]
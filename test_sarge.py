@@ -8,6 +8,7 @@
 from __future__ import unicode_literals
 
 from io import TextIOWrapper
+import json
 import logging
 import os
 import re
@@ -18,10 +19,11 @@ import tempfile
 import time
 import unittest
 
+import sarge
 from sarge import (shell_quote, Capture, Command, CommandLineParser, Pipeline, shell_format, run,
                    parse_command_line, capture_stdout, get_stdout, capture_stderr, get_stderr,
-                   capture_both, get_both, Popen, Feeder)
-from sarge.shlext import shell_shlex
+                   capture_both, get_both, Popen, Feeder, run_many, run_batched)
+from sarge.shlext import scan_tokens, shell_shlex
 from stack_tracer import start_trace, stop_trace
 
 if sys.platform == 'win32':  # pragma: no cover
@@ -259,6 +261,28 @@ class SargeTest(unittest.TestCase):
         self.assertEqual(dk, ek)
         self.assertEqual(dk, {'FOO'})
 
+    def test_env_cache(self):
+        env = {str('SARGE_TEST_FOO'): str('BAR')}
+        c1 = Command('echo foo', env=env)
+        c2 = Command('echo foo', env=dict(env))
+        self.assertEqual(c1.kwargs['env'], c2.kwargs['env'])
+        # Each command has its own environment, which can be changed
+        self.assertIsNot(c1.kwargs['env'], c2.kwargs['env'])
+        c1.kwargs['env']['X'] = 'Y'
+        self.assertNotIn('X', c2.kwargs['env'])
+        self.assertNotIn('X', Command('echo foo', env=env).kwargs['env'])
+        os.environ[str('SARGE_TEST_BAZ')] = str('QUUX')
+        try:
+            c3 = Command('echo foo', env=env)
+            self.assertIsNot(c1.kwargs['env'], c3.kwargs['env'])
+            self.assertEqual(c3.kwargs['env']['SARGE_TEST_BAZ'], 'QUUX')
+            self.assertNotIn('SARGE_TEST_BAZ', c1.kwargs['env'])
+        finally:
+            del os.environ[str('SARGE_TEST_BAZ')]
+        c4 = Command('echo foo', env={str('SARGE_TEST_FOO'): str('BAZ')})
+        self.assertEqual(c4.kwargs['env']['SARGE_TEST_FOO'], 'BAZ')
+        self.assertEqual(get_stdout('echo $SARGE_TEST_FOO', env=env, shell=True), 'BAR\n')
+
     def test_env_usage(self):
         if os.name == 'nt':
             cmd = 'echo %FOO%'
@@ -353,6 +377,66 @@ class SargeTest(unittest.TestCase):
         actual = list(shell_shlex(cmd))
         self.assertEqual(actual, ['ls', 'foo,bar'])
 
+    def test_scan_tokens(self):
+        import random
+
+        def tokens(source, posix, use_scanner):
+            parser = CommandLineParser()
+            parser.use_scanner = use_scanner
+            result = []
+            try:
+                parser._parse('', posix)  # to set up the parser's state
+                raw = scan_tokens(source, posix) if use_scanner else None
+                if raw is None:
+                    parser.lex = shell_shlex(source, posix=posix, control=True)
+                else:
+                    parser.tokens = iter(parser.classify_tokens(raw))
+                eofs = 0
+                while eofs < 3:
+                    t = parser.next_token()
+                    result.append(t)
+                    if t[0] is None:
+                        eofs += 1
+            except ValueError as e:
+                result.append(str(e))
+            return result
+
+        def parse(source, posix, use_scanner):
+            parser = CommandLineParser()
+            parser.use_scanner = use_scanner
+            try:
+                return repr(parser._parse(source, posix))
+            except Exception as e:  # the parser raises IndexError for some input
+                return '%s: %s' % (type(e).__name__, e)
+
+        sources = ['', ' ', 'a', 'a && b\n', 'a | b; c>/fred/jim-sheila.txt|&d;e&',
+                   'echo foo 2>&1 >> out.txt; (a || b) &', '"a b" c', 'a"b c"d \'e\' |& f',
+                   'x=1 y:2 a,b+c %d @e', '"a" "b"c"d"', '(a;b)|c', 'a >& 2', '12 34>x',
+                   '"ab""cd"', "'x' | \"y\"", 'a\tb\r\nc', 'ßàá', '|| &&& >>> |&|']
+        rng = random.Random(0)
+        chars = list('ab12 \t\n\'"|&;()<>-./=$é') + ['foo', '2>', '>&', '&&', '||']
+        for i in range(2000):
+            sources.append(''.join(rng.choice(chars) for j in range(rng.randint(0, 12))))
+        scanned = 0
+        for posix in (False, True):
+            for source in sources:
+                expected = tokens(source, posix, False)
+                if scan_tokens(source, posix) is not None:
+                    scanned += 1
+                    self.assertEqual(tokens(source, posix, True), expected,
+                                     'tokens differ for %r (posix=%s)' % (source, posix))
+                    self.assertEqual(parse(source, posix, True), parse(source, posix, False))
+        self.assertGreater(scanned, 1000)
+        # What the scanner doesn't handle is left to shell_shlex
+        for source, posix in (('a # comment', True), ('a\\ b', True), ('a!b', False),
+                              ('"abc', True), ('|"x"', True), ("a '' b", True)):
+            self.assertIsNone(scan_tokens(source, posix))
+        self.assertIsNotNone(scan_tokens('c:\\Python26\\Python lister.py', False))
+        # Long generated command lines are scanned
+        source = 'ls -l %s | sort > out.txt' % ' '.join('file-%05d.txt' % i for i in range(5000))
+        self.assertIsNotNone(scan_tokens(source, True))
+        self.assertEqual(parse(source, True, True), parse(source, True, False))
+
     def test_parsing(self):
         parse_command_line('abc')
         parse_command_line('abc " " # comment')
@@ -413,6 +497,79 @@ class SargeTest(unittest.TestCase):
         self.assertRaises(ValueError, parse_command_line, 'a 2>> b 2>> c')
         self.assertRaises(ValueError, parse_command_line, 'a 3> b')
 
+    def test_parse_nodes(self):
+        t = parse_command_line('a |& b 2>&1 | c && d || e; f & g', posix=True)
+        self.assertIsInstance(t, sarge.ListNode)
+        self.assertEqual(t.ops, (sarge.OPCODES[';'], sarge.OPCODES['&']))
+        pipeline = t.children[0]
+        self.assertIsInstance(pipeline, sarge.PipelineNode)
+        self.assertEqual([sarge.OPERATORS[op] for op in pipeline.ops], ['&&', '||'])
+        logical = pipeline.children[0]
+        self.assertEqual(logical.kind, 'logical')
+        self.assertEqual([c.command for c in logical.children], [['a'], ['b'], ['c']])
+        self.assertEqual(logical.children[1].redirects, {2: ('>', ('&', 1))})
+        # The parts view interleaves shared separator nodes
+        parts = logical.parts
+        self.assertEqual(len(parts), 5)
+        self.assertIs(parts[2], logical.children[1])
+        self.assertEqual((parts[1].kind, parts[1].pipe), ('pipe', '|&'))
+        self.assertEqual(parts[3].pipe, '|')
+        self.assertIs(parts[3], parse_command_line('x | y').parts[1])
+        self.assertEqual([p.check for p in pipeline.parts[1::2]], ['&&', '||'])
+        self.assertEqual([p.sync for p in t.parts[1::2]], [';', '&'])
+        self.assertEqual(repr(t.parts[1]), 'SyncNode(sync=;)')
+        self.assertEqual(repr(logical.children[0]), "CommandNode(command=['a'] redirects={})")
+        # Nodes have no __dict__
+        for node in [t, logical, logical.children[0], parts[1]]:
+            self.assertFalse(hasattr(node, '__dict__'))
+        self.assertRaises(AttributeError, setattr, logical, 'cmd', None)
+        # Copies can replace or unset attributes
+        c = logical.children[0].copy(command=['z'], source='z')
+        self.assertEqual((c.command, c.redirects, c.source), (['z'], {}, 'z'))
+        self.assertFalse(hasattr(c.copy(source=None), 'source'))
+        # Trees are shared through the parse cache, so commands run for them
+        # are given copies of their command lists
+        node = parse_command_line('a b 2> c | d').children[0]
+        self.assertIs(node, parse_command_line('a b 2> c | d').children[0])
+        self.assertEqual(node.args, ['a', 'b'])
+        self.assertIsNot(node.args, node.command)
+        p = run('echo foo | cat', stdout=Capture())
+        p.commands[0].args.append('bar')
+        self.assertEqual(capture_stdout('echo foo | cat').stdout.text, 'foo\n')
+
+    def test_plans(self):
+        for source in ('echo foo', 'a |& b 2>&1 | c >> d && e || f; g & h',
+                       '(a | b; c d && e || f > ghi jkl 2> mno) & p; q | r 2>&1 | s'):
+            tree = parse_command_line(source, posix=True)
+            plan = sarge.dump_plan(source, posix=True)
+            loaded = sarge.load_plan(plan)
+            self.assertEqual(loaded.source, source)
+            self.assertEqual(repr(loaded.copy(source=None)), repr(tree))
+            self.assertEqual(sarge.load_plan(plan.encode('utf-8')).source, source)
+            self.assertEqual(sarge.dump_plan(loaded), plan)
+        # Bound templates can be serialized, and loaded plans run
+        tree = sarge.compile_pipeline('echo {} && echo {}').bind('x  y', '$z')
+        p = capture_stdout(sarge.load_plan(sarge.dump_plan(tree)))
+        self.assertEqual(p.stdout.text, 'x  y\n$z\n')
+        self.assertFalse(hasattr(tree, 'source'))
+        self.assertIsNone(p.source)
+        self.assertRaises(ValueError, sarge.dump_plan,
+                          sarge.compile_pipeline('echo {}').tree)
+        # Plans are validated when loaded
+        self.assertRaises(ValueError, sarge.load_plan, '[]')
+        plan = json.loads(sarge.dump_plan('a | b > c'))
+        self.assertEqual(plan['version'], sarge.PLAN_VERSION)
+        for path, value in (('version', 0), ('tree', ['list', [0], []]),
+                            ('tree', ['logical', [2], plan['tree'][2]]),
+                            ('tree', ['logical', [0], plan['tree'][2][::-1]]),
+                            ('tree', ['command', [], []]),
+                            ('tree', ['command', ['a'], [[3, '>', 'x']]]),
+                            ('tree', ['command', ['a'], [[1, '<', 'x']]]),
+                            ('tree', ['command', ['a'], [[1, '>', -3]]])):
+            bad = dict(plan)
+            bad[path] = value
+            self.assertRaises(ValueError, sarge.load_plan, json.dumps(bad))
+
     def test_pipeline_no_input_stdout(self):
         with Capture() as out:
             with Pipeline('echo foo 2> %s | cat | cat' % os.devnull, stdout=out) as pl:
@@ -749,6 +906,729 @@ class SargeTest(unittest.TestCase):
         expected = b'done.\n' if os.name != 'nt' else b'done.\r\n'
         self.assertEqual(cap.read(), expected)
 
+    def test_wait_deadline(self):
+        if sys.version_info[:2] < (3, 3) or os.name != 'posix':
+            raise unittest.SkipTest('test is only valid for Python >= 3.3 on POSIX')
+        p = run('sleep 5 | sleep 5 | sleep 5', async_=True)
+        start = time.time()
+        with self.assertRaises(subprocess.TimeoutExpired) as ctx:
+            p.wait(0.5)
+        self.assertLess(time.time() - start, 2.0)  # not cumulative
+        self.assertEqual(len(ctx.exception.running), 3)
+        running = p.wait(0.1, raise_on_timeout=False, escalate=1.0)
+        self.assertEqual(running, p.commands)
+        self.assertEqual(p.returncodes, [-15] * 3)
+        self.assertEqual(p.wait(0.1), [])
+        code = 'import signal, time; signal.signal(signal.SIGTERM, signal.SIG_IGN); time.sleep(5)'
+        p = run([sys.executable, '-c', code], async_=True)
+        time.sleep(0.5)  # give it time to ignore SIGTERM
+        start = time.time()
+        running = p.wait(0.1, raise_on_timeout=False, escalate=0.2)
+        self.assertLess(time.time() - start, 2.0)
+        self.assertEqual(len(running), 1)
+        self.assertEqual(p.returncodes, [-9])
+        with self.assertRaises(subprocess.TimeoutExpired):
+            run('sleep 0.5 && sleep 5', async_=True).wait(0.1, escalate=0)
+
+    def test_cancel(self):
+        if os.name != 'posix':
+            raise unittest.SkipTest('test is only valid on POSIX')
+        import threading
+
+        spawned = threading.Event()
+        # Without cancellation, the ';' parts would run after the '&&' chain fails
+        source = ' && '.join(['sleep 5'] * 20) + ' ; ' + ' ; '.join(['sleep 5'] * 20)
+        p = run('(%s) & (%s)' % (source, source), async_=True,
+                on_spawn=lambda cmd: spawned.set())
+        self.assertTrue(spawned.wait(5.0))
+        time.sleep(0.2)
+        start = time.time()
+        p.cancel(grace=0.5)
+        self.assertLess(time.time() - start, 2.0)
+        self.assertTrue(1 <= len(p.commands) <= 2)
+        self.assertTrue(all(rc == -15 for rc in p.returncodes))
+        # a command which ignores SIGTERM is killed after the grace period
+        code = ('import signal, sys, time; signal.signal(signal.SIGTERM, signal.SIG_IGN); '
+                'sys.stdout.write("ready\\n"); sys.stdout.flush(); time.sleep(5)')
+        spawned.clear()
+        p = run([sys.executable, '-c', code], stdout=Capture(), async_=True,
+                on_first_output=lambda cmd, name: spawned.set())
+        self.assertTrue(spawned.wait(5.0))
+        start = time.time()
+        p.cancel(grace=0.2)
+        self.assertLess(time.time() - start, 2.0)
+        self.assertEqual(p.returncodes, [-9])
+        self.assertEqual(p.stdout.text, 'ready\n')
+        # signalling the process group stops descendants holding the output open
+        p = run("sh -c 'sleep 5; echo done'", stdout=Capture(), async_=True,
+                start_new_session=True)
+        time.sleep(0.2)
+        start = time.time()
+        p.cancel(grace=0.5, group=True)
+        self.assertLess(time.time() - start, 2.0)
+        self.assertEqual(p.stdout.text, '')
+
+    def test_process_groups(self):
+        if os.name != 'posix':
+            raise unittest.SkipTest('test is only valid on POSIX')
+        import signal
+        import threading
+
+        # A descendant which outlives its parent keeps the captured output open
+        p = run("sh -c 'sleep 1 & echo started'", stdout=Capture(), async_=True,
+                process_group=0)
+        p.wait_events()
+        cmd = p.commands[0]
+        self.assertEqual(cmd.wait(), 0)
+        self.assertEqual(cmd.process_group, cmd.process.pid)
+        orphans = p.orphans()
+        if orphans is not None:
+            self.assertEqual(len(orphans), 1)
+            self.assertEqual(os.getpgid(orphans[0]), cmd.process_group)
+        p.close()
+        self.assertEqual(p.stdout.text, 'started\n')
+        self.assertEqual(cmd.orphans(), [] if orphans is not None else None)
+        # Killing the group stops descendants while the command is running
+        started = threading.Event()
+        p = run("sh -c 'sleep 5 & echo started; sleep 5'", stdout=Capture(), async_=True,
+                process_group=0, on_first_output=lambda cmd, name: started.set())
+        self.assertTrue(started.wait(5.0))
+        start = time.time()
+        p.commands[0].kill(group=True)
+        p.close()
+        self.assertLess(time.time() - start, 2.0)
+        self.assertEqual(p.returncodes, [-9])
+        # Once all its members have been reaped, a group isn't signalled, as
+        # its ID could have been reused
+        killpg = os.killpg
+        calls = []
+        os.killpg = lambda *args: calls.append(args)
+        try:
+            p = run('true | true', new_group=True)
+            self.assertEqual(p.returncodes, [0, 0])
+            p.send_signal(signal.SIGTERM, group=True)
+            p.cancel(grace=0.1, group=True)
+            p.commands[0].terminate(group=True)
+            p.commands[0].kill(group=True)
+            p.commands[0].send_signal(signal.SIGTERM, group=True)
+        finally:
+            os.killpg = killpg
+        self.assertEqual(calls, [])
+        # All the commands in a pipeline can share a group
+        p = run('sleep 5 | sleep 5 | sleep 5', new_group=True, async_=True)
+        p.wait_events()
+        pgids = set(os.getpgid(c.process.pid) for c in p.commands)
+        self.assertEqual(pgids, set([p.process_group]))
+        self.assertEqual(p.process_group, p.commands[0].process.pid)
+        self.assertNotEqual(p.process_group, os.getpgid(0))
+        p.send_signal(signal.SIGTERM, group=True)
+        p.wait()
+        self.assertEqual(p.returncodes, [-15] * 3)
+        # A command can't join a group which has gone, so it starts a new one
+        p = run('true && true', new_group=True)
+        self.assertEqual(p.returncodes, [0, 0])
+        self.assertEqual([c.process_group for c in p.commands],
+                         [c.process.pid for c in p.commands])
+
+    def test_child_settings(self):
+        if os.name != 'posix':
+            raise unittest.SkipTest('test is only valid on POSIX')
+        import signal
+        import resource
+
+        burn = [sys.executable, '-c', 'while True: pass']
+        # A runaway command is stopped by its CPU time limit
+        cmd = Command(burn, rlimits={'cpu': 1})
+        cmd.run()
+        self.assertEqual(cmd.returncode, -signal.SIGXCPU)
+        code = ('import os, resource; '
+                'print(resource.getrlimit(resource.RLIMIT_NOFILE)[0], os.nice(0))')
+        p = run([sys.executable, '-c', code], rlimits={'nofile': (64, 64)}, nice=5,
+                stdout=Capture())
+        self.assertEqual(p.stdout.text.split(), ['64', str(os.nice(0) + 5)])
+        if hasattr(os, 'sched_getaffinity'):
+            code = 'import os; print(sorted(os.sched_getaffinity(0)))'
+            cpu = min(os.sched_getaffinity(0))
+            p = run([sys.executable, '-c', code], cpu_affinity=[cpu], stdout=Capture())
+            self.assertEqual(p.stdout.text, '[%d]\n' % cpu)
+        self.assertRaises(ValueError, run, 'true', rlimits={'nonesuch': 1})
+
+        # The settings are applied before the command runs, so they cover
+        # anything it starts
+        p = run(['sh', '-c', 'sh -c "ulimit -n"'], rlimits={'nofile': (64, 64)},
+                stdout=Capture())
+        self.assertEqual(p.stdout.text, '64\n')
+
+        # They need a fork()-based spawn
+        cmd = Command(['sleep', '5'], nice=19, rlimits={'cpu': 30}, fast_spawn=True)
+        cmd.run(async_=True)
+        try:
+            self.assertFalse(cmd.process.fast_spawned)
+            if hasattr(os, 'getpriority'):
+                self.assertEqual(os.getpriority(os.PRIO_PROCESS, cmd.process.pid), 19)
+            if hasattr(resource, 'prlimit'):
+                self.assertEqual(resource.prlimit(cmd.process.pid, resource.RLIMIT_CPU)[0], 30)
+        finally:
+            cmd.kill()
+            cmd.wait()
+        # The spawn server applies them in its children
+        from sarge import spawnserver
+
+        if spawnserver.available and hasattr(os, 'getpriority'):
+            server = spawnserver.SpawnServer().start()
+            try:
+                cmd = Command(['sleep', '5'], nice=19, spawn_server=server)
+                cmd.run(async_=True)
+                try:
+                    self.assertIsInstance(cmd.process, spawnserver.RemoteProcess)
+                    self.assertEqual(os.getpriority(os.PRIO_PROCESS, cmd.process.pid), 19)
+                finally:
+                    cmd.kill()
+                    cmd.wait()
+                if hasattr(os, 'sched_setaffinity'):
+                    cmd = Command('sleep 5', cpu_affinity=[1 << 20], spawn_server=server)
+                    self.assertRaises(subprocess.SubprocessError, cmd.run)
+            finally:
+                server.stop()
+        # Settings which can't be applied stop the command being run
+        if hasattr(os, 'sched_setaffinity'):
+            start = time.time()
+            self.assertRaises(subprocess.SubprocessError, run, 'sleep 5',
+                              cpu_affinity=[1 << 20])
+            self.assertLess(time.time() - start, 2.0)
+
+        # A niced command doesn't slow its siblings down, even on a single CPU
+
+        def work():
+            start = time.time()
+            for i in range(1000000):
+                pass
+            return time.time() - start
+
+        def measure():
+            return sorted(work() for i in range(7))[3]
+
+        baseline = measure()
+        cmd = Command(burn, nice=19, rlimits={'cpu': 30})
+        cmd.run(async_=True)
+        try:
+            time.sleep(0.1)
+            loaded = measure()
+        finally:
+            cmd.kill()
+            cmd.wait()
+        self.assertLess(loaded, baseline * 1.5)
+
+    def test_result_cache(self):
+        spawns = []
+
+        def on_spawn(cmd):
+            spawns.append(cmd)
+
+        cache = sarge.ResultCache(maxsize=2)
+        kwargs = {'cache': cache, 'on_spawn': on_spawn}
+        for i in range(3):
+            p = capture_both('echo foo && echo bar >&2 && false', **kwargs)
+            self.assertEqual(p.returncodes, [0, 0, 1])
+            self.assertEqual(p.returncode, 1)
+            self.assertEqual(p.stdout.readlines(), [b'foo\n'])
+            self.assertEqual(p.stderr.text, 'bar\n')
+        self.assertEqual(len(spawns), 3)
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+        self.assertEqual(get_stdout('cat', input='foo', **kwargs), 'foo')
+        self.assertEqual(get_stdout('cat', input='bar', **kwargs), 'bar')
+        self.assertEqual(get_stdout('cat', input='foo', **kwargs), 'foo')
+        self.assertEqual(len(spawns), 5)
+        # The least recently used result has been discarded
+        self.assertEqual(get_both('echo foo && echo bar >&2 && false', **kwargs),
+                         ('foo\n', 'bar\n'))
+        self.assertEqual(len(spawns), 8)
+        workdir = tempfile.mkdtemp()
+        try:
+            cache = sarge.ResultCache(directory=workdir, max_bytes=1000)
+            kwargs = {'cache': cache, 'on_spawn': on_spawn, 'cwd': workdir}
+            # Results depend on named files and environment variables
+            with open(os.path.join(workdir, 'dep.txt'), 'w') as f:
+                f.write('1')
+            kwargs['cache_files'] = [os.path.join(workdir, 'dep.txt')]
+            self.assertEqual(get_stdout('cat dep.txt', **kwargs), '1')
+            self.assertEqual(get_stdout('cat dep.txt', **kwargs), '1')
+            with open(os.path.join(workdir, 'dep.txt'), 'w') as f:
+                f.write('22')
+            self.assertEqual(get_stdout('cat dep.txt', **kwargs), '22')
+            del kwargs['cache_files']
+            os.environ['SARGE_CACHE_TEST'] = 'foo'
+            try:
+                cmd = [sys.executable, '-c',
+                       'import os; print(os.environ["SARGE_CACHE_TEST"])']
+                kwargs['cache_env'] = ['SARGE_CACHE_TEST']
+                self.assertEqual(get_stdout(cmd, **kwargs).strip(), 'foo')
+                os.environ['SARGE_CACHE_TEST'] = 'bar'
+                self.assertEqual(get_stdout(cmd, **kwargs).strip(), 'bar')
+            finally:
+                del os.environ['SARGE_CACHE_TEST']
+            # Output sent to a file isn't cached
+            del spawns[:]
+            run('echo foo > out.txt', **kwargs)
+            run('echo foo > out.txt', **kwargs)
+            self.assertEqual(len(spawns), 2)
+            # Results are shared through the directory, which is kept to size
+            for i in range(20):
+                get_stdout('echo %s %d' % ('x' * 50, i), **kwargs)
+            self.assertGreater(cache.evictions, 0)
+            size = sum(os.path.getsize(os.path.join(workdir, fn))
+                       for fn in os.listdir(workdir) if fn.endswith('.result'))
+            self.assertLessEqual(size, 1000)
+            other = sarge.ResultCache(directory=workdir)
+            kwargs['cache'] = other
+            del spawns[:]
+            self.assertEqual(get_stdout('echo %s 19' % ('x' * 50), **kwargs), 'x' * 50 + ' 19\n')
+            self.assertEqual(spawns, [])
+            self.assertEqual(other.disk_hits, 1)
+        finally:
+            shutil.rmtree(workdir)
+
+    def test_incremental(self):
+        spawns = []
+
+        def on_spawn(cmd):
+            spawns.append(cmd.args)
+
+        workdir = tempfile.mkdtemp()
+        try:
+            state = os.path.join(workdir, 'stages.json')
+            kwargs = {'cwd': workdir, 'incremental': state, 'on_spawn': on_spawn}
+            source = os.path.join(workdir, 'src.txt')
+            with open(source, 'w') as f:
+                f.write('foo\n')
+            cmd = 'cat src.txt > a.txt && sed s/o/0/g a.txt > b.txt; wc -c b.txt'
+            p = capture_stdout(cmd, **kwargs)
+            self.assertEqual(p.returncodes, [0, 0, 0])
+            self.assertEqual(len(spawns), 3)
+            self.assertEqual(p.skipped, [])
+            # Nothing has changed, so only the last command, which has no
+            # outputs, is run again
+            del spawns[:]
+            p = capture_stdout(cmd, **kwargs)
+            self.assertEqual(p.returncodes, [0, 0, 0])
+            self.assertEqual(spawns, [['wc', '-c', 'b.txt']])
+            self.assertEqual([c.args for c in p.skipped], [['cat', 'src.txt'],
+                                                          ['sed', 's/o/0/g', 'a.txt']])
+            with open(os.path.join(workdir, 'b.txt')) as f:
+                self.assertEqual(f.read(), 'f00\n')
+            # Touching an input without changing it doesn't cause a re-run
+            os.utime(source, None)
+            del spawns[:]
+            capture_stdout(cmd, **kwargs)
+            self.assertEqual(len(spawns), 1)
+            # Changing it re-runs the stages which depend on it
+            with open(source, 'w') as f:
+                f.write('bar\n')
+            del spawns[:]
+            capture_stdout(cmd, **kwargs)
+            self.assertEqual(len(spawns), 3)
+            with open(os.path.join(workdir, 'b.txt')) as f:
+                self.assertEqual(f.read(), 'bar\n')
+            # So does changing an output
+            with open(os.path.join(workdir, 'b.txt'), 'w') as f:
+                f.write('baz\n')
+            del spawns[:]
+            capture_stdout(cmd, **kwargs)
+            self.assertEqual(spawns[0], ['sed', 's/o/0/g', 'a.txt'])
+            # Inputs which aren't named in the arguments can be declared
+            del spawns[:]
+            for i in range(2):
+                run('echo done > stamp.txt', stage_inputs=['src.txt'], **kwargs)
+            self.assertEqual(len(spawns), 1)
+            with open(source, 'w') as f:
+                f.write('baz\n')
+            run('echo done > stamp.txt', stage_inputs=['src.txt'], **kwargs)
+            self.assertEqual(len(spawns), 2)
+            # Without a record, outputs newer than inputs are up to date
+            os.remove(state)
+            os.utime(source, (time.time() - 10, time.time() - 10))
+            del spawns[:]
+            run('cat src.txt > a.txt', **kwargs)
+            self.assertEqual(spawns, [])
+            os.utime(source, (time.time() + 10, time.time() + 10))
+            run('cat src.txt > a.txt', **kwargs)
+            self.assertEqual(len(spawns), 1)
+            # Failed stages and appended output aren't skipped
+            del spawns[:]
+            for i in range(2):
+                run('cat src.txt missing.txt > c.txt', **kwargs)
+                run('cat src.txt >> d.txt', **kwargs)
+            self.assertEqual(len(spawns), 4)
+            with open(os.path.join(workdir, 'd.txt')) as f:
+                self.assertEqual(f.read(), 'baz\nbaz\n')
+            # A stage can start a |& chain. When it's skipped, the next command
+            # reads nothing, rather than this process's stdin.
+            r, w = os.pipe()
+            os.write(w, b'leaked\n')
+            os.close(w)
+            saved = os.dup(0)
+            os.dup2(r, 0)
+            os.close(r)
+            try:
+                del spawns[:]
+                for i in range(2):
+                    p = capture_stdout('echo foo > e.txt |& cat', **kwargs)
+                    self.assertEqual(p.stdout.text, '')
+                self.assertEqual(spawns, [['echo', 'foo'], ['cat'], ['cat']])
+                self.assertEqual([c.args for c in p.skipped], [['echo', 'foo']])
+            finally:
+                os.dup2(saved, 0)
+                os.close(saved)
+        finally:
+            shutil.rmtree(workdir)
+
+    def test_hedged(self):
+        histogram = sarge.LatencyHistogram(window=20)
+        workdir = tempfile.mkdtemp()
+        try:
+            # The first copy stalls, and the second finishes quickly
+            cmd = ['sh', '-c', 'if [ -e marker ]; then echo fast; '
+                   'else touch marker; sleep 10; echo slow; fi']
+            start = time.time()
+            p = sarge.run_hedged(cmd, after=0.2, cwd=workdir, histogram=histogram)
+            self.assertLess(time.time() - start, 5)
+            self.assertEqual(p.stdout.text, 'fast\n')
+            self.assertEqual((histogram.hedges, histogram.hedge_wins), (1, 1))
+            self.assertEqual(histogram.count(histogram.signature(cmd, workdir)), 1)
+            # Copies which have already finished aren't cancelled
+            os.remove(os.path.join(workdir, 'marker'))
+            cmd = ['sh', '-c', 'if [ -e marker ]; then exit 1; '
+                   'else touch marker; sleep 0.5; echo slow; fi']
+            cancelled = []
+            cancel = Pipeline.cancel
+            Pipeline.cancel = lambda self, *args, **kwargs: cancelled.append(self)
+            try:
+                p = sarge.run_hedged(cmd, after=0.1, cwd=workdir, histogram=histogram)
+            finally:
+                Pipeline.cancel = cancel
+            self.assertEqual(p.stdout.text, 'slow\n')
+            self.assertEqual(cancelled, [])
+            self.assertEqual((histogram.hedges, histogram.hedge_wins), (2, 1))
+            # A command which finishes in time isn't duplicated
+            spawns = []
+            p = sarge.run_hedged('echo foo', after=5, histogram=histogram,
+                                 on_spawn=lambda c: spawns.append(c))
+            self.assertEqual(p.stdout.text, 'foo\n')
+            self.assertEqual(len(spawns), 1)
+            # Nor is one which fails: hedging isn't retrying
+            del spawns[:]
+            p = sarge.run_hedged('false', after=5, histogram=histogram,
+                                 on_spawn=lambda c: spawns.append(c))
+            self.assertEqual(p.returncode, 1)
+            self.assertEqual(len(spawns), 1)
+            # Without a threshold, none is used until durations are known
+            sig = histogram.signature('echo foo')
+            self.assertIsNone(histogram.percentile(sig))
+            for i in range(9):
+                sarge.run_hedged('echo foo', histogram=histogram)
+            self.assertEqual(histogram.count(sig), 10)
+            p95 = histogram.percentile(sig)
+            self.assertIsNotNone(p95)
+            self.assertEqual(p95, sorted(histogram.samples[sig])[-1])
+            self.assertEqual(histogram.percentile(sig, 50), sorted(histogram.samples[sig])[4])
+            self.assertEqual(histogram.hedges, 2)
+        finally:
+            shutil.rmtree(workdir)
+
+    def test_spawn_limiter(self):
+        # Spawns are limited to a rate, after an initial burst
+        limiter = sarge.SpawnLimiter(rate=20, burst=2)
+        start = time.time()
+        for i in range(6):
+            run('true', spawn_limiter=limiter)
+        self.assertGreaterEqual(time.time() - start, 0.18)
+        self.assertEqual(limiter.spawns, 6)
+        self.assertGreater(limiter.max_queue_delay, 0.03)
+        self.assertGreater(limiter.mean_queue_delay, 0)
+        # The number running at once is limited
+        limiter = sarge.SpawnLimiter(max_concurrency=2)
+        start = time.time()
+        cmds = [Command('sleep 0.3', spawn_limiter=limiter).run(async_=True) for i in range(4)]
+        self.assertEqual(limiter.running, 2)
+        for cmd in cmds:
+            cmd.wait()
+        self.assertGreaterEqual(time.time() - start, 0.55)
+        self.assertEqual(limiter.running, 0)
+        # The commands of a pipeline share a slot
+        limiter = sarge.SpawnLimiter(max_concurrency=1, timeout=5)
+        p = capture_stdout('echo foo | cat | cat', spawn_limiter=limiter)
+        self.assertEqual(p.stdout.text, 'foo\n')
+        # Spawns are rejected when they've waited too long, or too many wait
+        limiter.timeout = 0.05
+        cmd = Command('sleep 5', spawn_limiter=limiter).run(async_=True)
+        try:
+            with self.assertRaises(ValueError) as ctx:
+                run('true', spawn_limiter=limiter)
+            self.assertIn('timed out', str(ctx.exception))
+            limiter.max_queue = 0
+            self.assertRaises(ValueError, run, 'true', spawn_limiter=limiter)
+            self.assertEqual(limiter.rejections, 2)
+        finally:
+            cmd.kill()
+            cmd.wait()
+        # The limit is cut when the host is overloaded, and raised otherwise
+        overloaded = [True]
+
+        class TestLimiter(sarge.SpawnLimiter):
+            def overloaded(self):
+                return overloaded[0]
+
+        limiter = TestLimiter(max_concurrency=8, min_concurrency=2, adjust_interval=0)
+        for limit in (4, 2, 2):
+            run('true', spawn_limiter=limiter)
+            self.assertEqual(limiter.limit, limit)
+        self.assertEqual(limiter.decreases, 2)
+        overloaded[0] = False
+        for limit in (3, 4):
+            run('true', spawn_limiter=limiter)
+            self.assertEqual(limiter.limit, limit)
+        # Real signals can be used
+        limiter = sarge.SpawnLimiter(max_concurrency=4, target_load=1e6, target_runnable=1e6,
+                                     max_child_rss=1)
+        cmd = Command('sleep 0.5', spawn_limiter=limiter).run(async_=True)
+        try:
+            self.assertEqual(limiter.overloaded(), sarge._process_rss(cmd.process.pid) > 1)
+        finally:
+            cmd.wait()
+        self.assertRaises(ValueError, sarge.SpawnLimiter, rate=0)
+        # try_acquire() doesn't wait, but says when to try again
+        limiter = sarge.SpawnLimiter(rate=10, burst=1, max_concurrency=1, timeout=1)
+        self.assertEqual(limiter.try_acquire('a'), (True, None))
+        woken = []
+        self.assertEqual(limiter.try_acquire('b', 0.5, lambda: woken.append('b')),
+                         (False, 0.5))
+        limiter.failed('a')
+        self.assertEqual(woken, ['b'])
+        acquired, wait = limiter.try_acquire('b')
+        self.assertFalse(acquired)
+        self.assertAlmostEqual(wait, 0.1, delta=0.02)
+        self.assertRaises(ValueError, limiter.try_acquire, 'b', 1)
+
+    def test_compile_pipeline(self):
+        t = sarge.compile_pipeline('echo {} --x={}.txt "{}" | cat')
+        for args in (('foo', 1, 'bar'), ('a b; echo x', '$HOME', '`id` > y')):
+            p = t.run(*args, stdout=Capture())
+            self.assertEqual(p.stdout.text, 'foo --x=1.txt bar\n' if args[0] == 'foo' else
+                             'a b; echo x --x=$HOME.txt `id` > y\n')
+        # Binding doesn't reparse, and values can't add arguments or commands
+        node = t.bind('a && b', '', 'c | d')
+        self.assertEqual(node.parts[0].command, ['echo', 'a && b', '--x=.txt', 'c | d'])
+        self.assertEqual(node.parts[2].command, ['cat'])
+        # The compiled tree isn't changed by running bound copies of it
+        self.assertFalse(hasattr(t.tree.parts[0], 'cmd'))
+        workdir = tempfile.mkdtemp()
+        try:
+            t = sarge.compile_pipeline('echo {msg} > {0} && cat {0}', posix=True)
+            out = os.path.join(workdir, 'out file.txt')
+            p = t.pipeline(out, params={'msg': 'hello'}, stdout=Capture())
+            self.assertIsInstance(p, Pipeline)
+            p.run()
+            self.assertEqual(p.stdout.text, 'hello\n')
+            with open(out) as f:
+                self.assertEqual(f.read(), 'hello\n')
+        finally:
+            shutil.rmtree(workdir)
+        self.assertRaises(ValueError, t.bind, 'x')  # no value for msg
+        self.assertRaises(ValueError, t.bind, msg='x')
+        self.assertRaises(ValueError, sarge.compile_pipeline, 'echo {0!r}')
+        self.assertRaises(ValueError, sarge.compile_pipeline, 'echo {1}')
+        self.assertRaises(ValueError, sarge.compile_pipeline, 'echo {0.x}')
+
+    def test_parse_cache(self):
+        cache = sarge.parse_cache
+        maxsize = cache.maxsize
+        try:
+            cache.clear()
+            cache.maxsize = 2
+            self.assertIsNone(cache.hit_rate)
+            source = 'echo bar > /dev/null && echo foo | cat'
+            t = parse_command_line(source, posix=True)
+            self.assertIs(parse_command_line(source, posix=True), t)
+            self.assertIsNot(parse_command_line(source, posix=False), t)
+            self.assertEqual((cache.hits, cache.misses), (1, 2))
+            self.assertEqual(cache.hit_rate, 1 / 3.0)
+            # Pipelines share the tree, but not the state of running it
+            p1 = capture_stdout(source)
+            p2 = capture_stdout(source)
+            self.assertIs(p1.tree, p2.tree)
+            self.assertEqual(p1.stdout.text, 'foo\n')
+            self.assertEqual(p2.stdout.text, 'foo\n')
+            self.assertIsNot(p1.commands[0], p2.commands[0])
+            for node in [p1.tree.parts[0]] + p1.tree.parts[2].parts[::2]:
+                self.assertFalse(hasattr(node, 'cmd'))
+                self.assertIs(p1.node_commands[node].pipeline, p1)
+            self.assertEqual(p1.get_status(p1.tree.parts[2]), 0)
+            # The least recently used tree is discarded
+            parse_command_line('true', posix=True)
+            self.assertNotIn((source, False), cache.entries)
+            self.assertIn((source, True), cache.entries)
+            # Caching can be disabled
+            cache.maxsize = 0
+            self.assertIsNot(parse_command_line('true', posix=True),
+                             parse_command_line('true', posix=True))
+        finally:
+            cache.maxsize = maxsize
+            cache.clear()
+
+    def test_reaper(self):
+        if not sarge.reaper.available:
+            raise unittest.SkipTest('pidfds are not available on this platform')
+        exits = sarge.reaper.exits
+        p = Popen(['sleep', '0.2'])
+        self.assertIsNotNone(p.exited)
+        self.assertIsNone(p.poll())
+        self.assertTrue(p.exited.wait(5.0))
+        self.assertGreater(sarge.reaper.wait_for_exit(exits, 5.0), exits)
+        self.assertEqual(p.wait(), 0)
+        ps = [Popen(['sleep', '5']) for i in range(10)]
+        self.assertGreaterEqual(sarge.reaper.active, 10)
+        with self.assertRaises(subprocess.TimeoutExpired):
+            ps[0].wait(0.1)
+        for p in ps:
+            p.kill()
+        self.assertEqual([p.wait(5.0) for p in ps], [-9] * 10)
+        sarge.reaper.enabled = False
+        try:
+            p = Popen(['true'])
+            self.assertIsNone(p.exited)
+            self.assertEqual(p.wait(), 0)
+        finally:
+            sarge.reaper.enabled = True
+
+    def test_resource_usage(self):
+        if not hasattr(os, 'wait4'):
+            raise unittest.SkipTest('os.wait4() is not available on this platform')
+        hog = '%s -c "x = 0\nwhile x < 2000000: x += 1"' % sys.executable
+        start = time.time()
+        p = run('%s | cat && true' % hog)
+        usages = p.resource_usages
+        self.assertEqual(len(usages), 3)
+        self.assertTrue(all(isinstance(u, sarge.ResourceUsage) for u in usages))
+        self.assertGreater(usages[0].cpu_time, usages[1].cpu_time)
+        self.assertGreater(usages[0].max_rss, 0)
+        total = p.resource_usage
+        self.assertAlmostEqual(total.user_time, sum(u.user_time for u in usages))
+        self.assertEqual(total.max_rss, max(u.max_rss for u in usages))
+        self.assertEqual(sum(usages), total)
+        self.assertRaises(TypeError, hash, total)
+        self.assertLessEqual(start, p.start_time)
+        self.assertLessEqual(p.start_time, p.end_time)
+        self.assertLessEqual(p.end_time, time.time())
+        c = p.commands[0]
+        self.assertEqual(c.start_time, p.start_time)
+        self.assertGreater(c.end_time - c.start_time, 0)
+        p = run('sleep 5', async_=True)
+        p.wait_events()
+        self.assertIsNone(p.resource_usage)
+        self.assertIsNone(p.end_time)
+        p.commands[0].kill()
+        p.wait()
+        self.assertIsNotNone(p.resource_usage)
+
+    def test_tracer(self):
+        import json
+        from io import StringIO
+
+        sarge.parse_cache.clear()  # so that the command line is parsed
+        with sarge.Tracer() as tracer:
+            self.assertIs(sarge.tracer, tracer)
+            p = capture_stdout('echo foo | cat && false')
+        self.assertIsNone(sarge.tracer)
+        self.assertEqual(p.stdout.text, 'foo\n')
+        pids = [c.process.pid for c in p.commands]
+        events = tracer.to_json()['traceEvents']
+        names = [e['name'] for e in events]
+        self.assertEqual(names.count('parse'), 1)
+        self.assertEqual(names.count('spawn'), 3)
+        self.assertEqual(names.count('thread_name'), 4)  # the parsing thread and children
+        cat = pids[1]
+        cat_events = dict((e['name'], e) for e in events if e['tid'] == cat and e['ph'] != 'M')
+        expected = ['spawn', 'first output (stdout)', 'EOF (stdout)']
+        if hasattr(os, 'wait4'):
+            expected.extend(['run', 'exit'])
+        self.assertEqual(set(cat_events), set(expected))
+        self.assertLessEqual(cat_events['first output (stdout)']['ts'],
+                             cat_events['EOF (stdout)']['ts'])
+        if hasattr(os, 'wait4'):
+            exits = dict((e['tid'], e['args']['returncode']) for e in events
+                         if e['name'] == 'exit')
+            self.assertEqual(exits, {pids[0]: 0, cat: 0, pids[2]: 1})
+            run_event = [e for e in events if e['name'] == 'run' and e['tid'] == cat][0]
+            self.assertGreaterEqual(run_event['dur'], 0)
+            self.assertIn('max_rss', run_event['args'])
+        out = StringIO()
+        tracer.dump(out)
+        self.assertEqual(json.loads(out.getvalue())['traceEvents'], events)
+        # nothing is recorded once uninstalled
+        run('true')
+        self.assertEqual(len(tracer.events), len(events))
+
+    def test_hooks(self):
+        import threading
+
+        events = []
+        complete = threading.Event()
+
+        def on_spawn(cmd):
+            events.append(('spawn', cmd.args[0]))
+
+        def on_first_output(cmd, name):
+            events.append(('output', cmd.args[0], name))
+
+        def on_exit(cmd, returncode, usage):
+            events.append(('exit', cmd.args[0], returncode))
+            if hasattr(os, 'wait4'):
+                self.assertTrue(isinstance(usage, sarge.ResourceUsage))
+
+        def on_complete(p):
+            events.append(('complete', p.returncodes))
+            complete.set()
+
+        p = run('echo foo | cat && false; sleep 0.1 & echo bar', stdout=Capture(),
+                on_spawn=on_spawn, on_first_output=on_first_output, on_exit=on_exit,
+                on_complete=on_complete, async_=True)
+        self.assertTrue(complete.wait(5.0))
+        p.close()
+        self.assertEqual(p.stdout.text.split(), ['foo', 'bar'])
+        self.assertEqual(events[-1], ('complete', [0, 0, 1, 0, 0]))
+        self.assertEqual(sorted(e for e in events if e[0] == 'exit'),
+                         [('exit', 'cat', 0), ('exit', 'echo', 0), ('exit', 'echo', 0),
+                          ('exit', 'false', 1), ('exit', 'sleep', 0)])
+        self.assertEqual(len([e for e in events if e[0] == 'spawn']), 5)
+        self.assertEqual(sorted(e for e in events if e[0] == 'output'),
+                         [('output', 'cat', 'stdout'), ('output', 'echo', 'stdout')])
+        # hooks for a single command, and a failing hook
+        exits = []
+        c = Command('true', on_exit=lambda cmd, rc, usage: exits.append(rc),
+                    on_spawn=lambda cmd: 1 / 0)
+        c.run()
+        self.assertEqual(c.returncode, 0)
+        c.wait()
+        self.assertEqual(exits, [0])
+        # hooks are called without the child's lock held, so they can poll or
+        # wait for it, and they've all been called when wait() returns
+        seen = []
+
+        def check_unlocked(cmd, rc, usage):
+            lock = getattr(cmd.process, '_waitpid_lock', None)
+            if lock is not None:
+                # another thread may hold it briefly, but not this one
+                seen.append(lock.acquire(True, 2))
+                if seen[-1]:
+                    lock.release()
+            seen.append((cmd.process.poll(), cmd.process.wait()))
+
+        for cmd in ('true', 'sleep 0.1'):
+            del seen[:]
+            Command(cmd, on_exit=check_unlocked).run(async_=True).wait()
+            self.assertEqual(seen[-1], (0, 0))
+            self.assertNotIn(False, seen)
+
     def test_exceptions(self):
         cmd = 'echo "Hello" && eco "Goodbye"'
         cap = Capture(buffer_size=1)
@@ -764,6 +1644,310 @@ class SargeTest(unittest.TestCase):
         returncodes = p.returncodes
         self.assertEqual(returncodes, [0, None])
 
+    def test_executable_cache(self):
+        from sarge.utils import ExecutableCache
+
+        cache = ExecutableCache(check_interval=0)
+        workdir = tempfile.mkdtemp()
+        try:
+            bindirs = [os.path.join(workdir, d) for d in ('a', 'b')]
+            for d in bindirs:
+                os.mkdir(d)
+            path = os.pathsep.join(bindirs)
+            self.assertIsNone(cache.find('sarge-tool', path))
+            self.assertIsNone(cache.find('sarge-tool', path))
+            self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+            def make_tool(d):
+                fn = os.path.join(d, 'sarge-tool')
+                with open(fn, 'w') as f:
+                    f.write('#!/bin/sh\n')
+                os.chmod(fn, 0o755)
+                # make sure the directory's mtime is seen to change
+                t = time.time() + 10
+                os.utime(d, (t, t))
+                return fn
+
+            fn = make_tool(bindirs[1])
+            self.assertEqual(cache.find('sarge-tool', path), fn)
+            self.assertEqual(cache.find('sarge-tool', path), fn)
+            self.assertEqual((cache.hits, cache.misses), (2, 2))
+            # a new executable earlier on the path invalidates the result
+            fn = make_tool(bindirs[0])
+            self.assertEqual(cache.find('sarge-tool', path), fn)
+            self.assertEqual((cache.hits, cache.misses), (2, 3))
+            # so does a change to the executable itself, even between checks
+            # of the directories
+            cache.check_interval = 3600
+            self.assertEqual(cache.find('sarge-tool', path), fn)
+            os.chmod(fn, 0o644)
+            self.assertEqual(cache.find('sarge-tool', path),
+                             os.path.join(bindirs[1], 'sarge-tool'))
+            self.assertEqual((cache.hits, cache.misses), (3, 4))
+            cache.check_interval = 0
+            # relative entries are looked up relative to cwd
+            self.assertEqual(cache.find('sarge-tool', 'b', cwd=workdir),
+                             os.path.join(workdir, 'b', 'sarge-tool'))
+            self.assertEqual(cache.find('./sarge-tool', path), './sarge-tool')
+        finally:
+            shutil.rmtree(workdir)
+
+    def test_run_many(self):
+        cmds = ['echo %d' % i for i in range(10)] + ['echo foo | cat', 'nonesuch']
+        results = run_many(cmds, max_workers=4, capture_stdout=True)
+        self.assertEqual([p.stdout.text for p in results[:11]],
+                         ['%d\n' % i for i in range(10)] + ['foo\n'])
+        self.assertEqual(results[-1].commands[0].exception.args,
+                         ('Command not found: nonesuch',))
+        # Errors in spawning are in each command's result; others are raised
+        completed = []
+        results = run_many(['true', 'true && nonesuch'], on_complete=completed.append)
+        self.assertEqual(len(completed), 2)
+        self.assertIsNone(results[0].commands[0].exception)
+        self.assertIsInstance(results[1].commands[1].exception, ValueError)
+        self.assertRaises(ValueError, run_many, ['true'], stdin=subprocess.PIPE)
+        cmd = '%s waiter.py 0.5' % sys.executable
+        start = time.time()
+        results = run_many([cmd] * 4, max_workers=2)
+        elapsed = time.time() - start
+        self.assertEqual([p.returncode for p in results], [0] * 4)
+        self.assertGreater(elapsed, 1.0)
+        self.assertLess(elapsed, 2.0)
+        results = run_many(['%s && echo slow' % cmd, 'echo fast'], max_workers=2,
+                           ordered=False, capture_stdout=True)
+        self.assertEqual([p.stdout.text.split()[-1] for p in results], ['fast', 'slow'])
+
+    def test_formatter_sequences(self):
+        self.assertEqual(shell_format('ls {0:*}', ['a b', '*.py', 'c']), "ls 'a b' '*.py' c")
+        self.assertEqual(shell_format('ls {0:*}', ()), 'ls ')
+        # Without the * spec, a sequence is a single word, as before 0.1.9
+        self.assertEqual(shell_format('ls {0}', ['a', 'b']), shell_format('ls {0}', "['a', 'b']"))
+        self.assertEqual(shell_format('ls {0!s}', ('a', 'b')), "ls ('a', 'b')")
+
+    def test_run_batched(self):
+        items = ['a b', "it's", '*', 'plain'] * 5
+        lister = '%s -c "import sys; sys.stdout.write(repr(sys.argv[1:]))"' % sys.executable
+        results = run_batched(lister, items, capture_stdout=True)
+        self.assertEqual(len(results), 1)
+        self.assertEqual(results[0].stdout.text, repr(items))
+        results = run_batched(lister + ' {0} end', items, max_args=8, max_workers=2,
+                              capture_stdout=True)
+        self.assertEqual([p.stdout.text for p in results],
+                         [repr(items[:8] + ['end']), repr(items[8:16] + ['end']),
+                          repr(items[16:] + ['end'])])
+        # the size limit is respected
+        from sarge import batch_arguments
+
+        batches = list(batch_arguments(['x' * 10] * 10, 100))
+        self.assertEqual([len(b) for b in batches], [5, 5] if sys.maxsize > 2**32 else [6, 4])
+        self.assertRaises(ValueError, list, batch_arguments(['x' * 100], 100))
+
+    def test_fast_spawn(self):
+        if not sarge._CAN_FAST_SPAWN:
+            raise unittest.SkipTest('os.posix_spawn is not available')
+        p = capture_both('echo foo >&2 && echo bar', fast_spawn=True)
+        self.assertEqual(p.stdout.text, 'bar\n')
+        self.assertEqual(p.stderr.text, 'foo\n')
+        self.assertTrue(all(c.process.fast_spawned for c in p.commands))
+        p = capture_stdout('echo foo', fast_spawn=False)
+        self.assertEqual(p.stdout.text, 'foo\n')
+        self.assertFalse(p.commands[0].process.fast_spawned)
+        # a working directory needs a fork-based spawn
+        p = capture_stdout('echo foo', cwd=tempfile.gettempdir(), fast_spawn=True)
+        self.assertEqual(p.stdout.text, 'foo\n')
+        self.assertFalse(p.commands[0].process.fast_spawned)
+
+    def test_fast_spawn_close_fds(self):
+        if not sarge._CAN_FAST_SPAWN:
+            raise unittest.SkipTest('os.posix_spawn is not available')
+        rd, wr = os.pipe()
+        try:
+            os.set_inheritable(wr, True)
+            cmd = [sys.executable, '-c', 'import os; os.fstat(%d)' % wr]
+            c = Command(cmd, stderr=subprocess.DEVNULL, fast_spawn=True)
+            c.run()
+            self.assertTrue(c.process.fast_spawned)
+            self.assertEqual(c.returncode, 1)
+            c = Command(cmd, close_fds=False, fast_spawn=True)
+            c.run()
+            self.assertEqual(c.returncode, 0)
+        finally:
+            os.close(rd)
+            os.close(wr)
+
+    def test_spawn_server(self):
+        from sarge import spawnserver
+
+        if not spawnserver.available:
+            raise unittest.SkipTest('A spawn server is not available on this platform')
+        server = spawnserver.SpawnServer().start()
+        try:
+            p = capture_both('echo foo >&2 && echo bar | cat', spawn_server=server)
+            self.assertEqual(p.returncodes, [0, 0, 0])
+            self.assertEqual(p.stdout.text, 'bar\n')
+            self.assertEqual(p.stderr.text, 'foo\n')
+            for c in p.commands:
+                self.assertTrue(isinstance(c.process, spawnserver.RemoteProcess))
+                self.assertTrue(isinstance(c.resource_usage, sarge.ResourceUsage))
+            self.assertEqual(get_stdout('cat', input='baz', spawn_server=server), 'baz')
+            p = run('%s waiter.py 5.0' % sys.executable, async_=True, spawn_server=server)
+            with self.assertRaises(subprocess.TimeoutExpired):
+                p.wait(0.1)
+            p.commands[0].kill()
+            p.wait()
+            self.assertEqual(p.returncodes, [-9])
+            self.assertRaises(ValueError, run, 'nonesuch', spawn_server=server)
+        finally:
+            server.stop()
+        # A child which has been reaped elsewhere is reported as having exited,
+        # and doesn't stop the server's reaper. This runs in another process,
+        # as the reaper would reap any of our children.
+        code = '''if True:
+            import socket, subprocess, threading
+            from sarge.spawnserver import Server, recv_message
+            ours, theirs = socket.socketpair()
+            ours.settimeout(10)
+            server = Server(theirs)
+            t = threading.Thread(target=server.reap)
+            t.daemon = True
+            t.start()
+            for args in (['true'], ['false']):
+                p = subprocess.Popen(args)
+                p.wait()
+                with server.lock:
+                    server.children[p.pid] = p
+                    server.children_present.notify()
+                print(recv_message(ours, 0)[0]['returncode'])
+            p = subprocess.Popen(['sh', '-c', 'exit 3'])
+            with server.lock:
+                server.children[p.pid] = p
+                server.children_present.notify()
+            print(recv_message(ours, 0)[0]['returncode'])
+        '''
+        p = run([sys.executable, '-c', code], stdout=Capture(), env={'PYTHONPATH': os.getcwd()})
+        self.assertEqual(p.stdout.text.split(), ['0', '1', '3'])
+
+    def test_node_executor(self):
+        import threading
+
+        executor = sarge.NodeExecutor(max_workers=1, idle_timeout=5.0)
+        started = threading.Event()
+        release = threading.Event()
+        done = []
+
+        def blocker():
+            started.set()
+            release.wait()
+            done.append('blocker')
+
+        def nested(e):
+            # runs in a worker: the inner submission mustn't wait behind blocker
+            inner = threading.Event()
+            executor.submit(inner.set)
+            executor.begin_wait()
+            try:
+                if inner.wait(5.0):
+                    e.set()
+            finally:
+                executor.end_wait()
+
+        executor.submit(blocker)
+        self.assertTrue(started.wait(5.0))
+        executor.submit(done.append, 'queued')
+        self.assertEqual(executor.queue_depth, 1)
+        self.assertEqual(executor.active_workers, 1)
+        release.set()
+        e = threading.Event()
+        executor.submit(nested, e)
+        self.assertTrue(e.wait(5.0))
+        self.assertEqual(done, ['blocker', 'queued'])
+        self.assertEqual(executor.queue_depth, 0)
+        self.assertEqual(executor.overflow_threads, 1)
+        # workers are reused by pipelines
+        created = sarge.node_executor.threads_created
+        for i in range(10):
+            with Capture() as out:
+                p = run('echo foo & echo bar', stdout=out, async_=True)
+                p.close()
+                self.assertEqual(sorted(out.text.split()), ['bar', 'foo'])
+        self.assertLess(sarge.node_executor.threads_created - created, 20)
+        self.assertEqual(sarge.node_executor.waiting_workers, 0)
+
+    @unittest.skipIf(sys.version_info[:2] < (3, 5), 'asyncio support requires Python >= 3.5')
+    def test_async_pipeline(self):
+        import asyncio
+        import threading
+        from sarge import aio
+
+        loop = asyncio.new_event_loop()
+
+        def arun(cmd, **kwargs):
+            return loop.run_until_complete(aio.run(cmd, **kwargs))
+
+        try:
+            nthreads = threading.active_count()
+            p = arun('echo foo | cat && false || echo bar; echo baz & echo quux',
+                     stdout=Capture())
+            self.assertEqual(sorted(p.stdout.text.split()), ['bar', 'baz', 'foo', 'quux'])
+            self.assertEqual(p.returncodes, [0, 0, 1, 0, 0, 0])
+            self.assertEqual(threading.active_count(), nthreads)
+            self.assertTrue(all(isinstance(c, aio.AsyncCommand) for c in p.commands))
+            p = arun('echo foo >&2 |& cat', stdout=Capture())
+            self.assertEqual(p.stdout.text, 'foo\n')
+            p = arun('echo foo >&2', stderr=Capture())
+            self.assertEqual(p.stderr.text, 'foo\n')
+            self.assertEqual(arun('cat', input='bar', stdout=Capture()).stdout.text, 'bar')
+            workdir = tempfile.mkdtemp()
+            try:
+                p = arun('echo foo > out.txt && cat out.txt', stdout=Capture(), cwd=workdir)
+                self.assertEqual(p.stdout.text, 'foo\n')
+            finally:
+                shutil.rmtree(workdir)
+            self.assertEqual(arun('false').returncode, 1)
+            self.assertRaises(ValueError, arun, 'nonesuch')
+            # close() is a coroutine, so a plain with statement isn't allowed
+            with self.assertRaises(TypeError):
+                with aio.AsyncPipeline('true'):
+                    pass
+            p = arun('sleep 0.1 && echo foo', stdout=Capture(), async_=True)
+            self.assertTrue(all(rc is None for rc in p.returncodes))
+            loop.run_until_complete(p.close())
+            self.assertEqual(p.returncodes, [0, 0])
+            self.assertEqual(p.stdout.text, 'foo\n')
+            events = []
+            p = arun('echo foo | cat && false', stdout=Capture(),
+                     on_spawn=lambda cmd: events.append('spawn'),
+                     on_first_output=lambda cmd, name: events.append(name),
+                     on_exit=lambda cmd, rc, usage: events.append(rc),
+                     on_complete=lambda p: events.append('complete'))
+            self.assertEqual(events.count('spawn'), 3)
+            self.assertEqual(events.count('stdout'), 1)
+            self.assertEqual(sorted(e for e in events if isinstance(e, int)), [0, 0, 1])
+            self.assertEqual(events[-1], 'complete')
+            limiter = sarge.SpawnLimiter(rate=10, max_concurrency=1, timeout=5)
+            p = arun('echo foo | cat; echo bar', stdout=Capture(), spawn_limiter=limiter)
+            self.assertEqual(p.stdout.text, 'foo\nbar\n')
+            self.assertEqual(limiter.spawns, 3)
+            self.assertEqual(limiter.running, 0)
+            # Another pipeline can't start while one holds the only slot, and
+            # waits for it without a helper thread
+            p = arun('sleep 0.3', spawn_limiter=limiter, async_=True)
+            start = time.time()
+            arun('true', spawn_limiter=limiter)
+            self.assertGreaterEqual(time.time() - start, 0.2)
+            loop.run_until_complete(p.close())
+            self.assertEqual(limiter.running, 0)
+            self.assertLessEqual(threading.active_count(), nthreads)
+            p = arun('sleep 5 && sleep 5; sleep 5 & echo foo | cat', async_=True)
+            loop.run_until_complete(asyncio.sleep(0.2))
+            start = time.time()
+            loop.run_until_complete(p.cancel(grace=0.5))
+            self.assertLess(time.time() - start, 2.0)
+            self.assertEqual(p.returncodes, [-15])
+        finally:
+            loop.close()
+
+
 if __name__ == '__main__':  # pragma: no cover
     # switch the level to DEBUG for in-depth logging.
     if not os.path.exists('logs'):